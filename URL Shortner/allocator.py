@@ -0,0 +1,242 @@
+# Short code allocation
+import abc
+import asyncio
+import hashlib
+import os
+import string
+import threading
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+
+from database import engine as default_engine
+from models import CodeCounter
+from utils import generate_short_code
+
+BASE62_ALPHABET = string.digits + string.ascii_letters
+BASE = len(BASE62_ALPHABET)
+
+
+def base62_encode(value: int, length: int) -> str:
+    """Encode a non-negative integer as a fixed-width base62 string"""
+    chars = []
+    for _ in range(length):
+        value, remainder = divmod(value, BASE)
+        chars.append(BASE62_ALPHABET[remainder])
+    if value:
+        raise ValueError("Value does not fit in the requested length")
+    return "".join(reversed(chars))
+
+
+def base62_decode(code: str) -> int:
+    """Decode a base62 string back to its integer value"""
+    value = 0
+    for char in code:
+        value = value * BASE + BASE62_ALPHABET.index(char)
+    return value
+
+
+class FeistelPermutation:
+    """Keyed bijection over range(domain).
+
+    A balanced Feistel network permutes the smallest even-bit power of two
+    covering the domain; values that land outside the domain are walked
+    through the network again until they fall back inside it.
+    """
+
+    def __init__(self, key: bytes, domain: int, rounds: int = 4):
+        self.key = key
+        self.domain = domain
+        self.rounds = rounds
+        bits = max(2, (domain - 1).bit_length())
+        bits += bits % 2
+        self.half_bits = bits // 2
+        self.half_mask = (1 << self.half_bits) - 1
+
+    def _round(self, round_number: int, value: int) -> int:
+        digest = hashlib.blake2b(
+            value.to_bytes(8, "big"),
+            key=self.key,
+            digest_size=8,
+            person=round_number.to_bytes(16, "big"),
+        ).digest()
+        return int.from_bytes(digest, "big") & self.half_mask
+
+    def _encrypt(self, value: int) -> int:
+        left, right = value >> self.half_bits, value & self.half_mask
+        for round_number in range(self.rounds):
+            left, right = right, left ^ self._round(round_number, right)
+        return (left << self.half_bits) | right
+
+    def permute(self, value: int) -> int:
+        if not 0 <= value < self.domain:
+            raise ValueError("Value outside permutation domain")
+        value = self._encrypt(value)
+        while value >= self.domain:
+            value = self._encrypt(value)
+        return value
+
+
+class CodeAllocator(abc.ABC):
+    """Interface for short code allocators used by /shorten"""
+
+    @abc.abstractmethod
+    def allocate(self) -> str:
+        """Return a new short code"""
+
+    async def allocate_async(self) -> str:
+        return self.allocate()
+
+    def allocate_many(self, count: int) -> list[str]:
+        return [self.allocate() for _ in range(count)]
+
+
+class RandomCodeAllocator(CodeAllocator):
+    """Legacy allocator: random codes, collisions are left to the unique index"""
+
+    def __init__(self, length: int = 6):
+        self.length = length
+
+    def allocate(self) -> str:
+        return generate_short_code(self.length)
+
+
+class FeistelCodeAllocator(CodeAllocator):
+    """Collision-free allocator built on a persistent counter.
+
+    Each process leases a block of counter values from the ``code_counters``
+    table and hands them out from memory, so the database is touched once per
+    ``block_size`` codes. Counter values are split into tiers by code length:
+    once ``max_fill`` of the keyspace of the current length has been handed
+    out, allocation moves on to codes one character longer. Within a tier the
+    index is passed through a keyed Feistel permutation so consecutive codes
+    do not look sequential. Unused values of a lease are lost on restart.
+    """
+
+    def __init__(
+        self,
+        key: bytes,
+        engine=None,
+        min_length: int = 6,
+        max_fill: float = 0.5,
+        block_size: int = 1000,
+        counter_name: str = "short_code",
+    ):
+        self.key = hashlib.blake2b(key, digest_size=32).digest()
+        self.engine = engine or default_engine
+        self.min_length = min_length
+        self.max_fill = max_fill
+        self.block_size = block_size
+        self.counter_name = counter_name
+        self._lock = threading.Lock()
+        self._next = 0
+        self._end = 0
+        self._permutations: dict[int, FeistelPermutation] = {}
+
+    def tier_for(self, counter: int) -> tuple[int, int]:
+        """Return (code length, index within that length) for a counter value"""
+        length = self.min_length
+        offset = 0
+        while True:
+            capacity = max(1, int(BASE**length * self.max_fill))
+            if counter < offset + capacity:
+                return length, counter - offset
+            offset += capacity
+            length += 1
+
+    def _permutation(self, length: int) -> FeistelPermutation:
+        permutation = self._permutations.get(length)
+        if permutation is None:
+            permutation = FeistelPermutation(self.key, BASE**length)
+            self._permutations[length] = permutation
+        return permutation
+
+    def _lease_block(self, size: int | None = None) -> int:
+        """Reserve size (default block_size) counter values and return the first one"""
+        size = size or self.block_size
+        for _ in range(2):
+            try:
+                with self.engine.begin() as conn:
+                    result = conn.execute(
+                        update(CodeCounter)
+                        .where(CodeCounter.name == self.counter_name)
+                        .values(next_value=CodeCounter.next_value + size)
+                    )
+                    if result.rowcount == 0:
+                        conn.execute(
+                            insert(CodeCounter).values(
+                                name=self.counter_name, next_value=size
+                            )
+                        )
+                        return 0
+                    end = conn.execute(
+                        select(CodeCounter.next_value).where(
+                            CodeCounter.name == self.counter_name
+                        )
+                    ).scalar_one()
+                    return end - size
+            except IntegrityError:
+                # Another process created the counter row first; retry the update
+                continue
+        raise RuntimeError("Could not lease a short code block")
+
+    def next_counter(self) -> int:
+        with self._lock:
+            if self._next >= self._end:
+                self._next = self._lease_block()
+                self._end = self._next + self.block_size
+            value = self._next
+            self._next += 1
+            return value
+
+    def next_counters(self, count: int) -> list[int]:
+        """Take count values, leasing whatever the current block lacks in one go"""
+        with self._lock:
+            values = list(range(self._next, min(self._end, self._next + count)))
+            self._next += len(values)
+            missing = count - len(values)
+            if missing:
+                start = self._lease_block(max(missing, self.block_size))
+                values.extend(range(start, start + missing))
+                self._next = start + missing
+                self._end = start + max(missing, self.block_size)
+            return values
+
+    def code_for(self, counter: int) -> str:
+        length, index = self.tier_for(counter)
+        return base62_encode(self._permutation(length).permute(index), length)
+
+    def allocate(self) -> str:
+        return self.code_for(self.next_counter())
+
+    async def allocate_async(self) -> str:
+        """Like allocate, but leases a new block in a thread instead of the event loop"""
+        if self._next >= self._end:
+            return await asyncio.to_thread(self.allocate)
+        return self.allocate()
+
+    def allocate_many(self, count: int) -> list[str]:
+        return [self.code_for(counter) for counter in self.next_counters(count)]
+
+
+_allocator: CodeAllocator | None = None
+
+
+def get_allocator() -> CodeAllocator:
+    """Return the process-wide allocator selected by SHORT_CODE_ALLOCATOR"""
+    global _allocator
+    if _allocator is None:
+        kind = os.getenv("SHORT_CODE_ALLOCATOR", "feistel")
+        if kind == "random":
+            _allocator = RandomCodeAllocator()
+        elif kind == "feistel":
+            key = os.getenv("SHORT_CODE_KEY") or os.getenv("SECRET_KEY", "")
+            _allocator = FeistelCodeAllocator(
+                key.encode(),
+                min_length=int(os.getenv("SHORT_CODE_MIN_LENGTH", "6")),
+                max_fill=float(os.getenv("SHORT_CODE_MAX_FILL", "0.5")),
+                block_size=int(os.getenv("SHORT_CODE_BLOCK_SIZE", "1000")),
+            )
+        else:
+            raise ValueError(f"Unknown SHORT_CODE_ALLOCATOR: {kind}")
+    return _allocator
@@ -0,0 +1,119 @@
+# Cache of verified access tokens
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+from sqlalchemy import event
+
+from models import User
+
+
+class UserSnapshot(NamedTuple):
+    """The fields of a user that authenticated endpoints need"""
+
+    id: int
+    username: str
+    is_active: bool
+
+
+def snapshot_for(user) -> UserSnapshot:
+    return UserSnapshot(user.id, user.username, bool(user.is_active))
+
+
+def token_key(token: str) -> bytes:
+    """Raw tokens are never kept in memory, only their digest"""
+    return hashlib.sha256(token.encode()).digest()
+
+
+class TokenCache:
+    """Bounded LRU of verified tokens to user snapshots.
+
+    An entry lives for at most ``ttl`` seconds and never past the token's own
+    ``exp``. Entries are also indexed by user id so that updating or deleting
+    a user drops every token issued to them.
+    """
+
+    def __init__(self, max_size: int = 10_000, ttl: float = 300.0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[bytes, tuple[UserSnapshot, float]] = OrderedDict()
+        self._by_user: dict[int, set[bytes]] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, token: str, now: float | None = None) -> UserSnapshot | None:
+        now = time.time() if now is None else now
+        key = token_key(token)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    self._remove(key)
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, token: str, user: UserSnapshot, exp: float, now: float | None = None):
+        now = time.time() if now is None else now
+        expires = min(now + self.ttl, exp)
+        if expires <= now:
+            return
+        key = token_key(token)
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (user, expires)
+            self._by_user.setdefault(user.id, set()).add(key)
+            while len(self._entries) > self.max_size:
+                self._remove(next(iter(self._entries)))
+
+    def _remove(self, key: bytes):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            keys = self._by_user.get(entry[0].id)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_user[entry[0].id]
+
+    def invalidate_user(self, user_id: int):
+        with self._lock:
+            for key in list(self._by_user.get(user_id, ())):
+                self._remove(key)
+            self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._by_user.clear()
+
+    def stats(self) -> dict:
+        return {
+            "entries": len(self._entries),
+            "max_size": self.max_size,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+        }
+
+
+def watch_users(token_cache: TokenCache):
+    """Invalidate cached tokens whenever a User is updated or deleted via the ORM.
+
+    Bulk ``update(User)``/``delete(User)`` statements bypass these hooks; other
+    workers see the change once their entries reach the TTL.
+    """
+
+    @event.listens_for(User, "after_update")
+    @event.listens_for(User, "after_delete")
+    def user_changed(mapper, connection, target):
+        token_cache.invalidate_user(target.id)
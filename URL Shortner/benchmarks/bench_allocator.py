@@ -0,0 +1,99 @@
+"""Short code creation latency versus table size.
+
+Seeds a scratch SQLite database with N rows in ``urls`` and measures the cost
+of creating new links with the legacy random-code + existence-query loop and
+with the Feistel allocator, which relies on the unique index alone.
+
+Run from the project directory:
+    python -m benchmarks.bench_allocator --sizes 10000,1000000,50000000
+"""
+import argparse
+import os
+import statistics
+import tempfile
+import time
+
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import IntegrityError
+
+from allocator import FeistelCodeAllocator, RandomCodeAllocator
+from models import Base, URL
+
+
+def seed(engine, rows: int):
+    """Fill urls with `rows` rows using codes outside the generated keyspace"""
+    with engine.begin() as conn:
+        conn.execute(
+            text(
+                "WITH RECURSIVE seq(n) AS (SELECT 1 UNION ALL SELECT n + 1 FROM seq "
+                "WHERE n < :rows) "
+                "INSERT INTO urls (long_url, short_code, is_active) "
+                "SELECT 'https://example.com/' || n, 'seed' || n, 1 FROM seq"
+            ),
+            {"rows": rows},
+        )
+
+
+def create_legacy(conn, allocator):
+    while True:
+        code = allocator.allocate()
+        exists = conn.execute(
+            text("SELECT 1 FROM urls WHERE short_code = :code"), {"code": code}
+        ).first()
+        if not exists:
+            break
+    conn.execute(URL.__table__.insert().values(long_url="https://x.io", short_code=code))
+
+
+def create_feistel(conn, allocator):
+    while True:
+        code = allocator.allocate()
+        try:
+            with conn.begin_nested():
+                conn.execute(
+                    URL.__table__.insert().values(long_url="https://x.io", short_code=code)
+                )
+            return
+        except IntegrityError:
+            continue
+
+
+def measure(engine, create, allocator, samples: int) -> list[float]:
+    timings = []
+    with engine.connect() as conn:
+        for _ in range(samples):
+            start = time.perf_counter()
+            with conn.begin():
+                create(conn, allocator)
+            timings.append((time.perf_counter() - start) * 1e6)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--samples", type=int, default=2000)
+    args = parser.parse_args()
+
+    print(f"{'rows':>12} {'strategy':>8} {'p50 us':>10} {'p99 us':>10}")
+    for size in [int(s) for s in args.sizes.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+            Base.metadata.create_all(bind=engine)
+            seed(engine, size)
+            strategies = [
+                ("random", create_legacy, RandomCodeAllocator()),
+                ("feistel", create_feistel, FeistelCodeAllocator(b"bench", engine)),
+            ]
+            for name, create, allocator in strategies:
+                timings = measure(engine, create, allocator, args.samples)
+                p99 = statistics.quantiles(timings, n=100)[98]
+                print(
+                    f"{size:>12} {name:>8} "
+                    f"{statistics.median(timings):>10.1f} {p99:>10.1f}"
+                )
+            engine.dispose()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+"""Click ingestion throughput: commit-per-redirect versus the write-behind buffer.
+
+Drives many concurrent simulated redirects on one event loop. The baseline
+commits each click inline; the buffered runs record into a ClickBuffer whose
+background task drains it with the given batch sizes.
+
+Run from the project directory:
+    python -m benchmarks.bench_clicks --clicks 20000 --batch-sizes 1,10,100,1000
+"""
+import argparse
+import asyncio
+import os
+import tempfile
+import time
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+
+from clicks import ClickBuffer
+from models import Base, Click
+
+
+async def inline_commits(session_factory, clicks: int, concurrency: int):
+    async def worker(count):
+        for _ in range(count):
+            db = session_factory()
+            db.add(Click(url_id=1, ip_address="127.0.0.1", user_agent="bench"))
+            db.commit()
+            db.close()
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*(worker(clicks // concurrency) for _ in range(concurrency)))
+
+
+async def buffered(session_factory, clicks: int, concurrency: int, batch_size: int):
+    buffer = ClickBuffer(
+        max_size=clicks, batch_size=batch_size, session_factory=session_factory
+    )
+    await buffer.start()
+
+    async def worker(count):
+        for _ in range(count):
+            buffer.record(1, "127.0.0.1", "bench")
+            await asyncio.sleep(0)
+
+    await asyncio.gather(*(worker(clicks // concurrency) for _ in range(concurrency)))
+    await buffer.stop()
+
+
+def run(label, factory):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine = create_engine(f"sqlite:///{os.path.join(tmp, 'bench.db')}")
+        Base.metadata.create_all(bind=engine)
+        session_factory = sessionmaker(bind=engine)
+        start = time.perf_counter()
+        asyncio.run(factory(session_factory))
+        elapsed = time.perf_counter() - start
+        with session_factory() as db:
+            stored = db.query(Click).count()
+        engine.dispose()
+    print(f"{label:>16} {stored:>10} {stored / elapsed:>14.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clicks", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--batch-sizes", default="1,10,100,1000")
+    args = parser.parse_args()
+
+    print(f"{'mode':>16} {'stored':>10} {'clicks/s':>14}")
+    run(
+        "inline commit",
+        lambda f: inline_commits(f, args.clicks, args.concurrency),
+    )
+    for batch_size in [int(b) for b in args.batch_sizes.split(",")]:
+        run(
+            f"buffer batch={batch_size}",
+            lambda f: buffered(f, args.clicks, args.concurrency, batch_size),
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+"""Redirect latency while analytics queries run concurrently.
+
+Seeds a scratch database with one hot link and one link with many raw clicks,
+then drives the ASGI app in-process. Redirects are measured alone and again
+while clients request exact unique-visitor analytics, which scan raw clicks.
+With the async database layer those scans no longer stall the event loop.
+
+Run from the project directory:
+    python -m benchmarks.bench_concurrency --clicks 200000 --duration 5
+"""
+import argparse
+import asyncio
+import os
+import random
+import statistics
+import tempfile
+import time
+
+TMP = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TMP, 'bench.db')}"
+os.environ.setdefault("SECRET_KEY", "bench")
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from database import SessionLocal  # noqa: E402
+from models import URL, Click, User  # noqa: E402
+
+
+def seed(clicks: int) -> str:
+    db = SessionLocal()
+    user = User(username="bench", hashed_password="-", is_active=True)
+    db.add(user)
+    db.flush()
+    db.add(URL(long_url="https://example.com/hot", short_code="hot", owner_id=user.id))
+    report = URL(long_url="https://example.com/big", short_code="big", owner_id=user.id)
+    db.add(report)
+    db.flush()
+    rng = random.Random(1)
+    db.execute(
+        Click.__table__.insert(),
+        [
+            {
+                "url_id": report.id,
+                "ip_address": f"10.{rng.randrange(256)}.{rng.randrange(256)}.{i % 256}",
+                "user_agent": "bench",
+            }
+            for i in range(clicks)
+        ],
+    )
+    db.commit()
+    db.close()
+    return main.create_access_token({"sub": "bench"})
+
+
+async def redirect_loop(client, stop, latencies):
+    while time.perf_counter() < stop:
+        start = time.perf_counter()
+        await client.get("/hot")
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def analytics_loop(client, stop, token, counter):
+    headers = {"Authorization": f"Bearer {token}"}
+    while time.perf_counter() < stop:
+        await client.get("/analytics/big?exact_unique=true", headers=headers)
+        counter.append(1)
+
+
+async def phase(token, duration, redirect_clients, analytics_clients):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        stop = time.perf_counter() + duration
+        latencies, analytics = [], []
+        await asyncio.gather(
+            *(redirect_loop(client, stop, latencies) for _ in range(redirect_clients)),
+            *(
+                analytics_loop(client, stop, token, analytics)
+                for _ in range(analytics_clients)
+            ),
+        )
+    return latencies, len(analytics)
+
+
+def report(label, latencies, analytics):
+    cuts = statistics.quantiles(latencies, n=100)
+    print(
+        f"{label:>24} {len(latencies):>9} {cuts[49]:>8.2f} {cuts[94]:>8.2f} "
+        f"{cuts[98]:>8.2f} {analytics:>10}"
+    )
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--clicks", type=int, default=200_000)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--redirect-clients", type=int, default=20)
+    parser.add_argument("--analytics-clients", type=int, default=2)
+    args = parser.parse_args()
+
+    token = seed(args.clicks)
+    print(
+        f"{'phase':>24} {'redirects':>9} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'analytics':>10}"
+    )
+    report(
+        "redirects only",
+        *asyncio.run(phase(token, args.duration, args.redirect_clients, 0)),
+    )
+    report(
+        "redirects + analytics",
+        *asyncio.run(
+            phase(token, args.duration, args.redirect_clients, args.analytics_clients)
+        ),
+    )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,117 @@
+"""Redirect latency during a login storm.
+
+Seeds a scratch database with one hot link and one user, then drives the
+ASGI app in-process. Redirects are measured alone, while clients hammer
+/token with bcrypt verified in the hashing pool, and while the same logins
+verify inline on the event loop as they used to.
+
+Run from the project directory:
+    python -m benchmarks.bench_login_storm --duration 5 --login-clients 8
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+
+TMP = tempfile.mkdtemp()
+os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(TMP, 'bench.db')}"
+os.environ.setdefault("SECRET_KEY", "bench")
+
+import httpx  # noqa: E402
+
+import main  # noqa: E402
+from database import SessionLocal  # noqa: E402
+from models import URL, User  # noqa: E402
+
+
+class InlineHasher:
+    """The pre-pool behaviour: bcrypt on the event loop thread"""
+
+    def __init__(self, context):
+        self.context = context
+
+    async def hash(self, password):
+        return self.context.hash(password)
+
+    async def verify(self, password, hashed_password):
+        return self.context.verify(password, hashed_password)
+
+
+def seed():
+    db = SessionLocal()
+    user = User(
+        username="bench",
+        hashed_password=main.pwd_context.hash("secret"),
+        is_active=True,
+    )
+    db.add(user)
+    db.flush()
+    db.add(URL(long_url="https://example.com/hot", short_code="hot", owner_id=user.id))
+    db.commit()
+    db.close()
+
+
+async def redirect_loop(client, stop, latencies):
+    while time.perf_counter() < stop:
+        start = time.perf_counter()
+        await client.get("/hot")
+        latencies.append((time.perf_counter() - start) * 1000)
+
+
+async def login_loop(client, stop, statuses):
+    form = {"username": "bench", "password": "secret"}
+    while time.perf_counter() < stop:
+        response = await client.post("/token", data=form)
+        statuses.append(response.status_code)
+        if response.status_code == 503:
+            await asyncio.sleep(0.05)
+
+
+async def phase(duration, redirect_clients, login_clients):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        stop = time.perf_counter() + duration
+        latencies, statuses = [], []
+        await asyncio.gather(
+            *(redirect_loop(client, stop, latencies) for _ in range(redirect_clients)),
+            *(login_loop(client, stop, statuses) for _ in range(login_clients)),
+        )
+    return latencies, statuses
+
+
+def report(label, latencies, statuses):
+    cuts = statistics.quantiles(latencies, n=100)
+    print(
+        f"{label:>24} {len(latencies):>9} {cuts[49]:>8.2f} {cuts[94]:>8.2f} "
+        f"{cuts[98]:>8.2f} {statuses.count(200):>7} {statuses.count(503):>7}"
+    )
+
+
+def run():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--redirect-clients", type=int, default=20)
+    parser.add_argument("--login-clients", type=int, default=8)
+    args = parser.parse_args()
+
+    seed()
+    print(
+        f"{'phase':>24} {'redirects':>9} {'p50 ms':>8} {'p95 ms':>8} "
+        f"{'p99 ms':>8} {'logins':>7} {'503s':>7}"
+    )
+    report("redirects only", *asyncio.run(phase(args.duration, args.redirect_clients, 0)))
+    report(
+        "logins in hashing pool",
+        *asyncio.run(phase(args.duration, args.redirect_clients, args.login_clients)),
+    )
+    main.password_hasher = InlineHasher(main.pwd_context)
+    report(
+        "logins on event loop",
+        *asyncio.run(phase(args.duration, args.redirect_clients, args.login_clients)),
+    )
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,280 @@
+"""Load test for redirect, shorten and analytics at a target request rate.
+
+Seeds a database with users, links and clicks, then drives the ASGI app
+in-process with an open-loop asyncio client: requests are issued on a fixed
+schedule whether or not earlier ones have finished, and latency is measured
+from the scheduled send time so a stalled server cannot hide its backlog.
+Each scenario reports throughput and p50/p95/p99, and the run is written to
+a JSON file that a later run can be compared against.
+
+Run from the project directory:
+    python -m benchmarks.load_test --links 10000 --clicks 200000 --rps 300
+    python -m benchmarks.load_test --output after.json --compare before.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+SCENARIOS = ("redirect", "shorten", "analytics")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument(
+        "--database",
+        help="SQLite file to seed and test against (default: a scratch file)",
+    )
+    parser.add_argument("--users", type=int, default=10)
+    parser.add_argument("--links", type=int, default=10_000)
+    parser.add_argument("--clicks", type=int, default=100_000)
+    parser.add_argument(
+        "--rps", type=float, default=200.0, help="Target rate per scenario"
+    )
+    parser.add_argument(
+        "--duration", type=float, default=10.0, help="Seconds per scenario"
+    )
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument(
+        "--skew", type=float, default=1.1, help="Zipf exponent of link popularity"
+    )
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", default="load_test_results.json")
+    parser.add_argument("--compare", help="Earlier results file to diff against")
+    return parser.parse_args(argv)
+
+
+def seed(args, rng):
+    """Create users, links and clicks.
+
+    Returns the new codes, their popularity weights, a token for the first
+    user and the codes that user owns.
+    """
+    import main
+    from clicks import ingest_clicks
+    from database import SessionLocal
+    from models import IST, URL, User
+
+    db = SessionLocal()
+    # Reuse the load users of an earlier run on the same database
+    users = []
+    for i in range(args.users):
+        user = db.query(User).filter(User.username == f"load{i}").first()
+        if user is None:
+            user = User(username=f"load{i}", hashed_password="-", is_active=True)
+            db.add(user)
+        users.append(user)
+    # Commit first: the allocator leases codes on its own connection
+    db.commit()
+    allocator = main.get_allocator()
+    codes = allocator.allocate_many(args.links)
+    db.execute(
+        URL.__table__.insert(),
+        [
+            {
+                "long_url": f"https://example.com/{i}",
+                "short_code": code,
+                "owner_id": users[i % args.users].id,
+                "is_active": True,
+            }
+            for i, code in enumerate(codes)
+        ],
+    )
+    db.commit()
+    ids = dict(db.query(URL.short_code, URL.id).all())
+
+    # Clicks follow the same skewed popularity as the redirect workload and are
+    # spread over the last week
+    now = datetime.now(IST)
+    weights = [1 / (rank + 1) ** args.skew for rank in range(len(codes))]
+    batch_size = 10_000
+    for start in range(0, args.clicks, batch_size):
+        picks = rng.choices(codes, weights, k=min(batch_size, args.clicks - start))
+        ingest_clicks(
+            db,
+            [
+                {
+                    "url_id": ids[code],
+                    "timestamp": now - timedelta(seconds=rng.uniform(0, 7 * 86400)),
+                    "ip_address": f"10.0.{rng.randrange(256)}.{rng.randrange(256)}",
+                    "user_agent": rng.choice(("Chrome", "Firefox", "Safari", "curl")),
+                }
+                for code in picks
+            ],
+        )
+        db.commit()
+    db.close()
+
+    owned = codes[0 :: args.users]
+    return codes, weights, main.create_access_token({"sub": "load0"}), owned
+
+
+def percentiles(latencies):
+    if len(latencies) < 2:
+        value = latencies[0] if latencies else 0.0
+        return {"p50": value, "p95": value, "p99": value}
+    cuts = statistics.quantiles(latencies, n=100)
+    return {"p50": cuts[49], "p95": cuts[94], "p99": cuts[98]}
+
+
+async def drive(client, make_request, rps, duration):
+    """Issue requests on a fixed schedule and collect their latencies in ms"""
+    interval = 1 / rps
+    latencies, errors = [], 0
+    pending = set()
+    start = time.perf_counter()
+
+    async def one(scheduled, request):
+        nonlocal errors
+        try:
+            response = await request(client)
+            if response.status_code >= 400:
+                errors += 1
+        except Exception:
+            errors += 1
+        latencies.append((time.perf_counter() - scheduled) * 1000)
+
+    sent = 0
+    while True:
+        scheduled = start + sent * interval
+        if scheduled - start >= duration:
+            break
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        task = asyncio.create_task(one(scheduled, make_request()))
+        pending.add(task)
+        task.add_done_callback(pending.discard)
+        sent += 1
+    await asyncio.gather(*pending)
+    elapsed = time.perf_counter() - start
+    return {
+        "requests": sent,
+        "errors": errors,
+        "throughput": round(sent / elapsed, 2),
+        **{key: round(value, 3) for key, value in percentiles(latencies).items()},
+        "max": round(max(latencies, default=0.0), 3),
+    }
+
+
+def request_factories(rng, codes, weights, token, owned):
+    headers = {"Authorization": f"Bearer {token}"}
+
+    def redirect():
+        code = rng.choices(codes, weights)[0]
+        return lambda client: client.get(f"/{code}")
+
+    def shorten():
+        body = {
+            "long_url": f"https://example.com/new/{rng.randrange(10**9)}",
+            "include_qr": False,
+        }
+        return lambda client: client.post("/shorten", json=body, headers=headers)
+
+    def analytics():
+        code = rng.choice(owned)
+        return lambda client: client.get(f"/analytics/{code}", headers=headers)
+
+    return {"redirect": redirect, "shorten": shorten, "analytics": analytics}
+
+
+async def run_scenarios(args, factories):
+    import httpx
+
+    import main
+
+    results = {}
+    async with main.lifespan(main.app):
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(
+            transport=transport, base_url="http://load", follow_redirects=False
+        ) as client:
+            for name in args.scenarios.split(","):
+                results[name] = await drive(
+                    client, factories[name], args.rps, args.duration
+                )
+                print_row(name, results[name])
+    return results
+
+
+def print_row(name, result):
+    print(
+        f"{name:>10} {result['requests']:>8} {result['errors']:>6} "
+        f"{result['throughput']:>9.1f} {result['p50']:>8.2f} {result['p95']:>8.2f} "
+        f"{result['p99']:>8.2f}"
+    )
+
+
+def git_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(previous, current):
+    print(f"\nChange against {previous.get('commit') or 'previous run'}:")
+    for name, result in current["results"].items():
+        before = previous.get("results", {}).get(name)
+        if before is None:
+            continue
+        deltas = []
+        for key in ("throughput", "p50", "p95", "p99"):
+            if before[key]:
+                deltas.append(f"{key} {100 * (result[key] / before[key] - 1):+.1f}%")
+        print(f"{name:>10} " + ", ".join(deltas))
+
+
+def run(argv=None):
+    args = parse_args(argv)
+    database = args.database or os.path.join(tempfile.mkdtemp(), "load.db")
+    # Must be set before anything imports the database module
+    os.environ["DATABASE_URL"] = f"sqlite:///{database}"
+    os.environ.setdefault("SECRET_KEY", "load-test")
+    # Every request comes from one client, which the rate limiter would throttle
+    os.environ.setdefault("RATE_LIMIT_ENABLED", "false")
+
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    codes, weights, token, owned = seed(args, rng)
+    print(
+        f"Seeded {args.users} users, {len(codes)} links and {args.clicks} clicks "
+        f"in {time.perf_counter() - start:.1f}s into {database}"
+    )
+
+    factories = request_factories(rng, codes, weights, token, owned)
+    print(
+        f"{'scenario':>10} {'requests':>8} {'errors':>6} {'req/s':>9} "
+        f"{'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}"
+    )
+    results = asyncio.run(run_scenarios(args, factories))
+
+    report = {
+        "commit": git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "config": {key: value for key, value in vars(args).items() if key != "compare"},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), report)
+    return report
+
+
+if __name__ == "__main__":
+    run()
@@ -0,0 +1,181 @@
+# Bloom filter guard for unknown short codes
+import hashlib
+import math
+import threading
+import time
+from functools import partial
+
+from models import URL
+
+
+class BloomFilter:
+    """Fixed-size Bloom filter over strings using double hashing"""
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.num_bits = max(
+            8, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        )
+        self.num_hashes = max(1, round(self.num_bits / self.capacity * math.log(2)))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.bits_set = 0
+        self.count = 0
+
+    def _positions(self, item: str):
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:], "little") | 1
+        for i in range(self.num_hashes):
+            yield (h1 + i * h2) % self.num_bits
+
+    def add(self, item: str):
+        for position in self._positions(item):
+            byte, mask = position >> 3, 1 << (position & 7)
+            if not self.bits[byte] & mask:
+                self.bits[byte] |= mask
+                self.bits_set += 1
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        bits = self.bits
+        return all(
+            bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item)
+        )
+
+    @property
+    def fill_ratio(self) -> float:
+        return self.bits_set / self.num_bits
+
+    @property
+    def false_positive_rate(self) -> float:
+        """Current false-positive probability, from the fraction of bits set"""
+        return self.fill_ratio**self.num_hashes
+
+    def stats(self) -> dict:
+        return {
+            "items": self.count,
+            "capacity": self.capacity,
+            "size_bytes": len(self.bits),
+            "num_bits": self.num_bits,
+            "num_hashes": self.num_hashes,
+            "fill_ratio": round(self.fill_ratio, 6),
+            "false_positive_rate": self.false_positive_rate,
+            "target_error_rate": self.error_rate,
+        }
+
+
+class ShortCodeFilter:
+    """Bloom filter of every short code in ``urls``, kept in sync with the table.
+
+    Until ``load`` has run the filter lets everything through. Codes created
+    by other workers are picked up by an incremental sync on ids greater than
+    the last one seen; a rejected lookup triggers such a sync at most once per
+    ``sync_interval`` seconds. Ids do not become visible in id order (a
+    transaction may commit after a higher id was synced, and slot moves copy
+    links with their old ids), so if the code is still rejected after the sync
+    it is looked up by short code before the 404 is final. When the table
+    outgrows the filter it is rebuilt at twice the size.
+
+    With several shards, ``load`` and ``sync`` take one session per shard in
+    shard order. New ids on shard i are i modulo ``id_stride``, so the sync
+    follows only those and ignores links moved in from other shards, whose
+    codes are already in the filter.
+    """
+
+    def __init__(
+        self,
+        capacity: int = 1_000_000,
+        error_rate: float = 0.01,
+        sync_interval=1.0,
+        id_stride: int = 1,
+    ):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.sync_interval = sync_interval
+        self.id_stride = id_stride
+        self.bloom: BloomFilter | None = None
+        self.last_ids: list[int] = []
+        self.last_sync = 0.0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> bool:
+        return self.bloom is not None
+
+    def load(self, *dbs):
+        """Build the filter from scratch from the urls table of every shard"""
+        total = sum(db.query(URL).count() for db in dbs)
+        bloom = BloomFilter(max(self.capacity, total * 2), self.error_rate)
+        last_ids = []
+        for shard, db in enumerate(dbs):
+            last_id = 0
+            rows = db.query(URL.id, URL.short_code).yield_per(10_000)
+            for url_id, short_code in rows:
+                bloom.add(short_code)
+                if self.id_stride == 1 or url_id % self.id_stride == shard:
+                    last_id = max(last_id, url_id)
+            last_ids.append(last_id)
+        with self._lock:
+            self.bloom = bloom
+            self.last_ids = last_ids
+            self.last_sync = time.monotonic()
+
+    def sync(self, *dbs):
+        """Add codes inserted since the last load or sync"""
+        self.last_sync = time.monotonic()
+        for shard, db in enumerate(dbs):
+            query = db.query(URL.id, URL.short_code).filter(
+                URL.id > self.last_ids[shard]
+            )
+            if self.id_stride > 1:
+                query = query.filter(URL.id % self.id_stride == shard)
+            for url_id, short_code in query.order_by(URL.id).all():
+                self.add(short_code)
+                self.last_ids[shard] = max(self.last_ids[shard], url_id)
+        if self.bloom.count > self.bloom.capacity:
+            self.load(*dbs)
+
+    def sync_and_find(self, *dbs, short_code: str) -> bool:
+        """Sync, then look up a code the filter still rejects; True if it exists"""
+        self.sync(*dbs)
+        if self.might_contain(short_code):
+            return True
+        for db in dbs:
+            if db.query(URL.id).filter(URL.short_code == short_code).first():
+                self.add(short_code)
+                return True
+        return False
+
+    def add(self, short_code: str):
+        if self.bloom is not None:
+            with self._lock:
+                self.bloom.add(short_code)
+
+    def might_contain(self, short_code: str) -> bool:
+        """False only if the code did not exist as of the last sync"""
+        return self.bloom is None or short_code in self.bloom
+
+    @property
+    def sync_due(self) -> bool:
+        return time.monotonic() - self.last_sync >= self.sync_interval
+
+    async def check(self, short_code: str, db) -> bool:
+        """False only if the code certainly does not exist.
+
+        db is an AsyncSession or a ShardRouter; either runs the sync for us.
+        """
+        if self.might_contain(short_code):
+            return True
+        if self.sync_due:
+            if await db.run_sync(partial(self.sync_and_find, short_code=short_code)):
+                return True
+        self.rejected += 1
+        return False
+
+    def stats(self) -> dict:
+        if self.bloom is None:
+            return {"ready": False}
+        return {"ready": True, "rejected": self.rejected, **self.bloom.stats()}
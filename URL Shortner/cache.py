@@ -1,3 +1,363 @@
-from aiocache import Cache
+import asyncio
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from typing import NamedTuple
 
-cache = Cache(Cache.MEMORY)
+from models import IST
+
+# How long a link stays cached when nothing shortens its lifetime
+REDIRECT_CACHE_TTL = float(os.getenv("REDIRECT_CACHE_TTL", "3600"))
+# Unknown and expired codes are remembered briefly so repeated misses skip the DB
+NEGATIVE_CACHE_TTL = float(os.getenv("NEGATIVE_CACHE_TTL", "30"))
+# Entries held by each worker's in-process tier
+REDIRECT_CACHE_SIZE = int(os.getenv("REDIRECT_CACHE_SIZE", "100000"))
+# Optional shared tier; unset keeps the cache per worker
+REDIS_URL = os.getenv("REDIS_URL")
+
+# Cached in place of a record for codes that do not exist
+NOT_FOUND = "__not_found__"
+
+# Channel on which workers announce codes whose cached entry changed
+INVALIDATION_CHANNEL = "shortener:invalidate"
+# Namespace of cache entries in the shared tier, which other features also use
+KEY_PREFIX = "shortener:url:"
+
+
+class CachedURL(NamedTuple):
+    """Everything the redirect needs to know about a link"""
+
+    long_url: str
+    url_id: int
+    is_active: bool
+    expires_at: float | None  # Unix timestamp
+
+    @property
+    def status(self):
+        return self.status_at(time.time())
+
+    def status_at(self, now: float):
+        # Expiry wins so links deactivated by the expiry scheduler still read as expired
+        if self.expires_at is not None and self.expires_at < now:
+            return "expired"
+        if not self.is_active:
+            return "inactive"
+        return "active"
+
+
+class LRUCache:
+    """Size-bounded in-process cache with a TTL per entry"""
+
+    def __init__(self, max_size: int = 100_000):
+        self.max_size = max_size
+        self._entries: OrderedDict[str, tuple[object, float]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key: str, now: float | None = None):
+        now = time.time() if now is None else now
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[1] <= now:
+                if entry is not None:
+                    del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def set(self, key: str, value, ttl: float, now: float | None = None):
+        now = time.time() if now is None else now
+        with self._lock:
+            self._entries[key] = (value, now + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+def encode(value) -> str:
+    """Serialise a cache value for the shared tier"""
+    if value == NOT_FOUND:
+        return json.dumps(NOT_FOUND)
+    return json.dumps(list(value))
+
+
+def decode(payload):
+    if isinstance(payload, bytes):
+        payload = payload.decode()
+    value = json.loads(payload)
+    if value == NOT_FOUND:
+        return NOT_FOUND
+    return CachedURL(*value)
+
+
+class TwoTierCache:
+    """Per-worker LRU in front of an optional shared Redis tier.
+
+    Reads try L1, then L2, filling L1 from L2 for the rest of the entry's
+    lifetime. Writes go to both tiers. Whenever a code's entry changes, its
+    code is published on ``INVALIDATION_CHANNEL``; every other worker drops it
+    from its L1 so the next read goes to L2 or the database. Errors talking
+    to L2 are counted and the cache falls back to L1 alone. L2 keys carry
+    ``prefix`` so ``clear`` can remove them without touching anything else
+    stored in the same Redis database.
+    """
+
+    def __init__(
+        self,
+        l1: LRUCache,
+        l2=None,
+        channel: str = INVALIDATION_CHANNEL,
+        prefix: str = KEY_PREFIX,
+    ):
+        self.l1 = l1
+        self.l2 = l2
+        self.channel = channel
+        self.prefix = prefix
+        self.origin = uuid.uuid4().hex
+        self._pubsub = None
+        self._task: asyncio.Task | None = None
+        self.l2_hits = 0
+        self.l2_misses = 0
+        self.l2_errors = 0
+        self.invalidations_sent = 0
+        self.invalidations_received = 0
+
+    def _l2_failed(self, e: Exception):
+        self.l2_errors += 1
+        print(f"Error talking to shared cache: {e}")
+
+    async def get(self, key: str):
+        value = self.l1.get(key)
+        if value is not None or self.l2 is None:
+            return value
+        try:
+            payload = await self.l2.get(self.prefix + key)
+        except Exception as e:
+            self._l2_failed(e)
+            return None
+        if payload is None:
+            self.l2_misses += 1
+            return None
+        self.l2_hits += 1
+        expires_at, value = json.loads(payload)
+        ttl = expires_at - time.time()
+        if ttl <= 0:
+            return None
+        value = decode(value)
+        self.l1.set(key, value, ttl)
+        return value
+
+    async def set(self, key: str, value, ttl: float):
+        await self.multi_set([(key, value)], ttl)
+
+    async def multi_set(self, pairs, ttl: float):
+        now = time.time()
+        for key, value in pairs:
+            self.l1.set(key, value, ttl, now)
+        if self.l2 is None:
+            return
+        try:
+            pipe = self.l2.pipeline()
+            for key, value in pairs:
+                payload = json.dumps([now + ttl, encode(value)])
+                pipe.set(self.prefix + key, payload, px=int(ttl * 1000))
+            await pipe.execute()
+        except Exception as e:
+            self._l2_failed(e)
+
+    async def delete(self, *keys: str):
+        for key in keys:
+            self.l1.delete(key)
+        if self.l2 is not None and keys:
+            try:
+                await self.l2.delete(*(self.prefix + key for key in keys))
+            except Exception as e:
+                self._l2_failed(e)
+
+    async def announce(self, *keys: str):
+        """Tell the other workers to drop these codes from their L1"""
+        if self.l2 is None or not keys:
+            return
+        message = json.dumps({"origin": self.origin, "codes": list(keys)})
+        try:
+            await self.l2.publish(self.channel, message)
+            self.invalidations_sent += 1
+        except Exception as e:
+            self._l2_failed(e)
+
+    async def clear(self, batch_size: int = 500):
+        """Drop every entry, in L2 only the keys under this cache's prefix"""
+        self.l1.clear()
+        if self.l2 is None:
+            return
+        batch = []
+        async for key in self.l2.scan_iter(match=f"{self.prefix}*", count=batch_size):
+            batch.append(key)
+            if len(batch) >= batch_size:
+                await self.l2.delete(*batch)
+                batch = []
+        if batch:
+            await self.l2.delete(*batch)
+
+    def handle_message(self, message):
+        data = message["data"]
+        if isinstance(data, bytes):
+            data = data.decode()
+        payload = json.loads(data)
+        if payload["origin"] == self.origin:
+            return
+        self.invalidations_received += 1
+        for key in payload["codes"]:
+            self.l1.delete(key)
+
+    async def _listen(self):
+        while True:
+            try:
+                message = await self._pubsub.get_message(
+                    ignore_subscribe_messages=True, timeout=1.0
+                )
+                if message is not None and message["type"] == "message":
+                    self.handle_message(message)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                self._l2_failed(e)
+                await asyncio.sleep(1)
+
+    async def start(self):
+        """Subscribe to invalidations from other workers"""
+        if self.l2 is None or self._task is not None:
+            return
+        self._pubsub = self.l2.pubsub()
+        await self._pubsub.subscribe(self.channel)
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+            await self._pubsub.aclose()
+            self._pubsub = None
+
+    def stats(self) -> dict:
+        return {
+            "l1": self.l1.stats(),
+            "l2": {
+                "enabled": self.l2 is not None,
+                "hits": self.l2_hits,
+                "misses": self.l2_misses,
+                "errors": self.l2_errors,
+            },
+            "invalidations_sent": self.invalidations_sent,
+            "invalidations_received": self.invalidations_received,
+        }
+
+
+def shared_backend(url: str | None):
+    """Redis client for REDIS_URL, or None to keep the cache per worker"""
+    if not url:
+        return None
+    import redis.asyncio
+
+    return redis.asyncio.from_url(url)
+
+
+cache = TwoTierCache(LRUCache(REDIRECT_CACHE_SIZE), shared_backend(REDIS_URL))
+
+
+def to_timestamp(value) -> float | None:
+    """Naive datetimes are stored as IST wall-clock time, like URL.status assumes"""
+    if value is None:
+        return None
+    if value.tzinfo is None:
+        value = IST.localize(value)
+    return value.timestamp()
+
+
+def record_for(db_url) -> CachedURL:
+    return CachedURL(
+        long_url=db_url.long_url,
+        url_id=db_url.id,
+        is_active=bool(db_url.is_active),
+        expires_at=to_timestamp(db_url.expires_at),
+    )
+
+
+def ttl_for(record: CachedURL, now: float | None = None) -> float:
+    """Cache lifetime of a record, never outliving the link's own expiry"""
+    now = time.time() if now is None else now
+    if record.status_at(now) != "active":
+        return NEGATIVE_CACHE_TTL
+    if record.expires_at is None:
+        return REDIRECT_CACHE_TTL
+    return max(0.001, min(REDIRECT_CACHE_TTL, record.expires_at - now))
+
+
+async def get_cached_url(short_code: str) -> CachedURL | str | None:
+    """Return the cached record, NOT_FOUND for a negative entry, or None on a miss"""
+    return await cache.get(short_code)
+
+
+async def cache_url(db_url, announce: bool = False) -> CachedURL:
+    """Cache a link; announce when it is new or changed so other workers re-read it"""
+    record = record_for(db_url)
+    await cache.set(db_url.short_code, record, ttl=ttl_for(record))
+    if announce:
+        await cache.announce(db_url.short_code)
+    return record
+
+
+async def cache_records(records: dict[str, CachedURL]):
+    """Cache many records at once; links without an expiry share one multi_set"""
+    now = time.time()
+    uniform = []
+    for short_code, record in records.items():
+        ttl = ttl_for(record, now)
+        if ttl == REDIRECT_CACHE_TTL:
+            uniform.append((short_code, record))
+        else:
+            await cache.set(short_code, record, ttl=ttl)
+    if uniform:
+        await cache.multi_set(uniform, ttl=REDIRECT_CACHE_TTL)
+    await cache.announce(*records)
+
+
+async def cache_missing(short_code: str):
+    await cache.set(short_code, NOT_FOUND, ttl=NEGATIVE_CACHE_TTL)
+
+
+async def invalidate(*short_codes: str):
+    await cache.delete(*short_codes)
+    await cache.announce(*short_codes)
@@ -0,0 +1,298 @@
+# Write-behind click ingestion
+import argparse
+import asyncio
+import threading
+from collections import deque
+
+from sqlalchemy import insert, select
+from sqlalchemy.exc import DisconnectionError, InterfaceError, OperationalError
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+
+from database import SessionLocal
+from models import URL, Click, now_ist
+from rollups import clear_rollups, update_rollups
+from hll import clear_sketches, update_sketches
+from heavy_hitters import clear_heavy_hitters, update_heavy_hitters
+from retention import CLICK_ARCHIVE_DIR, iter_archived_clicks
+
+
+def is_outage(error: Exception) -> bool:
+    """Errors of the database rather than of the rows; retrying can fix them"""
+    if isinstance(error, (OperationalError, InterfaceError)):
+        return True
+    if isinstance(error, (DisconnectionError, PoolTimeoutError)):
+        return True
+    return bool(getattr(error, "connection_invalidated", False))
+
+
+def update_aggregates(db, rows: list[dict]):
+    """Fold click rows into every structure derived from raw clicks"""
+    update_rollups(db, rows)
+    update_sketches(db, rows)
+    update_heavy_hitters(db, rows)
+
+
+def ingest_clicks(db, rows: list[dict]):
+    """Persist a batch of click rows; every click write goes through here"""
+    db.execute(insert(Click), rows)
+    update_aggregates(db, rows)
+
+
+def rebuild_aggregates(
+    db,
+    url_ids: list[int] | None = None,
+    batch_size: int = 10_000,
+    archive_dir: str = CLICK_ARCHIVE_DIR,
+) -> int:
+    """Regenerate rollups and sketches from archived and raw clicks; returns clicks read"""
+    clear_rollups(db, url_ids)
+    clear_sketches(db, url_ids)
+    clear_heavy_hitters(db, url_ids)
+
+    processed = 0
+    # Clicks moved out by the retention job still count towards history; the
+    # archive is shared by all shards, so only this database's links are taken
+    for batch in iter_archived_clicks(archive_dir, url_ids, batch_size):
+        ids = {row["url_id"] for row in batch}
+        local = set(db.execute(select(URL.id).where(URL.id.in_(ids))).scalars())
+        batch = [row for row in batch if row["url_id"] in local]
+        if batch:
+            update_aggregates(db, batch)
+            processed += len(batch)
+
+    query = db.query(
+        Click.url_id, Click.timestamp, Click.ip_address, Click.user_agent
+    ).order_by(Click.url_id)
+    if url_ids is not None:
+        query = query.filter(Click.url_id.in_(url_ids))
+
+    batch = []
+    for row in query.yield_per(batch_size):
+        batch.append(row._asdict())
+        if len(batch) >= batch_size:
+            update_aggregates(db, batch)
+            processed += len(batch)
+            batch = []
+    update_aggregates(db, batch)
+    processed += len(batch)
+    db.commit()
+    return processed
+
+
+class ClickBuffer:
+    """Bounded in-process queue of clicks drained to the database in batches.
+
+    Redirects call ``record`` and return immediately. A background task wakes
+    up every ``flush_interval`` seconds, or as soon as ``batch_size`` clicks are
+    waiting, and bulk-inserts them in one transaction per batch. When
+    ``max_size`` clicks are already pending new clicks are dropped and
+    counted instead of growing memory without bound. With a shard router
+    each click is written to the shard given when it was recorded.
+
+    A batch that fails because the database is unavailable is requeued as
+    is, and the background task backs off up to ``max_backoff`` seconds
+    between flushes until one succeeds; memory stays capped by ``max_size``.
+    A batch rejected for its data is requeued too, but once its clicks have
+    failed ``max_retries`` times they are written one by one, and any click
+    that is still rejected is logged and dropped, so one bad row cannot hold
+    back the rest of the buffer.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 100_000,
+        batch_size: int = 500,
+        flush_interval: float = 1.0,
+        session_factory=SessionLocal,
+        router=None,
+        max_retries: int = 3,
+        max_backoff: float = 30.0,
+    ):
+        self.max_size = max_size
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.session_factory = session_factory
+        self.router = router
+        # (shard index, click row, failed attempts)
+        self._pending: deque[tuple[int, dict, int]] = deque()
+        self._flush_lock = threading.Lock()
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self.recorded = 0
+        self.dropped = 0
+        self.flushed = 0
+        self.batches = 0
+        self.failures = 0
+        self.dead_lettered = 0
+        # Flushes in a row that found the database unavailable
+        self.outages = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(
+        self, url_id: int, ip_address: str, user_agent: str, shard: int = 0
+    ) -> bool:
+        """Queue a click; returns False if the buffer is full and it was dropped"""
+        if len(self._pending) >= self.max_size:
+            self.dropped += 1
+            return False
+        self._pending.append(
+            (
+                shard,
+                {
+                    "url_id": url_id,
+                    "timestamp": now_ist(),
+                    "ip_address": ip_address,
+                    "user_agent": user_agent,
+                },
+                0,
+            )
+        )
+        self.recorded += 1
+        if (
+            self._wakeup is not None
+            and len(self._pending) >= self.batch_size
+            and not self._wakeup.is_set()
+        ):
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+        return True
+
+    def _session(self, shard: int):
+        if self.router is None:
+            return self.session_factory()
+        return self.router.shards[shard].session()
+
+    def _write(self, shard: int, rows: list[dict]) -> Exception | None:
+        """Ingest rows in one transaction; returns the error if it failed"""
+        db = self._session(shard)
+        try:
+            ingest_clicks(db, rows)
+            db.commit()
+            self.batches += 1
+            return None
+        except Exception as e:
+            db.rollback()
+            self.failures += 1
+            return e
+        finally:
+            db.close()
+
+    def flush(self) -> int:
+        """Write all pending clicks to the database and return how many were written"""
+        written = 0
+        with self._flush_lock:
+            while self._pending:
+                size = min(self.batch_size, len(self._pending))
+                batch = [self._pending.popleft() for _ in range(size)]
+                by_shard: dict[int, list[tuple[dict, int]]] = {}
+                for shard, row, attempts in batch:
+                    by_shard.setdefault(shard, []).append((row, attempts))
+                done, failed, outage = 0, [], False
+                for shard, entries in by_shard.items():
+                    error = self._write(shard, [row for row, _ in entries])
+                    if error is None:
+                        done += len(entries)
+                        continue
+                    print(f"Error flushing clicks: {error}")
+                    if is_outage(error):
+                        outage = True
+                        failed.extend((shard, row, tries) for row, tries in entries)
+                        continue
+                    for row, attempts in entries:
+                        if attempts + 1 < self.max_retries:
+                            failed.append((shard, row, attempts + 1))
+                            continue
+                        error = self._write(shard, [row])
+                        if error is None:
+                            done += 1
+                        elif is_outage(error):
+                            outage = True
+                            failed.append((shard, row, attempts))
+                        else:
+                            self.dead_lettered += 1
+                            print(f"Dropping click rejected {attempts + 1}x: {row}")
+                self.outages = self.outages + 1 if outage else 0
+                written += done
+                self.flushed += done
+                if failed:
+                    # Put the failed clicks back in order so the next flush retries them
+                    self._pending.extendleft(reversed(failed))
+                    break
+        return written
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            if self._pending:
+                await asyncio.to_thread(self.flush)
+                if self.outages:
+                    await asyncio.sleep(self.retry_delay())
+
+    def retry_delay(self) -> float:
+        """Extra wait after a flush that found the database unavailable"""
+        if not self.outages:
+            return 0.0
+        return min(self.flush_interval * 2 ** (self.outages - 1), self.max_backoff)
+
+    async def start(self):
+        """Start draining in the background on the running event loop"""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Stop the background task and flush whatever is still pending"""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._wakeup = None
+        self._loop = None
+        await asyncio.to_thread(self.flush)
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self._pending),
+            "max_size": self.max_size,
+            "recorded": self.recorded,
+            "dropped": self.dropped,
+            "flushed": self.flushed,
+            "batches": self.batches,
+            "failures": self.failures,
+            "dead_lettered": self.dead_lettered,
+            "outages": self.outages,
+        }
+
+
+if __name__ == "__main__":
+    from sharding import router
+
+    parser = argparse.ArgumentParser(
+        description="Rebuild click rollups and sketches from archived and raw clicks"
+    )
+    parser.add_argument("--url-id", type=int, help="Only rebuild this link")
+    args = parser.parse_args()
+
+    router.prepare()
+    count = 0
+    for shard in router.shards:
+        db = shard.session()
+        try:
+            url_ids = [args.url_id] if args.url_id is not None else None
+            count += rebuild_aggregates(db, url_ids)
+        finally:
+            db.close()
+    print(f"Rebuilt click aggregates from {count} clicks")
@@ -1,9 +1,180 @@
 # DB connection
-from sqlalchemy import create_engine
+import os
+
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
 
-DATABASE_URL = "sqlite:///./urls.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./urls.db")
+DB_PROFILE = os.getenv("DB_PROFILE", "development")
+
+# Async drivers used by the API for each database backend
+ASYNC_DRIVERS = {"sqlite": "aiosqlite", "postgresql": "asyncpg"}
+# Sync drivers for URLs that name none (SQLAlchemy would pick psycopg2)
+SYNC_DRIVERS = {"postgresql": "psycopg"}
+
+# Tuning profiles; any value can be overridden by the matching environment variable
+PROFILES = {
+    "development": {
+        "sqlite_pragmas": {"busy_timeout": 5000},
+        "pool": {},
+        "statement_cache_size": None,
+    },
+    "production": {
+        "sqlite_pragmas": {
+            "journal_mode": "WAL",
+            "synchronous": "NORMAL",
+            "mmap_size": 268_435_456,  # 256 MiB
+            "cache_size": -65_536,  # 64 MiB
+            "busy_timeout": 5000,
+            "temp_store": "MEMORY",
+        },
+        "pool": {
+            "pool_size": 20,
+            "max_overflow": 10,
+            "pool_pre_ping": True,
+            "pool_recycle": 1800,
+        },
+        "statement_cache_size": 1024,
+    },
+}
+
+POOL_ENV = {
+    "pool_size": ("DB_POOL_SIZE", int),
+    "max_overflow": ("DB_MAX_OVERFLOW", int),
+    "pool_pre_ping": ("DB_POOL_PRE_PING", lambda value: value.lower() == "true"),
+    "pool_recycle": ("DB_POOL_RECYCLE", int),
+}
+SQLITE_PRAGMAS = [
+    "journal_mode",
+    "synchronous",
+    "mmap_size",
+    "cache_size",
+    "busy_timeout",
+    "temp_store",
+]
+
+
+def load_settings(profile: str = DB_PROFILE, environ=os.environ) -> dict:
+    """Profile defaults with SQLITE_*, DB_POOL_* and DB_STATEMENT_CACHE_SIZE overrides"""
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE: {profile}")
+    base = PROFILES[profile]
+    pragmas = dict(base["sqlite_pragmas"])
+    for name in SQLITE_PRAGMAS:
+        value = environ.get(f"SQLITE_{name.upper()}")
+        if value is not None:
+            pragmas[name] = value
+    pool = dict(base["pool"])
+    for name, (variable, parse) in POOL_ENV.items():
+        value = environ.get(variable)
+        if value is not None:
+            pool[name] = parse(value)
+    statement_cache_size = base["statement_cache_size"]
+    if environ.get("DB_STATEMENT_CACHE_SIZE") is not None:
+        statement_cache_size = int(environ["DB_STATEMENT_CACHE_SIZE"])
+    return {
+        "profile": profile,
+        "sqlite_pragmas": pragmas,
+        "pool": pool,
+        "statement_cache_size": statement_cache_size,
+    }
+
+
+def async_url(url: str) -> str:
+    """Swap the driver of a database URL for its asyncio counterpart"""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No async driver configured for {backend}")
+    return parsed.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}").render_as_string(
+        hide_password=False
+    )
+
+
+def sync_url(url: str) -> str:
+    """Pin the sync driver of a URL without one to the one in requirements.txt"""
+    parsed = make_url(url)
+    backend = parsed.get_backend_name()
+    if parsed.drivername != backend or backend not in SYNC_DRIVERS:
+        return url
+    return parsed.set(drivername=f"{backend}+{SYNC_DRIVERS[backend]}").render_as_string(
+        hide_password=False
+    )
+
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+def apply_pragmas(target_engine, pragmas: dict):
+    """Run the PRAGMA statements on every new SQLite connection"""
+
+    @event.listens_for(target_engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+
+
+def create_engines(url: str, settings: dict):
+    """Build the sync and async engines for a URL with the given settings"""
+    backend = make_url(url).get_backend_name()
+    sync_options, async_options = {}, {}
+    if settings["statement_cache_size"] is not None:
+        sync_options["query_cache_size"] = settings["statement_cache_size"]
+        async_options["query_cache_size"] = settings["statement_cache_size"]
+
+    if backend == "sqlite":
+        sync_options["connect_args"] = {"check_same_thread": False}
+    else:
+        sync_options.update(settings["pool"])
+        async_options.update(settings["pool"])
+        if backend == "postgresql" and settings["statement_cache_size"] is not None:
+            async_options["connect_args"] = {
+                "prepared_statement_cache_size": settings["statement_cache_size"]
+            }
+
+    sync_engine = create_engine(sync_url(url), **sync_options)
+    aio_engine = create_async_engine(async_url(url), **async_options)
+    if backend == "sqlite" and settings["sqlite_pragmas"]:
+        apply_pragmas(sync_engine, settings["sqlite_pragmas"])
+        apply_pragmas(aio_engine.sync_engine, settings["sqlite_pragmas"])
+    return sync_engine, aio_engine
+
+
+settings = load_settings()
+
+# Synchronous engine for scripts, tests and background threads;
+# async engine used by every request handler
+engine, async_engine = create_engines(DATABASE_URL, settings)
 SessionLocal = sessionmaker(bind=engine, autoflush=False, autocommit=False)
+AsyncSessionLocal = async_sessionmaker(
+    bind=async_engine, autoflush=False, expire_on_commit=False
+)
+
 Base = declarative_base()
+
+
+async def effective_settings() -> dict:
+    """Settings as observed on a live connection of the async engine"""
+    url = make_url(DATABASE_URL)
+    report = {
+        "profile": settings["profile"],
+        "url": url.render_as_string(hide_password=True),
+        "statement_cache_size": settings["statement_cache_size"],
+    }
+    if url.get_backend_name() == "sqlite":
+        async with async_engine.connect() as conn:
+            report["sqlite_pragmas"] = {
+                name: (await conn.exec_driver_sql(f"PRAGMA {name}")).scalar()
+                for name in SQLITE_PRAGMAS
+            }
+    else:
+        pool = async_engine.pool
+        report["pool"] = {
+            "class": type(pool).__name__,
+            "size": pool.size() if hasattr(pool, "size") else None,
+            "max_overflow": getattr(pool, "_max_overflow", None),
+            "pre_ping": pool._pre_ping,
+            "recycle": pool._recycle,
+        }
+    return report
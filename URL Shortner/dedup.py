@@ -0,0 +1,112 @@
+# Long-URL deduplication per owner
+import argparse
+import hashlib
+from urllib.parse import urlsplit, urlunsplit
+
+from sqlalchemy import select, update
+
+from models import URL
+
+DEFAULT_PORTS = {"http": 80, "https": 443}
+
+
+def normalize_url(long_url: str) -> str:
+    """One spelling per URL: lowercase scheme and host, no default port.
+
+    Path, query and fragment are kept as given, since servers may treat them
+    case- and order-sensitively.
+    """
+    parts = urlsplit(long_url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+    if ":" in host:
+        host = f"[{host}]"  # IPv6 literal
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += f":{parts.password}"
+        netloc = f"{userinfo}@{netloc}"
+    if port is not None and port != DEFAULT_PORTS.get(scheme):
+        netloc += f":{port}"
+    path = parts.path or ("/" if netloc else "")
+    return urlunsplit((scheme, netloc, path, parts.query, parts.fragment))
+
+
+def url_hash(long_url: str) -> bytes:
+    """16-byte digest of the normalized URL, the indexed dedup key"""
+    return hashlib.blake2b(normalize_url(long_url).encode(), digest_size=16).digest()
+
+
+def duplicate_query(owner_id: int, long_url: str):
+    """Candidates are found through the (owner_id, long_url_hash) index"""
+    return (
+        select(URL)
+        .where(
+            URL.owner_id == owner_id,
+            URL.long_url_hash == url_hash(long_url),
+            URL.is_active.is_(True),
+            URL.expires_at.is_(None),
+        )
+        .order_by(URL.id.desc())
+    )
+
+
+async def find_duplicate(db, owner_id: int, long_url: str) -> URL | None:
+    """The owner's newest active link without expiry to the same URL.
+
+    The few candidates sharing the hash are compared in full, so a hash
+    collision can never return another URL.
+    """
+    result = await db.execute(duplicate_query(owner_id, long_url))
+    normalized = normalize_url(long_url)
+    for db_url in result.scalars():
+        if normalize_url(db_url.long_url) == normalized:
+            return db_url
+    return None
+
+
+def backfill_hashes(db, batch_size: int = 1000) -> int:
+    """Fill long_url_hash for links created before it existed; returns rows updated"""
+    updated = 0
+    last_id = None
+    while True:
+        query = (
+            select(URL.id, URL.long_url)
+            .where(URL.long_url_hash.is_(None))
+            .order_by(URL.id)
+            .limit(batch_size)
+        )
+        if last_id is not None:
+            query = query.where(URL.id > last_id)
+        rows = db.execute(query).all()
+        if not rows:
+            return updated
+        for url_id, long_url in rows:
+            db.execute(
+                update(URL)
+                .where(URL.id == url_id)
+                .values(long_url_hash=url_hash(long_url))
+            )
+        db.commit()
+        updated += len(rows)
+        last_id = rows[-1].id
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Compute the dedup hash of links created before it was added"
+    )
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    from sharding import router
+
+    router.prepare()
+    for shard in router.shards:
+        with shard.session() as db:
+            print(f"shard {shard.index}: {backfill_hashes(db, args.batch_size)} links")
@@ -0,0 +1,213 @@
+# Deactivation of links at their expiry time
+import asyncio
+import heapq
+import threading
+import time
+from datetime import datetime
+
+from sqlalchemy import select, update
+
+from cache import invalidate, to_timestamp
+from database import SessionLocal
+from models import IST, URL
+from rollups import ist_naive
+
+
+class ExpiryScheduler:
+    """Min-heap of upcoming expirations, deactivating links as they come due.
+
+    Only links expiring within ``horizon`` seconds are held in memory; the
+    heap is topped up from the ``expires_at`` index every
+    ``refresh_interval`` seconds, which also picks up links created by other
+    workers. Due links are deactivated with one UPDATE per ``batch_size``
+    ids and evicted from the redirect cache. Redirects never have to write:
+    they already read expiry from the cached record. With a shard router
+    the heap is loaded from every shard and each link is deactivated on the
+    shard that holds it when it comes due.
+    """
+
+    def __init__(
+        self,
+        horizon: float = 3600.0,
+        refresh_interval: float = 60.0,
+        batch_size: int = 500,
+        session_factory=SessionLocal,
+        router=None,
+    ):
+        self.horizon = horizon
+        self.refresh_interval = refresh_interval
+        self.batch_size = batch_size
+        self.session_factory = session_factory
+        self.router = router
+        self._heap: list[tuple[float, int, str]] = []
+        self._scheduled: set[int] = set()
+        self._lock = threading.Lock()
+        self.loaded_until = 0.0
+        self.last_refresh = 0.0
+        self._loop: asyncio.AbstractEventLoop | None = None
+        self._wakeup: asyncio.Event | None = None
+        self._task: asyncio.Task | None = None
+        self.expired = 0
+        self.batches = 0
+        self.failures = 0
+        self.last_lag = 0.0
+        self.max_lag = 0.0
+
+    def __len__(self):
+        return len(self._heap)
+
+    def schedule(self, url_id: int, short_code: str, expires_at: datetime | float):
+        """Track a link whose expiry falls inside the loaded horizon"""
+        if isinstance(expires_at, datetime):
+            expires_at = to_timestamp(expires_at)
+        with self._lock:
+            if expires_at > self.loaded_until or url_id in self._scheduled:
+                return
+            heapq.heappush(self._heap, (expires_at, url_id, short_code))
+            self._scheduled.add(url_id)
+            earliest = self._heap[0][1] == url_id
+        if earliest and self._wakeup is not None:
+            self._loop.call_soon_threadsafe(self._wakeup.set)
+
+    def load(self, db, now: float | None = None):
+        """Add active links expiring before now + horizon, including overdue ones"""
+        now = time.time() if now is None else now
+        until = now + self.horizon
+        rows = db.execute(
+            select(URL.id, URL.short_code, URL.expires_at).where(
+                URL.is_active.is_(True),
+                URL.expires_at.isnot(None),
+                URL.expires_at <= ist_naive(datetime.fromtimestamp(until, IST)),
+            )
+        ).all()
+        self.loaded_until = max(self.loaded_until, until)
+        self.last_refresh = time.monotonic()
+        for url_id, short_code, expires_at in rows:
+            self.schedule(url_id, short_code, expires_at)
+        return len(rows)
+
+    def pop_due(self, now: float) -> list[tuple[float, int, str]]:
+        due = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                entry = heapq.heappop(self._heap)
+                self._scheduled.discard(entry[1])
+                due.append(entry)
+        return due
+
+    def deactivate(self, db, due: list[tuple[float, int, str]], now: float):
+        """Mark due links inactive and return their codes for cache eviction"""
+        cutoff = ist_naive(datetime.fromtimestamp(now, IST))
+        codes = []
+        for start in range(0, len(due), self.batch_size):
+            batch = due[start : start + self.batch_size]
+            # Links re-activated or given a later expiry since loading are skipped
+            result = db.execute(
+                update(URL)
+                .where(
+                    URL.id.in_([url_id for _, url_id, _ in batch]),
+                    URL.is_active.is_(True),
+                    URL.expires_at <= cutoff,
+                )
+                .values(is_active=False)
+            )
+            db.commit()
+            self.expired += result.rowcount
+            self.batches += 1
+            codes.extend(short_code for _, _, short_code in batch)
+        for expires_at, _, _ in due:
+            self.last_lag = max(0.0, now - expires_at)
+            self.max_lag = max(self.max_lag, self.last_lag)
+        return codes
+
+    def _sessions(self) -> list:
+        if self.router is None:
+            return [self.session_factory()]
+        return [shard.session() for shard in self.router.shards]
+
+    def run_once(self, now: float | None = None) -> list[str]:
+        """Refresh the heap if due and deactivate everything that has expired"""
+        now = time.time() if now is None else now
+        sessions = self._sessions()
+        try:
+            if time.monotonic() - self.last_refresh >= self.refresh_interval:
+                for db in sessions:
+                    self.load(db, now)
+            due = self.pop_due(now)
+            if not due:
+                return []
+            by_shard: dict[int, list] = {}
+            for entry in due:
+                shard = 0 if self.router is None else self.router.index_for(entry[2])
+                by_shard.setdefault(shard, []).append(entry)
+            codes = []
+            for shard, entries in by_shard.items():
+                db = sessions[shard]
+                try:
+                    codes.extend(self.deactivate(db, entries, now))
+                except Exception:
+                    db.rollback()
+                    # Keep this shard's links and any not tried yet scheduled
+                    # so the next pass retries them
+                    done = set(codes)
+                    for expires_at, url_id, short_code in due:
+                        if short_code not in done:
+                            self.schedule(url_id, short_code, expires_at)
+                    raise
+            return codes
+        finally:
+            for db in sessions:
+                db.close()
+
+    def _timeout(self) -> float:
+        until_refresh = self.last_refresh + self.refresh_interval - time.monotonic()
+        if not self._heap:
+            return max(0.0, until_refresh)
+        return max(0.0, min(until_refresh, self._heap[0][0] - time.time()))
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self._timeout())
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                codes = await asyncio.to_thread(self.run_once)
+                await invalidate(*codes)
+            except Exception as e:
+                self.failures += 1
+                print(f"Error expiring URLs: {e}")
+                await asyncio.sleep(1)
+
+    async def start(self):
+        """Start the timer on the running loop; the first pass loads the heap"""
+        if self._task is not None:
+            return
+        self._loop = asyncio.get_running_loop()
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._wakeup = None
+        self._loop = None
+
+    def stats(self) -> dict:
+        return {
+            "scheduled": len(self._heap),
+            "next_expiry_in": (
+                round(self._heap[0][0] - time.time(), 3) if self._heap else None
+            ),
+            "expired": self.expired,
+            "batches": self.batches,
+            "failures": self.failures,
+            "last_lag": round(self.last_lag, 3),
+            "max_lag": round(self.max_lag, 3),
+        }
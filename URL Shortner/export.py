@@ -0,0 +1,146 @@
+# Streaming export of a link's raw clicks
+import asyncio
+import csv
+import io
+import json
+import os
+import zlib
+from datetime import datetime
+
+from sqlalchemy import select
+
+from database import AsyncSessionLocal
+from models import Click
+from retention import CLICK_ARCHIVE_DIR, archived_dataset, has_archives
+from rollups import ist_naive
+
+# Rows fetched per query; memory use of an export is bounded by this
+EXPORT_PAGE_SIZE = int(os.getenv("EXPORT_PAGE_SIZE", "1000"))
+
+FIELDS = ("id", "timestamp", "ip_address", "user_agent")
+MEDIA_TYPES = {"csv": "text/csv", "ndjson": "application/x-ndjson"}
+
+
+async def live_click_pages(
+    url_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    page_size: int = EXPORT_PAGE_SIZE,
+    session_factory=AsyncSessionLocal,
+):
+    """Yield a link's clicks from the database in id order, one page at a time.
+
+    Each page is a keyset query on (url_id, id) in its own short session, so
+    no transaction or cursor is held open while the client reads.
+    """
+    query = (
+        select(Click.id, Click.timestamp, Click.ip_address, Click.user_agent)
+        .where(Click.url_id == url_id)
+        .order_by(Click.id)
+        .limit(page_size)
+    )
+    if start is not None:
+        query = query.where(Click.timestamp >= ist_naive(start))
+    if end is not None:
+        query = query.where(Click.timestamp < ist_naive(end))
+    last_id = 0
+    while True:
+        async with session_factory() as db:
+            rows = (await db.execute(query.where(Click.id > last_id))).all()
+        if not rows:
+            return
+        yield [row._asdict() for row in rows]
+        if len(rows) < page_size:
+            return
+        last_id = rows[-1].id
+
+
+async def archived_click_pages(
+    url_id: int,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    page_size: int = EXPORT_PAGE_SIZE,
+    archive_dir: str = CLICK_ARCHIVE_DIR,
+):
+    """Yield a link's archived clicks, month by month, in batches of row dicts"""
+    if not has_archives(archive_dir):
+        return
+    import pyarrow.dataset as ds
+
+    flt = ds.field("url_id") == url_id
+    if start is not None:
+        flt = flt & (ds.field("timestamp") >= ist_naive(start))
+    if end is not None:
+        flt = flt & (ds.field("timestamp") < ist_naive(end))
+    batches = archived_dataset(archive_dir).scanner(
+        columns=list(FIELDS), filter=flt, batch_size=page_size, use_threads=False
+    ).to_batches()
+    while True:
+        # Parquet reads block, so they run off the event loop
+        batch = await asyncio.to_thread(next, batches, None)
+        if batch is None:
+            return
+        if batch.num_rows:
+            yield batch.to_pylist()
+
+
+def format_csv(rows: list[dict], header: bool) -> str:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(FIELDS)
+    for row in rows:
+        writer.writerow(
+            [
+                row["id"],
+                row["timestamp"].isoformat(),
+                row["ip_address"],
+                row["user_agent"],
+            ]
+        )
+    return buffer.getvalue()
+
+
+def format_ndjson(rows: list[dict], header: bool) -> str:
+    return "".join(json.dumps(row, default=datetime.isoformat) + "\n" for row in rows)
+
+
+FORMATTERS = {"csv": format_csv, "ndjson": format_ndjson}
+
+
+async def export_clicks(
+    url_id: int,
+    format: str = "csv",
+    gzip: bool = False,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    page_size: int = EXPORT_PAGE_SIZE,
+    archive_dir: str = CLICK_ARCHIVE_DIR,
+    session_factory=AsyncSessionLocal,
+):
+    """Yield the encoded export chunk by chunk: archived clicks, then live ones"""
+    formatter = FORMATTERS[format]
+    # wbits=31 writes a gzip header and trailer around the deflate stream
+    compressor = zlib.compressobj(wbits=31) if gzip else None
+
+    def encode(text: str) -> bytes:
+        data = text.encode()
+        return compressor.compress(data) if compressor is not None else data
+
+    sources = (
+        archived_click_pages(url_id, start, end, page_size, archive_dir),
+        live_click_pages(url_id, start, end, page_size, session_factory),
+    )
+    header = True
+    for pages in sources:
+        async for rows in pages:
+            chunk = encode(formatter(rows, header))
+            header = False
+            if chunk:
+                yield chunk
+    # An empty export still gets its CSV header
+    tail = encode(formatter([], header)) if header else b""
+    if compressor is not None:
+        tail += compressor.flush()
+    if tail:
+        yield tail
@@ -0,0 +1,104 @@
+# Password hashing off the event loop
+import asyncio
+import math
+import threading
+import time
+from concurrent.futures import Executor, ThreadPoolExecutor
+
+
+class HashingPoolFull(Exception):
+    """Raised when every hashing worker is busy and the queue is full"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Password hashing queue is full, retry in {retry_after}s")
+        self.retry_after = retry_after
+
+
+class PasswordHasher:
+    """Runs passlib hashing and verification in a small dedicated thread pool.
+
+    bcrypt releases the GIL, so ``workers`` threads hash in parallel while
+    the event loop keeps serving other requests. At most ``max_queue``
+    calls may wait behind the busy workers; beyond that callers get
+    ``HashingPoolFull`` straight away instead of piling up.
+    """
+
+    def __init__(self, context, workers: int = 2, max_queue: int = 32):
+        self.context = context
+        self.workers = workers
+        self.max_queue = max_queue
+        self._executor: Executor | None = None
+        self._lock = threading.Lock()
+        self.in_flight = 0
+        self.peak_queue_depth = 0
+        self.completed = 0
+        self.rejected = 0
+        self.total_seconds = 0.0
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=self.workers, thread_name_prefix="bcrypt"
+            )
+        return self._executor
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    @property
+    def average_seconds(self) -> float:
+        return self.total_seconds / self.completed if self.completed else 0.0
+
+    def retry_after(self) -> int:
+        """Seconds until the current backlog should have drained"""
+        backlog = self.in_flight / max(1, self.workers)
+        return max(1, math.ceil(backlog * (self.average_seconds or 0.25)))
+
+    def _timed(self, fn, *args):
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.completed += 1
+                self.total_seconds += elapsed
+
+    async def _submit(self, fn, *args):
+        with self._lock:
+            if self.in_flight >= self.workers + self.max_queue:
+                self.rejected += 1
+                raise HashingPoolFull(self.retry_after())
+            self.in_flight += 1
+            self.peak_queue_depth = max(self.peak_queue_depth, self.queue_depth)
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, self._timed, fn, *args)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+    async def hash(self, password: str) -> str:
+        return await self._submit(self.context.hash, password)
+
+    async def verify(self, password: str, hashed_password: str) -> bool:
+        return await self._submit(self.context.verify, password, hashed_password)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "queue_depth": self.queue_depth,
+            "peak_queue_depth": self.peak_queue_depth,
+            "completed": self.completed,
+            "rejected": self.rejected,
+            "average_ms": round(self.average_seconds * 1000, 2),
+        }
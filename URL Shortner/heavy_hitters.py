@@ -0,0 +1,113 @@
+# Space-Saving heavy-hitter sketches for top browsers
+import json
+from collections import Counter, defaultdict
+
+from sqlalchemy import delete, select, tuple_
+
+from models import HeavyHitterSketch
+
+# Dimension name -> click row key it summarises
+DIMENSIONS = {"user_agent": "user_agent"}
+CAPACITY = 50
+
+
+class SpaceSaving:
+    """Top-k summary keeping at most ``capacity`` counters.
+
+    Every item whose true count exceeds total / capacity is guaranteed to be
+    tracked. Each counter overestimates its item by at most its ``error``.
+    """
+
+    def __init__(self, capacity: int = CAPACITY):
+        self.capacity = capacity
+        self.counters: dict[str, list[int]] = {}  # item -> [count, error]
+
+    def update(self, item: str, weight: int = 1):
+        counter = self.counters.get(item)
+        if counter is not None:
+            counter[0] += weight
+        elif len(self.counters) < self.capacity:
+            self.counters[item] = [weight, 0]
+        else:
+            # Replace the smallest counter; its count becomes the newcomer's error
+            victim = min(self.counters, key=lambda key: self.counters[key][0])
+            floor = self.counters.pop(victim)[0]
+            self.counters[item] = [floor + weight, floor]
+
+    def top(self, k: int) -> list[tuple[str, int, int]]:
+        """The k largest (item, count, error) entries, largest first"""
+        ranked = sorted(self.counters.items(), key=lambda entry: -entry[1][0])
+        return [(item, count, error) for item, (count, error) in ranked[:k]]
+
+    def to_json(self) -> str:
+        return json.dumps(self.counters)
+
+    @classmethod
+    def from_json(cls, data: str, capacity: int = CAPACITY) -> "SpaceSaving":
+        summary = cls(capacity)
+        summary.counters = json.loads(data)
+        return summary
+
+
+def update_heavy_hitters(db, rows: list[dict]):
+    """Fold a batch of click rows into the per-link summaries"""
+    batches = defaultdict(Counter)
+    for row in rows:
+        for dimension, key in DIMENSIONS.items():
+            batches[(row["url_id"], dimension)][row[key] or "unknown"] += 1
+    if not batches:
+        return
+
+    existing = {
+        (sketch.url_id, sketch.dimension): sketch
+        for sketch in db.query(HeavyHitterSketch)
+        .filter(
+            tuple_(HeavyHitterSketch.url_id, HeavyHitterSketch.dimension).in_(
+                list(batches)
+            )
+        )
+        .with_for_update()
+    }
+    for (url_id, dimension), counts in batches.items():
+        sketch = existing.get((url_id, dimension))
+        summary = SpaceSaving.from_json(sketch.counters) if sketch else SpaceSaving()
+        # Larger counts first so a batch's own heavy items are not evicted by its tail
+        for item, count in counts.most_common():
+            summary.update(item, count)
+        if sketch:
+            sketch.counters = summary.to_json()
+        else:
+            db.add(
+                HeavyHitterSketch(
+                    url_id=url_id, dimension=dimension, counters=summary.to_json()
+                )
+            )
+    db.flush()
+
+
+def clear_heavy_hitters(db, url_ids: list[int] | None = None):
+    stmt = delete(HeavyHitterSketch)
+    if url_ids is not None:
+        stmt = stmt.where(HeavyHitterSketch.url_id.in_(url_ids))
+    db.execute(stmt)
+
+
+def summary_query(url_id: int, dimension: str):
+    return select(HeavyHitterSketch.counters).where(
+        HeavyHitterSketch.url_id == url_id,
+        HeavyHitterSketch.dimension == dimension,
+    )
+
+
+def top_of(counters: str | None, k: int):
+    return SpaceSaving.from_json(counters).top(k) if counters is not None else []
+
+
+def top_items(db, url_id: int, dimension: str, k: int = 5):
+    """Top-k (item, count, error) for one link, read from a single row"""
+    return top_of(db.execute(summary_query(url_id, dimension)).scalar(), k)
+
+
+async def fetch_top_items(db, url_id: int, dimension: str, k: int = 5):
+    """top_items on an AsyncSession; at most CAPACITY counters are parsed"""
+    return top_of((await db.execute(summary_query(url_id, dimension))).scalar(), k)
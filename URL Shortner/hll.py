@@ -0,0 +1,177 @@
+# HyperLogLog unique-visitor sketches
+import asyncio
+import hashlib
+import math
+import zlib
+from collections import defaultdict
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, tuple_
+
+from models import IST, UniqueVisitorSketch, UniqueVisitorTotal
+from rollups import day_bucket, ist_naive
+
+PRECISION = 12
+
+
+class HyperLogLog:
+    """Cardinality estimator with 2**precision one-byte registers"""
+
+    def __init__(self, precision: int = PRECISION, registers: bytes | None = None):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = bytearray(registers or self.num_registers)
+        self._rank_bits = 64 - precision
+
+    def add(self, item: str):
+        value = int.from_bytes(
+            hashlib.blake2b(item.encode(), digest_size=8).digest(), "big"
+        )
+        index = value >> self._rank_bits
+        remainder = value & ((1 << self._rank_bits) - 1)
+        rank = self._rank_bits - remainder.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other: "HyperLogLog"):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches of different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def count(self) -> int:
+        m = self.num_registers
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        # Linear counting is more accurate while many registers are still empty
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)
+        return round(estimate)
+
+    @property
+    def relative_error(self) -> float:
+        """Standard error of the estimate relative to the true count"""
+        return 1.04 / math.sqrt(self.num_registers)
+
+    def to_bytes(self) -> bytes:
+        return zlib.compress(bytes(self.registers))
+
+    @classmethod
+    def from_bytes(cls, data: bytes, precision: int = PRECISION) -> "HyperLogLog":
+        return cls(precision, zlib.decompress(data))
+
+
+def fold(db, existing: dict, visitors: dict, make):
+    """Add each key's addresses to its stored sketch, or store a new one"""
+    for key, addresses in visitors.items():
+        sketch = existing.get(key)
+        hll = HyperLogLog.from_bytes(sketch.registers) if sketch else HyperLogLog()
+        for address in addresses:
+            hll.add(address)
+        if sketch:
+            sketch.registers = hll.to_bytes()
+        else:
+            db.add(make(key, hll.to_bytes()))
+
+
+def update_sketches(db, rows: list[dict]):
+    """Fold a batch of click rows into the per-link daily and all-time sketches"""
+    visitors = defaultdict(set)
+    totals = defaultdict(set)
+    for row in rows:
+        address = row["ip_address"] or "unknown"
+        visitors[(row["url_id"], day_bucket(row["timestamp"]))].add(address)
+        totals[row["url_id"]].add(address)
+    if not visitors:
+        return
+
+    existing = {
+        (sketch.url_id, sketch.bucket): sketch
+        for sketch in db.query(UniqueVisitorSketch)
+        .filter(
+            tuple_(UniqueVisitorSketch.url_id, UniqueVisitorSketch.bucket).in_(
+                list(visitors)
+            )
+        )
+        .with_for_update()
+    }
+    fold(
+        db,
+        existing,
+        visitors,
+        lambda key, registers: UniqueVisitorSketch(
+            url_id=key[0], bucket=key[1], registers=registers
+        ),
+    )
+    existing = {
+        sketch.url_id: sketch
+        for sketch in db.query(UniqueVisitorTotal)
+        .filter(UniqueVisitorTotal.url_id.in_(list(totals)))
+        .with_for_update()
+    }
+    fold(
+        db,
+        existing,
+        totals,
+        lambda url_id, registers: UniqueVisitorTotal(
+            url_id=url_id, registers=registers
+        ),
+    )
+    db.flush()
+
+
+def clear_sketches(db, url_ids: list[int] | None = None):
+    for model in (UniqueVisitorSketch, UniqueVisitorTotal):
+        stmt = delete(model)
+        if url_ids is not None:
+            stmt = stmt.where(model.url_id.in_(url_ids))
+        db.execute(stmt)
+
+
+def sketch_queries(url_id: int, windows: dict, now: datetime | None = None):
+    """The all-time sketch and the daily ones the widest window needs.
+
+    Windows are widened to whole days: a 7 day window merges the sketches of
+    the last 7 days plus the partial day it started in. Returns the window
+    starts and the two queries, so reads cost the same however old a link is.
+    """
+    now = ist_naive(now or datetime.now(IST))
+    starts = {name: day_bucket(now - timedelta(days=days)) for name, days in windows.items()}
+    total = select(UniqueVisitorTotal.registers).where(
+        UniqueVisitorTotal.url_id == url_id
+    )
+    daily = select(UniqueVisitorSketch.bucket, UniqueVisitorSketch.registers).where(
+        UniqueVisitorSketch.url_id == url_id,
+        UniqueVisitorSketch.bucket >= min(starts.values(), default=now),
+    )
+    return starts, total, daily
+
+
+def merge_estimates(total: bytes | None, daily: list, starts: dict):
+    """Estimates keyed like ``starts`` plus "total", and the relative error"""
+    merged = {name: HyperLogLog() for name in starts}
+    for bucket, registers in daily:
+        sketch = HyperLogLog.from_bytes(registers)
+        for name, start in starts.items():
+            if bucket >= start:
+                merged[name].merge(sketch)
+    merged["total"] = HyperLogLog.from_bytes(total) if total else HyperLogLog()
+    estimates = {name: hll.count() for name, hll in merged.items()}
+    return estimates, merged["total"].relative_error
+
+
+def unique_visitors(db, url_id: int, windows: dict, now: datetime | None = None):
+    """Estimated unique visitors overall and for each window of days"""
+    starts, total, daily = sketch_queries(url_id, windows, now)
+    registers = db.execute(total).scalar()
+    return merge_estimates(registers, db.execute(daily).all(), starts)
+
+
+async def estimate_unique_visitors(
+    db, url_id: int, windows: dict, now: datetime | None = None
+):
+    """unique_visitors on an AsyncSession; the merging runs off the event loop"""
+    starts, total, daily = sketch_queries(url_id, windows, now)
+    registers = (await db.execute(total)).scalar()
+    rows = (await db.execute(daily)).all()
+    return await asyncio.to_thread(merge_estimates, registers, rows, starts)
@@ -1,22 +1,55 @@
-from fastapi import FastAPI, HTTPException, Depends, Request, BackgroundTasks
-from fastapi.responses import RedirectResponse
+from fastapi import FastAPI, HTTPException, Depends, Request, Query
+from fastapi.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    RedirectResponse,
+    Response,
+    StreamingResponse,
+)
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
-from sqlalchemy import and_, func, update
-from database import SessionLocal, engine
-from models import Base, URL, Click, User
-from utils import generate_unique_short_code, validate_custom_code
-from cache import Cache
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy import distinct, func, insert, select
+from sqlalchemy.exc import IntegrityError
+from database import AsyncSessionLocal, async_engine, effective_settings, engine
+from models import URL, Click, ClickRollupDaily, User
+from utils import validate_custom_code
+from allocator import get_allocator
+from clicks import ClickBuffer
+from bloom import ShortCodeFilter
+from rollups import click_windows
+from hll import estimate_unique_visitors
+from heavy_hitters import fetch_top_items
+from cache import (
+    NOT_FOUND,
+    CachedURL,
+    cache,
+    cache_missing,
+    cache_records,
+    cache_url,
+    get_cached_url,
+    to_timestamp,
+)
+from qr import MEDIA_TYPES, QRRenderer, etag_matches
+from expiry import ExpiryScheduler
+from warmup import warm_cache
+from metrics import Metrics, MetricsMiddleware
+from hashing import HashingPoolFull, PasswordHasher
+from auth_cache import TokenCache, UserSnapshot, snapshot_for, watch_users
+from export import MEDIA_TYPES as EXPORT_MEDIA_TYPES, export_clicks
+from retention import CLICK_ARCHIVE_DIR, archived_ips, has_archives
+from sharding import router
+from dedup import find_duplicate, url_hash
+from migrations import migrate
+from ratelimit import RATE_LIMIT_ENABLED, RateLimitMiddleware, build_limiter
 from pydantic import BaseModel
 from datetime import datetime, timedelta
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi.middleware.cors import CORSMiddleware
-import qrcode
-import io
 import base64
 import pytz
 import asyncio
+from contextlib import asynccontextmanager
 
 # Set timezone to IST
 IST = pytz.timezone("Asia/Kolkata")
@@ -36,56 +69,203 @@ if not SECRET_KEY:
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "30"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
-oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
+# Public address short links are served from
+BASE_URL = os.getenv("BASE_URL", "http://localhost:8000").rstrip("/")
 
-Base.metadata.create_all(bind=engine)
-app = FastAPI()
-
-
-async def update_expired_urls():
-    """Background task to update is_active status of expired URLs"""
-    while True:
-        db = None
-        try:
-            db = SessionLocal()
-            current_time = datetime.now(IST)
-
-            # Update is_active status for expired URLs in a single query
-            stmt = (
-                update(URL)
-                .where(
-                    and_(
-                        URL.is_active.is_(True),
-                        URL.expires_at.isnot(None),
-                        URL.expires_at < current_time,
-                    )
-                )
-                .values(is_active=False)
-            )
+# Comma-separated usernames allowed to read /admin/stats; empty allows nobody
+ADMIN_USERS = {
+    name.strip() for name in os.getenv("ADMIN_USERS", "").split(",") if name.strip()
+}
 
-            db.execute(stmt)
-            db.commit()
+# Largest number of links accepted by one /shorten/batch call
+MAX_BATCH_SIZE = int(os.getenv("MAX_BATCH_SIZE", "1000"))
 
-        except Exception as e:
-            print(f"Error in update_expired_urls: {e}")
-        finally:
-            if db:
-                db.close()
+# Startup warm-up: how many of the most clicked links to preload, from how far back
+CACHE_WARMUP_TOP_N = int(os.getenv("CACHE_WARMUP_TOP_N", "1000"))
+CACHE_WARMUP_LOOKBACK_HOURS = int(os.getenv("CACHE_WARMUP_LOOKBACK_HOURS", "24"))
+CACHE_WARMUP_TIMEOUT = float(os.getenv("CACHE_WARMUP_TIMEOUT", "5"))
+warmup_report: dict = {}
 
-        # Wait for 5 minutes before next check
-        await asyncio.sleep(300)
+# Generated codes can only clash with custom or legacy codes, so a few retries suffice
+MAX_CODE_ATTEMPTS = 5
 
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
-@app.on_event("startup")
-async def start_background_tasks():
-    """Start background tasks when the application starts"""
-    background_tasks = BackgroundTasks()
-    background_tasks.add_task(update_expired_urls)
+# Bring the schema up to date, then the link tables on every shard and the
+# slot map that places codes on them
+migrate(engine)
+router.prepare()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Start background workers with the application and drain them on exit"""
+    print(f"Worker {os.getpid()} database settings: {await effective_settings()}")
+    await cache.start()
+    await router.start()
+    await click_buffer.start()
+    await expiry_scheduler.start()
+    await router.run_sync(code_filter.load)
+    # Hot links are cached before the worker starts taking requests
+    warmup_report.update(
+        await warm_cache(
+            router,
+            CACHE_WARMUP_TOP_N,
+            CACHE_WARMUP_LOOKBACK_HOURS,
+            CACHE_WARMUP_TIMEOUT,
+        )
+    )
+    print(f"Worker {os.getpid()} redirect cache warm-up: {warmup_report}")
+    yield
+    await expiry_scheduler.stop()
+    await click_buffer.stop()
+    await router.stop()
+    await cache.stop()
+    qr_renderer.shutdown()
+    password_hasher.shutdown()
+
+
+app = FastAPI(lifespan=lifespan)
+
+
+def token_user(token: str) -> str | None:
+    """User name of a recently verified token, for keying rate limits.
+
+    Only the token cache is consulted; a token it does not hold is keyed by
+    IP until get_current_user has verified it once.
+    """
+    cached = token_cache.get(token)
+    return cached.username if cached is not None else None
+
+
+# Token buckets per user or IP on redirect and shorten; inside the metrics
+# middleware so rejected requests are still measured
+rate_limiter = build_limiter()
+if RATE_LIMIT_ENABLED:
+    app.add_middleware(RateLimitMiddleware, limiter=rate_limiter, identify=token_user)
+
+# Request, phase and query metrics for /metrics; METRICS_ENABLED=false turns them off
+metrics = Metrics(enabled=os.getenv("METRICS_ENABLED", "true").lower() == "true")
+if metrics.enabled:
+    app.add_middleware(MetricsMiddleware, metrics=metrics)
+    metrics.instrument_engine(engine)
+    metrics.instrument_engine(async_engine.sync_engine)
+    for shard in router.shards:
+        if shard.engine is not engine:
+            metrics.instrument_engine(shard.engine)
+            metrics.instrument_engine(shard.async_engine.sync_engine)
+        for replica in shard.replicas.replicas:
+            metrics.instrument_engine(replica.async_engine.sync_engine)
+
+
+@app.exception_handler(HashingPoolFull)
+async def hashing_pool_full(request: Request, exc: HashingPoolFull):
+    """Shed login and register load instead of queueing without bound"""
+    return JSONResponse(
+        status_code=503,
+        content={"detail": "Server busy, try again later"},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
 
 
-# Cache setup
-cache = Cache(Cache.MEMORY)
+# Clicks are written behind the redirect response
+click_buffer = ClickBuffer(
+    max_size=int(os.getenv("CLICK_BUFFER_MAX_SIZE", "100000")),
+    batch_size=int(os.getenv("CLICK_BATCH_SIZE", "500")),
+    flush_interval=float(os.getenv("CLICK_FLUSH_INTERVAL", "1.0")),
+    router=router,
+    max_retries=int(os.getenv("CLICK_FLUSH_RETRIES", "3")),
+)
+
+# Rules out unknown short codes before they reach the database
+code_filter = ShortCodeFilter(
+    capacity=int(os.getenv("BLOOM_CAPACITY", "1000000")),
+    error_rate=float(os.getenv("BLOOM_ERROR_RATE", "0.01")),
+    sync_interval=float(os.getenv("BLOOM_SYNC_INTERVAL", "1.0")),
+    id_stride=router.id_stride,
+)
+
+# QR images are rendered in a pool and kept in a bounded LRU
+qr_renderer = QRRenderer(
+    kind=os.getenv("QR_EXECUTOR", "thread"),
+    workers=int(os.getenv("QR_WORKERS", "2")),
+    cache_size=int(os.getenv("QR_CACHE_SIZE", "1024")),
+)
+
+# bcrypt runs in its own bounded pool so hashing never blocks the event loop
+password_hasher = PasswordHasher(
+    pwd_context,
+    workers=int(os.getenv("HASH_WORKERS", "2")),
+    max_queue=int(os.getenv("HASH_QUEUE_SIZE", "32")),
+)
+
+# Verified tokens, so authenticated requests skip the JWT check and user query
+token_cache = TokenCache(
+    max_size=int(os.getenv("TOKEN_CACHE_SIZE", "10000")),
+    ttl=float(os.getenv("TOKEN_CACHE_TTL", "300")),
+)
+watch_users(token_cache)
+
+# Deactivates links as they expire instead of polling the whole table
+expiry_scheduler = ExpiryScheduler(
+    horizon=float(os.getenv("EXPIRY_HORIZON", "3600")),
+    refresh_interval=float(os.getenv("EXPIRY_REFRESH_INTERVAL", "60")),
+    batch_size=int(os.getenv("EXPIRY_BATCH_SIZE", "500")),
+    router=router,
+)
+
+
+def cache_hit_ratio():
+    stats = cache.stats()
+    lookups = stats["l1"]["hits"] + stats["l1"]["misses"]
+    return (stats["l1"]["hits"] + stats["l2"]["hits"]) / lookups if lookups else 0.0
+
+
+registry = metrics.registry
+registry.gauge(
+    "redirect_cache_hits_total",
+    "Redirect cache hits per tier",
+    lambda: {"l1": cache.l1.hits, "l2": cache.l2_hits},
+    label="tier",
+    kind="counter",
+)
+registry.gauge(
+    "redirect_cache_misses_total",
+    "Redirect cache misses per tier",
+    lambda: {"l1": cache.l1.misses, "l2": cache.l2_misses},
+    label="tier",
+    kind="counter",
+)
+registry.gauge(
+    "redirect_cache_hit_ratio",
+    "Share of lookups answered by either tier",
+    cache_hit_ratio,
+)
+registry.gauge(
+    "click_buffer_pending", "Clicks waiting to be written", lambda: len(click_buffer)
+)
+registry.gauge(
+    "click_buffer_dropped_total",
+    "Clicks dropped because the buffer was full",
+    lambda: click_buffer.dropped,
+    kind="counter",
+)
+registry.gauge(
+    "expiry_scheduler_scheduled",
+    "Expirations held in memory",
+    lambda: len(expiry_scheduler),
+)
+registry.gauge(
+    "expiry_scheduler_lag_seconds",
+    "Delay between a link's expiry and its deactivation, last batch",
+    lambda: expiry_scheduler.last_lag,
+)
+registry.gauge(
+    "expiry_scheduler_max_lag_seconds",
+    "Largest deactivation delay seen by this worker",
+    lambda: expiry_scheduler.max_lag,
+)
 
 
 class Token(BaseModel):
@@ -109,27 +289,46 @@ class UserResponse(UserBase):
         from_attributes = True  # newer version of orm_mode
 
 
-class URLRequest(BaseModel):
+class URLItem(BaseModel):
     long_url: str
     expires_at: datetime | None = None  # Optional expiry
     custom_code: str | None = None  # Optional custom short code
     expiry_minutes: int | None = None  # Expiry in minutes
 
 
-def get_db():
-    db = SessionLocal()
-    try:
+class URLRequest(URLItem):
+    include_qr: bool = True  # Inline base64 PNG; otherwise fetch it from qr_url
+    dedupe: bool = False  # Return the caller's existing link to the same URL
+
+
+class BatchURLRequest(BaseModel):
+    urls: list[URLItem]
+
+
+def resolve_expiry(request: URLItem, current_time: datetime) -> datetime | None:
+    """Expiry of a new link in IST, from either expiry_minutes or expires_at"""
+    if request.expiry_minutes:
+        # Convert minutes to timedelta and add to current IST time
+        return current_time + timedelta(minutes=int(request.expiry_minutes))
+    if request.expires_at:
+        # Ensure the provided expires_at is in IST
+        if request.expires_at.tzinfo is None:
+            return IST.localize(request.expires_at)
+        return request.expires_at.astimezone(IST)
+    return None
+
+
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 
-def verify_password(plain_password, hashed_password):
-    return pwd_context.verify(plain_password, hashed_password)
+async def verify_password(plain_password, hashed_password):
+    return await password_hasher.verify(plain_password, hashed_password)
 
 
-def get_password_hash(password):
-    return pwd_context.hash(password)
+async def get_password_hash(password):
+    return await password_hasher.hash(password)
 
 
 def create_access_token(data: dict, expires_delta: timedelta | None = None):
@@ -145,13 +344,18 @@ def create_access_token(data: dict, expires_delta: timedelta | None = None):
 
 
 async def get_current_user(
-    token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)
+    token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_db)
 ):
     credentials_exception = HTTPException(
         status_code=401,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
+    # A token verified recently needs neither signature checks nor a user lookup
+    cached = token_cache.get(token)
+    if cached is not None:
+        return cached
+
     try:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username = payload.get("sub")
@@ -159,19 +363,29 @@ async def get_current_user(
             raise credentials_exception
     except JWTError:
         raise credentials_exception
-    user = db.query(User).filter(User.username == username).first()
-    if user is None:
+    result = await db.execute(select(User).where(User.username == username))
+    user = result.scalars().first()
+    if user is None or not user.is_active:
         raise credentials_exception
-    return user
+    snapshot = snapshot_for(user)
+    token_cache.put(token, snapshot, exp=payload.get("exp", 0))
+    return snapshot
+
+
+async def get_admin_user(current_user: UserSnapshot = Depends(get_current_user)):
+    if current_user.username not in ADMIN_USERS:
+        raise HTTPException(status_code=403, detail="Admin access required")
+    return current_user
 
 
 @app.post("/register")
-async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     # Check if username exists
-    if db.query(User).filter(User.username == user.username).count() > 0:
+    result = await db.execute(select(User.id).where(User.username == user.username))
+    if result.first() is not None:
         raise HTTPException(status_code=400, detail="Username already taken")
 
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await get_password_hash(user.password)
     db_user = User(
         username=user.username,
         hashed_password=hashed_password,
@@ -179,20 +393,24 @@ async def register_user(user: UserCreate, db: Session = Depends(get_db)):
     )
     db.add(db_user)
     try:
-        db.commit()
-        db.refresh(db_user)
+        await db.commit()
+        await db.refresh(db_user)
         return {"message": "User created successfully"}
     except Exception as e:
-        db.rollback()
+        await db.rollback()
         raise HTTPException(status_code=500, detail="Database error")
 
 
 @app.post("/token")
 async def login(
-    form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)
+    form_data: OAuth2PasswordRequestForm = Depends(),
+    db: AsyncSession = Depends(get_db),
 ):
-    user = db.query(User).filter(User.username == form_data.username).first()
-    if not user or not verify_password(form_data.password, user.hashed_password):
+    result = await db.execute(select(User).where(User.username == form_data.username))
+    user = result.scalars().first()
+    if not user or not await verify_password(
+        form_data.password, user.hashed_password
+    ):
         raise HTTPException(
             status_code=401,
             detail="Incorrect username or password",
@@ -208,163 +426,459 @@ async def login(
 @app.post("/shorten")
 async def shorten_url(
     request: URLRequest,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    current_user: UserSnapshot = Depends(get_current_user),
 ):
     # Handle custom short code if provided
+    if request.custom_code and not validate_custom_code(request.custom_code):
+        raise HTTPException(status_code=400, detail="Invalid custom code format")
+
+    # Handle expiration time
+    expires_at = resolve_expiry(request, datetime.now(IST))
+
+    # Links with a custom code or an expiry are always new
+    if request.dedupe and not request.custom_code and expires_at is None:
+        matches = await router.fan_out(
+            find_duplicate, current_user.id, request.long_url
+        )
+        matches = [db_url for db_url in matches if db_url is not None]
+        if matches:
+            existing = max(matches, key=lambda db_url: db_url.created_at)
+            return await shorten_response(
+                existing.short_code, None, request.include_qr, deduplicated=True
+            )
+
     if request.custom_code:
-        if not validate_custom_code(request.custom_code):
-            raise HTTPException(status_code=400, detail="Invalid custom code format")
-        if db.query(URL).filter(URL.short_code == request.custom_code).first():
-            raise HTTPException(status_code=400, detail="Custom code already exists")
         short_code = request.custom_code
     else:
-        short_code = generate_unique_short_code(db)
+        short_code = await get_allocator().allocate_async()
+
+    # The unique index on short_code is the only collision check; the code
+    # decides the shard, so each attempt opens a session on its own shard
+    for _ in range(MAX_CODE_ATTEMPTS):
+        shard = router.shard_for(short_code)
+        async with shard.async_session() as db:
+            [url_id] = await router.next_url_ids(db, shard, 1)
+            db_url = URL(
+                id=url_id,
+                long_url=request.long_url,
+                long_url_hash=url_hash(request.long_url),
+                short_code=short_code,
+                expires_at=expires_at,
+                is_active=True,
+                owner_id=current_user.id,
+            )
+            db.add(db_url)
+            try:
+                await db.commit()
+                break
+            except IntegrityError:
+                await db.rollback()
+        if request.custom_code:
+            raise HTTPException(status_code=400, detail="Custom code already exists")
+        short_code = await get_allocator().allocate_async()
+    else:
+        raise HTTPException(status_code=503, detail="Could not allocate a short code")
 
-    # Handle expiration time
-    expires_at = None
-    current_time = datetime.now(IST)
+    # Cache the URL, replacing any negative entry for the code in every worker
+    await cache_url(db_url, announce=True)
+    code_filter.add(short_code)
+    # Replicas may not have the link yet; this worker reads it from the primary
+    shard.replicas.wrote(short_code)
+    if expires_at is not None:
+        expiry_scheduler.schedule(db_url.id, short_code, expires_at)
+    return await shorten_response(short_code, expires_at, request.include_qr)
 
-    if request.expiry_minutes:
-        # Convert minutes to timedelta and add to current IST time
-        expires_at = current_time + timedelta(minutes=int(request.expiry_minutes))
-    elif request.expires_at:
-        # Ensure the provided expires_at is in IST
-        if request.expires_at.tzinfo is None:
-            expires_at = IST.localize(request.expires_at)
+
+async def shorten_response(
+    short_code: str,
+    expires_at: datetime | None,
+    include_qr: bool,
+    deduplicated: bool = False,
+) -> dict:
+    response = {
+        "short_url": f"{BASE_URL}/{short_code}",
+        "qr_url": f"{BASE_URL}/qr/{short_code}",
+        "expires_at": expires_at,
+        "deduplicated": deduplicated,
+    }
+    if include_qr:
+        image, _ = await qr_renderer.render(f"{BASE_URL}/{short_code}", "png", 10, 5)
+        response["qr_code"] = base64.b64encode(image).decode()
+    return response
+
+
+@app.post("/shorten/batch")
+async def shorten_batch(
+    request: BatchURLRequest,
+    current_user: UserSnapshot = Depends(get_current_user),
+):
+    """Create many links, one transaction per shard; results are in input order"""
+    if len(request.urls) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=400, detail=f"At most {MAX_BATCH_SIZE} URLs per batch"
+        )
+    current_time = datetime.now(IST)
+    errors: dict[int, str] = {}
+    codes: dict[int, str] = {}
+    expiries = [resolve_expiry(item, current_time) for item in request.urls]
+
+    # Custom codes: format and in-batch duplicates first
+    for index, item in enumerate(request.urls):
+        if item.custom_code is None:
+            continue
+        if not validate_custom_code(item.custom_code):
+            errors[index] = "Invalid custom code format"
+        elif item.custom_code in codes.values():
+            errors[index] = "Duplicate custom code in batch"
         else:
-            expires_at = request.expires_at.astimezone(IST)
+            codes[index] = item.custom_code
+    custom = set(codes)
+    generated = [
+        i for i in range(len(request.urls)) if i not in custom and i not in errors
+    ]
+
+    ids: dict[str, int] = {}
+    for _ in range(MAX_CODE_ATTEMPTS):
+        # Generated codes can only clash with custom or legacy ones; refill those
+        missing = [i for i in generated if i not in codes]
+        if missing:
+            fresh = await asyncio.to_thread(get_allocator().allocate_many, len(missing))
+            codes.update(zip(missing, fresh))
+
+        by_shard: dict[int, dict[int, str]] = {}
+        for index, short_code in codes.items():
+            if short_code not in ids:
+                shard_index = router.index_for(short_code)
+                by_shard.setdefault(shard_index, {})[index] = short_code
+        for shard_index, shard_codes in by_shard.items():
+            shard = router.shards[shard_index]
+            async with shard.async_session() as db:
+                # One set-based query for every code that is about to be inserted
+                result = await db.execute(
+                    select(URL.short_code).where(
+                        URL.short_code.in_(shard_codes.values())
+                    )
+                )
+                taken = set(result.scalars())
+                group = list(shard_codes)
+                for index, short_code in list(shard_codes.items()):
+                    if short_code in taken:
+                        del codes[index], shard_codes[index]
+                        if index in custom:
+                            errors[index] = "Custom code already exists"
+                refill = any(i not in codes for i in group if i in generated)
+                if not shard_codes or refill:
+                    # Retry this shard once the generated codes are refilled
+                    continue
+
+                url_ids = await router.next_url_ids(db, shard, len(shard_codes))
+                rows = []
+                for url_id, (index, short_code) in zip(url_ids, shard_codes.items()):
+                    row = {
+                        "long_url": request.urls[index].long_url,
+                        "long_url_hash": url_hash(request.urls[index].long_url),
+                        "short_code": short_code,
+                        "expires_at": expiries[index],
+                        "is_active": True,
+                        "owner_id": current_user.id,
+                        "created_at": current_time,
+                    }
+                    if url_id is not None:
+                        row["id"] = url_id
+                    rows.append(row)
+                try:
+                    result = await db.execute(
+                        insert(URL).returning(URL.id, URL.short_code), rows
+                    )
+                    inserted = dict((code, url_id) for url_id, code in result.all())
+                    await db.commit()
+                    ids.update(inserted)
+                except IntegrityError:
+                    # A concurrent request took one of the codes; check them again
+                    await db.rollback()
+        if all(short_code in ids for short_code in codes.values()) and all(
+            i in codes for i in generated
+        ):
+            break
+    else:
+        raise HTTPException(status_code=503, detail="Could not allocate short codes")
+
+    # Prime the cache, the Bloom filter and the expiry scheduler in one pass
+    await cache_records(
+        {
+            short_code: CachedURL(
+                request.urls[index].long_url,
+                ids[short_code],
+                True,
+                to_timestamp(expiries[index]),
+            )
+            for index, short_code in codes.items()
+        }
+    )
+    results = []
+    for index in range(len(request.urls)):
+        if index in errors:
+            results.append({"index": index, "error": errors[index]})
+            continue
+        short_code = codes[index]
+        code_filter.add(short_code)
+        router.shard_for(short_code).replicas.wrote(short_code)
+        if expiries[index] is not None:
+            expiry_scheduler.schedule(ids[short_code], short_code, expiries[index])
+        results.append(
+            {
+                "index": index,
+                "short_url": f"{BASE_URL}/{short_code}",
+                "qr_url": f"{BASE_URL}/qr/{short_code}",
+                "expires_at": expiries[index],
+            }
+        )
+    return {"created": len(codes), "failed": len(errors), "results": results}
 
-    db_url = URL(
-        long_url=request.long_url,
-        short_code=short_code,
-        expires_at=expires_at,
-        is_active=True,
-        owner_id=current_user.id,
+
+async def owned_links(db: AsyncSession, owner_id: int, limit: int) -> list[dict]:
+    """Newest links of owner_id on one shard, with their total clicks"""
+    totals = (
+        select(
+            ClickRollupDaily.url_id,
+            func.sum(ClickRollupDaily.clicks).label("clicks"),
+        )
+        .group_by(ClickRollupDaily.url_id)
+        .subquery()
+    )
+    result = await db.execute(
+        select(URL, func.coalesce(totals.c.clicks, 0))
+        .outerjoin(totals, totals.c.url_id == URL.id)
+        .where(URL.owner_id == owner_id)
+        .order_by(URL.created_at.desc(), URL.id.desc())
+        .limit(limit)
+    )
+    return [
+        {
+            "short_code": db_url.short_code,
+            "short_url": f"{BASE_URL}/{db_url.short_code}",
+            "long_url": db_url.long_url,
+            "created_at": db_url.created_at,
+            "expires_at": db_url.expires_at,
+            "status": db_url.status,
+            "total_clicks": clicks,
+        }
+        for db_url, clicks in result.all()
+    ]
+
+
+@app.get("/urls")
+async def list_urls(
+    limit: int = Query(50, ge=1, le=500),
+    current_user: UserSnapshot = Depends(get_current_user),
+):
+    """The caller's newest links, gathered from every shard"""
+    per_shard = await router.fan_out(owned_links, current_user.id, limit)
+    links = sorted(
+        (link for shard_links in per_shard for link in shard_links),
+        key=lambda link: link["created_at"],
+        reverse=True,
     )
-    db.add(db_url)
-    db.commit()
-    db.refresh(db_url)
+    return {"urls": links[:limit]}
 
-    # Cache the URL
-    await cache.set(short_code, request.long_url)
 
-    # Generate QR code
-    qr = qrcode.QRCode(version=1, box_size=10, border=5)
-    qr.add_data(f"http://localhost:8000/{short_code}")
-    qr.make(fit=True)
-    img = qr.make_image(fill_color="black", back_color="white")
+@app.get("/qr/{short_code}")
+async def get_qr_code(
+    short_code: str,
+    request: Request,
+    format: str = Query("png", pattern="^(png|svg)$"),
+    size: int = Query(10, ge=1, le=40, description="Pixels per QR module"),
+    border: int = Query(4, ge=0, le=20, description="Quiet zone in modules"),
+):
+    """QR code for a short link, rendered lazily and cached"""
+    if not await code_filter.check(short_code, router):
+        raise HTTPException(status_code=404, detail="URL not found")
+    record = await get_cached_url(short_code)
+    if record is None:
+        async with router.async_session(short_code) as db:
+            result = await db.execute(
+                select(URL.id).where(URL.short_code == short_code)
+            )
+            if result.first() is None:
+                record = NOT_FOUND
+    if record == NOT_FOUND:
+        raise HTTPException(status_code=404, detail="URL not found")
+
+    image, etag = await qr_renderer.render(
+        f"{BASE_URL}/{short_code}", format, size, border
+    )
+    headers = {"ETag": etag, "Cache-Control": "public, max-age=86400"}
+    if etag_matches(request.headers.get("if-none-match", ""), etag):
+        return Response(status_code=304, headers=headers)
+    return Response(content=image, media_type=MEDIA_TYPES[format], headers=headers)
 
-    # Convert QR code to base64
-    buffered = io.BytesIO()
-    img.save(buffered)  # PIL will auto-detect format
-    qr_code = base64.b64encode(buffered.getvalue()).decode()
 
+@app.get("/metrics", include_in_schema=False)
+async def get_metrics():
+    """Prometheus text exposition of this worker's metrics"""
+    if not metrics.enabled:
+        raise HTTPException(status_code=404, detail="Metrics are disabled")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+@app.get("/admin/stats")
+async def get_stats(current_user: UserSnapshot = Depends(get_admin_user)):
+    """Internal state of the redirect path"""
     return {
-        "short_url": f"http://localhost:8000/{short_code}",
-        "qr_code": qr_code,
-        "expires_at": expires_at,
+        "database": await effective_settings(),
+        "redirect_cache": cache.stats(),
+        "cache_warmup": warmup_report,
+        "bloom_filter": code_filter.stats(),
+        "click_buffer": click_buffer.stats(),
+        "qr_renderer": qr_renderer.stats(),
+        "expiry_scheduler": expiry_scheduler.stats(),
+        "token_cache": token_cache.stats(),
+        "password_hasher": password_hasher.stats(),
+        "shards": router.stats(),
+        "rate_limiter": rate_limiter.stats(),
     }
 
 
+async def find_link(db: AsyncSession, short_code: str) -> URL | None:
+    result = await db.execute(select(URL).where(URL.short_code == short_code))
+    return result.scalars().first()
+
+
 @app.get("/{short_code}")
-async def redirect(short_code: str, request: Request, db: Session = Depends(get_db)):
-    # First, try to get the URL from database
-    db_url = db.query(URL).filter(URL.short_code == short_code).first()
-    if db_url is None:
+async def redirect(short_code: str, request: Request):
+    # Codes the Bloom filter has never seen cannot exist
+    with metrics.timer("bloom"):
+        known = await code_filter.check(short_code, router)
+    if not known:
         raise HTTPException(status_code=404, detail="URL not found")
 
-    # Check if URL is expired and update is_active if needed
-    status = db_url.status
-    if status == "expired":
-        # Update the is_active status in the database
-        db.query(URL).filter(URL.id == db_url.id).update({"is_active": False})
-        db.commit()
-        raise HTTPException(status_code=410, detail="URL is expired")
-    elif status != "active":
-        raise HTTPException(status_code=410, detail=f"URL is {status}")
+    # Serve from cache first; a hit needs no database work at all
+    with metrics.timer("cache"):
+        record = await get_cached_url(short_code)
+    if record == NOT_FOUND:
+        raise HTTPException(status_code=404, detail="URL not found")
 
-    # Try to get the long URL from cache
-    long_url = await cache.get(short_code)
-    if not long_url:
-        long_url = db_url.long_url
-        await cache.set(short_code, long_url)
+    if record is None:
+        with metrics.timer("db"):
+            # A replica that does not know the code yet may just be behind
+            shard = router.shard_for(short_code)
+            db_url = await shard.replicas.read(
+                shard.async_session,
+                find_link,
+                short_code,
+                keys=(short_code,),
+                stale=lambda found: found is None,
+            )
+        if db_url is None:
+            await cache_missing(short_code)
+            raise HTTPException(status_code=404, detail="URL not found")
+        # Expired links are answered from expires_at; the scheduler deactivates them
+        record = await cache_url(db_url)
+
+    status = record.status
+    if status != "active":
+        raise HTTPException(status_code=410, detail=f"URL is {status}")
 
     # Track click
     ip_address = request.client.host if request.client else "unknown"
     user_agent = request.headers.get("user-agent", "unknown")
-    click = Click(
-        url_id=db_url.id,
-        ip_address=ip_address,
-        user_agent=user_agent,
-    )
-    db.add(click)
-    db.commit()
+    with metrics.timer("click"):
+        click_buffer.record(
+            record.url_id, ip_address, user_agent, router.index_for(short_code)
+        )
 
-    return RedirectResponse(url=str(long_url), status_code=307)
+    return RedirectResponse(url=record.long_url, status_code=307)
+
+
+async def count_unique_visitors(
+    db: AsyncSession, url_id: int, windows: dict
+) -> dict:
+    """Exact distinct visitor IPs, archived clicks included, overall and per window"""
+    now = datetime.now(IST)
+    since = {"total": None}
+    since.update({name: now - timedelta(days=days) for name, days in windows.items()})
+    if not has_archives(CLICK_ARCHIVE_DIR):
+        query = select(func.count(distinct(Click.ip_address))).where(
+            Click.url_id == url_id
+        )
+        return {
+            name: (
+                await db.execute(
+                    query if start is None else query.where(Click.timestamp >= start)
+                )
+            ).scalar()
+            for name, start in since.items()
+        }
+
+    # Archived and live clicks can share visitors, so count the union of the sets
+    query = select(distinct(Click.ip_address)).where(Click.url_id == url_id)
+    counts = {}
+    for name, start in since.items():
+        live = (
+            await db.execute(
+                query if start is None else query.where(Click.timestamp >= start)
+            )
+        ).scalars()
+        # Parquet reads block, so they run off the event loop
+        archived = await asyncio.to_thread(
+            archived_ips, url_id, start, CLICK_ARCHIVE_DIR
+        )
+        counts[name] = len(set(live) | archived)
+    return counts
 
 
 @app.get("/analytics/{short_code}")
 async def get_analytics(
     short_code: str,
-    db: Session = Depends(get_db),
-    current_user: User = Depends(get_current_user),
+    exact_unique: bool = False,
+    current_user: UserSnapshot = Depends(get_current_user),
 ):
-    db_url = db.query(URL).filter(URL.short_code == short_code).first()
-    if not db_url:
+    # Served by a replica unless the link was just created or the replica lags
+    shard = router.shard_for(short_code)
+    analytics = await shard.replicas.read(
+        shard.async_session,
+        link_analytics,
+        short_code,
+        exact_unique,
+        current_user,
+        keys=(short_code,),
+        stale=lambda found: found is None,
+    )
+    if analytics is None:
         raise HTTPException(status_code=404, detail="URL not found")
+    return analytics
 
-    # Check if user owns this URL or is admin
-    if (
-        not db.query(URL)
-        .filter(URL.id == db_url.id, URL.owner_id == current_user.id)
-        .first()
-    ):
+
+async def link_analytics(
+    db: AsyncSession, short_code: str, exact_unique: bool, current_user: UserSnapshot
+) -> dict | None:
+    db_url = await find_link(db, short_code)
+    if not db_url:
+        return None
+
+    # Check if user owns this URL
+    if db_url.owner_id != current_user.id:
         raise HTTPException(
             status_code=403, detail="Not authorized to view these analytics"
         )
 
-    # Get basic click count
-    click_count = db.query(Click).filter(Click.url_id == db_url.id).count()
+    # Get total and time-window click counts from the rollups
+    windows = await db.run_sync(click_windows, db_url.id)
 
-    # Get clicks by time periods
-    now = datetime.now(IST)
-    day_ago = now - timedelta(days=1)
-    week_ago = now - timedelta(days=7)
-    month_ago = now - timedelta(days=30)
-
-    daily_clicks = (
-        db.query(Click)
-        .filter(and_(Click.url_id == db_url.id, Click.timestamp >= day_ago))
-        .count()
-    )
-
-    weekly_clicks = (
-        db.query(Click)
-        .filter(and_(Click.url_id == db_url.id, Click.timestamp >= week_ago))
-        .count()
-    )
-
-    monthly_clicks = (
-        db.query(Click)
-        .filter(and_(Click.url_id == db_url.id, Click.timestamp >= month_ago))
-        .count()
-    )
-
-    # Get unique visitors (by IP)
-    unique_visitors = (
-        db.query(Click.ip_address).filter(Click.url_id == db_url.id).distinct().count()
-    )
+    # Get unique visitors (by IP): HyperLogLog estimate unless exact is requested
+    unique_windows = {"last_7d": 7, "last_30d": 30}
+    if exact_unique:
+        unique_visitors = await count_unique_visitors(db, db_url.id, unique_windows)
+        unique_error = 0
+    else:
+        unique_visitors, relative_error = await estimate_unique_visitors(
+            db, db_url.id, unique_windows
+        )
+        # Roughly 95% of estimates fall within two standard errors
+        unique_error = round(2 * relative_error * unique_visitors["total"])
 
-    # Get top user agents
-    top_browsers = (
-        db.query(Click.user_agent, func.count(Click.id).label("count"))
-        .filter(Click.url_id == db_url.id)
-        .group_by(Click.user_agent)
-        .order_by(func.count(Click.id).desc())
-        .limit(5)
-        .all()
-    )
+    # Get top user agents from the heavy-hitter summary
+    top_browsers = await fetch_top_items(db, db_url.id, "user_agent", 5)
 
     return {
         "long_url": db_url.long_url,
@@ -373,16 +887,62 @@ async def get_analytics(
         "is_active": db_url.is_active,
         "status": db_url.status,
         "analytics": {
-            "total_clicks": click_count,
-            "last_24h_clicks": daily_clicks,
-            "last_7d_clicks": weekly_clicks,
-            "last_30d_clicks": monthly_clicks,
-            "unique_visitors": unique_visitors,
+            **windows,
+            "unique_visitors": unique_visitors["total"],
+            "unique_visitors_last_7d": unique_visitors["last_7d"],
+            "unique_visitors_last_30d": unique_visitors["last_30d"],
+            "unique_visitors_error": unique_error,
+            "unique_visitors_exact": exact_unique,
             "top_browsers": [
-                {"browser": ua, "clicks": count} for ua, count in top_browsers
+                {"browser": ua, "clicks": count} for ua, count, _ in top_browsers
             ],
         },
     }
 
 
+@app.get("/analytics/{short_code}/clicks/export")
+async def export_click_log(
+    short_code: str,
+    format: str = Query("csv", pattern="^(csv|ndjson)$"),
+    gzip: bool = False,
+    start: datetime | None = None,
+    end: datetime | None = None,
+    current_user: UserSnapshot = Depends(get_current_user),
+):
+    """Stream the raw clicks of a link, optionally limited to [start, end)"""
+    shard = router.shard_for(short_code)
+    async with shard.async_session() as db:
+        result = await db.execute(
+            select(URL.id, URL.owner_id).where(URL.short_code == short_code)
+        )
+        db_url = result.first()
+    if not db_url:
+        raise HTTPException(status_code=404, detail="URL not found")
+    if db_url.owner_id != current_user.id:
+        raise HTTPException(
+            status_code=403, detail="Not authorized to view these analytics"
+        )
+
+    # Pending clicks would otherwise be missing from the end of the export
+    await asyncio.to_thread(click_buffer.flush)
+    filename = f"{short_code}-clicks.{format}"
+    media_type = EXPORT_MEDIA_TYPES[format]
+    if gzip:
+        filename += ".gz"
+        media_type = "application/gzip"
+    return StreamingResponse(
+        export_clicks(
+            db_url.id,
+            format,
+            gzip,
+            start,
+            end,
+            archive_dir=CLICK_ARCHIVE_DIR,
+            session_factory=shard.async_session,
+        ),
+        media_type=media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
+
+
 # uvicorn main:app --reload
@@ -0,0 +1,206 @@
+# Prometheus text-format metrics
+import bisect
+import contextvars
+import threading
+import time
+from contextlib import contextmanager
+
+from sqlalchemy import event
+
+# Seconds; the low end resolves cache hits, the high end slow analytics
+LATENCY_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50)
+
+# [queries, seconds] for the request being served, shared with its DB events
+request_queries: contextvars.ContextVar[list | None] = contextvars.ContextVar(
+    "request_queries", default=None
+)
+
+
+def format_labels(names, values) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{name}="{value}"' for name, value in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Histogram:
+    """Cumulative-bucket histogram with optional labels"""
+
+    def __init__(self, name: str, help: str, buckets=LATENCY_BUCKETS, labels=()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.labels = tuple(labels)
+        self._series: dict[tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                # Per-bucket counts, then sum and count
+                series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0, 0]
+            series[index] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            series = {labels: list(values) for labels, values in self._series.items()}
+        for labels, values in sorted(series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), values):
+                cumulative += count
+                bucket_labels = format_labels(self.labels + ("le",), labels + (bound,))
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            label_text = format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{label_text} {values[-2]}")
+            lines.append(f"{self.name}_count{label_text} {values[-1]}")
+        return lines
+
+
+class Gauge:
+    """Value read from a callback at scrape time; dict results become labelled series"""
+
+    def __init__(
+        self, name: str, help: str, read, label: str | None = None, kind="gauge"
+    ):
+        self.name = name
+        self.help = help
+        self.read = read
+        self.label = label
+        self.kind = kind
+
+    def render(self) -> list[str]:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+        value = self.read()
+        if isinstance(value, dict):
+            for key, item in value.items():
+                label_text = format_labels((self.label,), (key,))
+                lines.append(f"{self.name}{label_text} {item}")
+        elif value is not None:
+            lines.append(f"{self.name} {value}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def gauge(self, *args, **kwargs) -> Gauge:
+        metric = Gauge(*args, **kwargs)
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+class Metrics:
+    """Request, phase and query instrumentation; every hook is a no-op when disabled"""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self.registry = Registry()
+        self.request_seconds = self.registry.histogram(
+            "http_request_duration_seconds",
+            "Request latency by route template, method and status",
+            labels=("route", "method", "status"),
+        )
+        self.request_queries = self.registry.histogram(
+            "http_request_db_queries",
+            "Database queries issued while serving a request",
+            buckets=QUERY_COUNT_BUCKETS,
+            labels=("route",),
+        )
+        self.request_db_seconds = self.registry.histogram(
+            "http_request_db_seconds",
+            "Time spent in database queries while serving a request",
+            labels=("route",),
+        )
+        self.phase_seconds = self.registry.histogram(
+            "redirect_phase_seconds",
+            "Time spent in each step of the redirect handler",
+            labels=("phase",),
+        )
+
+    @contextmanager
+    def timer(self, phase: str):
+        """Time a block of the redirect path"""
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phase_seconds.observe(time.perf_counter() - start, phase)
+
+    def instrument_engine(self, target_engine):
+        """Count queries and their time against the request that issued them"""
+        if not self.enabled:
+            return
+
+        @event.listens_for(target_engine, "before_cursor_execute")
+        def before(conn, cursor, statement, parameters, context, executemany):
+            if request_queries.get() is not None:
+                conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+        @event.listens_for(target_engine, "after_cursor_execute")
+        def after(conn, cursor, statement, parameters, context, executemany):
+            totals = request_queries.get()
+            if totals is not None and conn.info.get("query_start"):
+                totals[0] += 1
+                totals[1] += time.perf_counter() - conn.info["query_start"].pop()
+
+    def render(self) -> str:
+        return self.registry.render()
+
+
+class MetricsMiddleware:
+    """ASGI middleware recording latency and DB work per route template"""
+
+    def __init__(self, app, metrics: Metrics):
+        self.app = app
+        self.metrics = metrics
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        status = [500]
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        totals = [0, 0.0]
+        token = request_queries.set(totals)
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - start
+            request_queries.reset(token)
+            route = scope.get("route")
+            # Unmatched paths share one series so scanners cannot blow up cardinality
+            path = route.path if route is not None else "unmatched"
+            self.metrics.request_seconds.observe(
+                elapsed, path, scope["method"], status[0]
+            )
+            self.metrics.request_queries.observe(totals[0], path)
+            self.metrics.request_db_seconds.observe(totals[1], path)
@@ -0,0 +1,358 @@
+# Versioned schema migrations, applied at startup
+import argparse
+import hashlib
+import zlib
+from urllib.parse import urlsplit, urlunsplit
+
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Index,
+    Integer,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    Text,
+    inspect,
+    insert,
+    select,
+    text,
+    update,
+)
+from sqlalchemy.exc import DBAPIError
+
+from models import SchemaMigration
+
+# Each step declares the tables and indexes it creates, and copies any logic
+# it runs on data, as they were when it was written; never through models.py
+# or the live modules, so a new database and an upgraded one end up with the
+# same schema and contents by the same path.
+
+
+def has_index(conn, table: str, name: str) -> bool:
+    return any(index["name"] == name for index in inspect(conn).get_indexes(table))
+
+
+def create_index(conn, index: Index):
+    if not has_index(conn, index.table.name, index.name):
+        index.create(conn)
+
+
+def drop_index(conn, table: str, name: str):
+    if has_index(conn, table, name):
+        conn.execute(text(f"DROP INDEX {name}"))
+
+
+def add_column(conn, column: Column):
+    """Add a nullable column unless it exists"""
+    existing = {c["name"] for c in inspect(conn).get_columns(column.table.name)}
+    if column.name not in existing:
+        column_type = column.type.compile(dialect=conn.dialect)
+        table = column.table.name
+        conn.execute(
+            text(f"ALTER TABLE {table} ADD COLUMN {column.name} {column_type}")
+        )
+
+
+def url_stub(metadata: MetaData) -> Table:
+    """Enough of urls for other tables' foreign keys; create_all skips it"""
+    return Table("urls", metadata, Column("id", Integer, primary_key=True))
+
+
+def baseline(conn):
+    """Users, links and clicks as first released"""
+    metadata = MetaData()
+    Table(
+        "users",
+        metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("username", String, unique=True, nullable=False),
+        Column("hashed_password", String, nullable=False),
+        Column("is_active", Boolean),
+        Column("created_at", DateTime),
+    )
+    Table(
+        "urls",
+        metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("long_url", String, nullable=False),
+        Column("short_code", String, unique=True, index=True),
+        Column("created_at", DateTime),
+        Column("expires_at", DateTime),
+        Column("is_active", Boolean),
+        # Released with a foreign key to users; left out so shards without
+        # the users table can be created
+        Column("owner_id", Integer),
+    )
+    Table(
+        "clicks",
+        metadata,
+        Column("id", Integer, primary_key=True, index=True),
+        Column("url_id", Integer, ForeignKey("urls.id")),
+        Column("timestamp", DateTime),
+        Column("ip_address", String),
+        Column("user_agent", String),
+    )
+    metadata.create_all(conn)
+
+
+def aggregate_tables(conn):
+    """Code counters, the shard map, click rollups and sketches"""
+    metadata = MetaData()
+    url_stub(metadata)
+    Table(
+        "code_counters",
+        metadata,
+        Column("name", String, primary_key=True),
+        Column("next_value", Integer, nullable=False),
+    )
+    Table(
+        "shard_slots",
+        metadata,
+        Column("slot", Integer, primary_key=True),
+        Column("shard", Integer, nullable=False),
+    )
+    for name in ("click_rollups_hourly", "click_rollups_daily"):
+        Table(
+            name,
+            metadata,
+            Column("url_id", Integer, ForeignKey("urls.id"), primary_key=True),
+            Column("bucket", DateTime, primary_key=True),
+            Column("clicks", Integer, nullable=False),
+        )
+    Table(
+        "unique_visitor_sketches",
+        metadata,
+        Column("url_id", Integer, ForeignKey("urls.id"), primary_key=True),
+        Column("bucket", DateTime, primary_key=True),
+        Column("registers", LargeBinary, nullable=False),
+    )
+    Table(
+        "heavy_hitter_sketches",
+        metadata,
+        Column("url_id", Integer, ForeignKey("urls.id"), primary_key=True),
+        Column("dimension", String, primary_key=True),
+        Column("counters", Text, nullable=False),
+    )
+    metadata.create_all(conn)
+
+
+def url_hash_v3(long_url: str) -> bytes:
+    """dedup.url_hash as released with migration 3"""
+    parts = urlsplit(long_url.strip())
+    scheme = parts.scheme.lower()
+    host = (parts.hostname or "").rstrip(".")
+    if ":" in host:
+        host = f"[{host}]"
+    try:
+        port = parts.port
+    except ValueError:
+        port = None
+    netloc = host
+    if parts.username is not None:
+        userinfo = parts.username
+        if parts.password is not None:
+            userinfo += f":{parts.password}"
+        netloc = f"{userinfo}@{netloc}"
+    if port is not None and port != {"http": 80, "https": 443}.get(scheme):
+        netloc += f":{port}"
+    path = parts.path or ("/" if netloc else "")
+    normalized = urlunsplit((scheme, netloc, path, parts.query, parts.fragment))
+    return hashlib.blake2b(normalized.encode(), digest_size=16).digest()
+
+
+def link_lookup_indexes(conn, batch_size: int = 1000):
+    """Export keyset index and the per-owner dedup hash, backfilled"""
+    metadata = MetaData()
+    clicks = Table("clicks", metadata, Column("id", Integer), Column("url_id", Integer))
+    urls = Table(
+        "urls",
+        metadata,
+        Column("id", Integer, primary_key=True),
+        Column("long_url", String),
+        Column("owner_id", Integer),
+        Column("long_url_hash", LargeBinary(16)),
+    )
+    create_index(conn, Index("ix_clicks_url_id_id", clicks.c.url_id, clicks.c.id))
+    add_column(conn, urls.c.long_url_hash)
+    create_index(
+        conn,
+        Index(
+            "ix_urls_owner_id_long_url_hash", urls.c.owner_id, urls.c.long_url_hash
+        ),
+    )
+    # Keyset batches, all inside this step's transaction
+    last_id = 0
+    while True:
+        rows = conn.execute(
+            select(urls.c.id, urls.c.long_url)
+            .where(urls.c.long_url_hash.is_(None), urls.c.id > last_id)
+            .order_by(urls.c.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        for url_id, long_url in rows:
+            conn.execute(
+                update(urls)
+                .where(urls.c.id == url_id)
+                .values(long_url_hash=url_hash_v3(long_url))
+            )
+        last_id = rows[-1].id
+
+
+def analytics_indexes(conn):
+    """Covering click indexes for unique visitors; partial index for expiry"""
+    metadata = MetaData()
+    clicks = Table(
+        "clicks",
+        metadata,
+        Column("url_id", Integer),
+        Column("timestamp", DateTime),
+        Column("ip_address", String),
+    )
+    urls = Table(
+        "urls",
+        metadata,
+        Column("expires_at", DateTime),
+        Column("is_active", Boolean),
+    )
+    create_index(
+        conn,
+        Index(
+            "ix_clicks_url_id_timestamp",
+            clicks.c.url_id,
+            clicks.c.timestamp,
+            clicks.c.ip_address,
+        ),
+    )
+    create_index(
+        conn,
+        Index("ix_clicks_url_id_ip_address", clicks.c.url_id, clicks.c.ip_address),
+    )
+    # The partial index replaces the full one on expires_at
+    create_index(
+        conn,
+        Index(
+            "ix_urls_active_expires_at",
+            urls.c.expires_at,
+            sqlite_where=text("is_active IS 1 AND expires_at IS NOT NULL"),
+            postgresql_where=text("is_active IS true AND expires_at IS NOT NULL"),
+        ),
+    )
+    drop_index(conn, "urls", "ix_urls_expires_at")
+
+
+def unique_visitor_totals(conn):
+    """All-time visitor sketches, merged once from the daily ones"""
+    metadata = MetaData()
+    url_stub(metadata)
+    totals = Table(
+        "unique_visitor_totals",
+        metadata,
+        Column("url_id", Integer, ForeignKey("urls.id"), primary_key=True),
+        Column("registers", LargeBinary, nullable=False),
+    )
+    sketches = Table(
+        "unique_visitor_sketches",
+        metadata,
+        Column("url_id", Integer),
+        Column("registers", LargeBinary),
+    )
+    totals.create(conn, checkfirst=True)
+    rows = conn.execution_options(yield_per=1000).execute(
+        select(sketches.c.url_id, sketches.c.registers)
+        .where(sketches.c.url_id.not_in(select(totals.c.url_id)))
+        .order_by(sketches.c.url_id)
+    )
+    # Sketches as released: zlib-compressed one-byte HyperLogLog registers,
+    # merged by taking the larger register
+    url_id, merged = None, None
+    for row_url_id, registers in rows:
+        registers = zlib.decompress(registers)
+        if row_url_id != url_id:
+            if merged is not None:
+                conn.execute(
+                    insert(totals),
+                    {"url_id": url_id, "registers": zlib.compress(merged)},
+                )
+            url_id, merged = row_url_id, registers
+        else:
+            merged = bytes(map(max, merged, registers))
+    if merged is not None:
+        conn.execute(
+            insert(totals), {"url_id": url_id, "registers": zlib.compress(merged)}
+        )
+
+
+# Append only: a migration's number and behaviour never change once released
+MIGRATIONS = [
+    (1, "baseline", baseline),
+    (2, "aggregate_tables", aggregate_tables),
+    (3, "link_lookup_indexes", link_lookup_indexes),
+    (4, "analytics_indexes", analytics_indexes),
+    (5, "unique_visitor_totals", unique_visitor_totals),
+]
+
+
+def applied_versions(engine) -> set[int]:
+    with engine.connect() as conn:
+        if not inspect(conn).has_table(SchemaMigration.__tablename__):
+            return set()
+        return set(conn.execute(select(SchemaMigration.version)).scalars())
+
+
+def migrate(engine, migrations=MIGRATIONS) -> list[str]:
+    """Apply pending migrations in order, each in its own transaction.
+
+    Every step checks what already exists, so databases created before
+    migrations were introduced are upgraded in place, and a step that
+    stopped halfway (SQLite commits DDL as it goes) can simply run again.
+    When several workers start together, one applies a step and the others
+    find it recorded. Returns the names of the steps this call applied.
+    """
+    SchemaMigration.__table__.create(bind=engine, checkfirst=True)
+    applied = []
+    for version, name, step in migrations:
+        if version in applied_versions(engine):
+            continue
+        try:
+            with engine.begin() as conn:
+                step(conn)
+                conn.execute(
+                    insert(SchemaMigration).values(version=version, name=name)
+                )
+        except DBAPIError:
+            # Another worker got there first; anything else is a real failure
+            if version in applied_versions(engine):
+                continue
+            raise
+        applied.append(name)
+        url = engine.url.render_as_string(hide_password=True)
+        print(f"Applied migration {version} ({name}) to {url}")
+    return applied
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply or list schema migrations")
+    parser.add_argument(
+        "command", choices=["upgrade", "status"], nargs="?", default="upgrade"
+    )
+    args = parser.parse_args()
+
+    from database import engine
+    from sharding import router
+
+    engines = [engine]
+    engines += [shard.engine for shard in router.shards if shard.engine is not engine]
+    for target in engines:
+        if args.command == "upgrade":
+            migrate(target)
+        versions = applied_versions(target)
+        print(f"{target.url.render_as_string(hide_password=True)}:")
+        for version, name, _ in MIGRATIONS:
+            state = "applied" if version in versions else "pending"
+            print(f"  {version} {name}: {state}")
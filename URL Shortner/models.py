@@ -1,4 +1,16 @@
-from sqlalchemy import Column, Integer, String, DateTime, ForeignKey, Boolean
+from sqlalchemy import (
+    Column,
+    Integer,
+    String,
+    DateTime,
+    ForeignKey,
+    Index,
+    Boolean,
+    LargeBinary,
+    Text,
+    TypeDecorator,
+    text,
+)
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.hybrid import hybrid_property
 from datetime import datetime, timezone
@@ -8,15 +20,42 @@ import pytz
 IST = pytz.timezone("Asia/Kolkata")
 
 
+def ist_naive(value: datetime) -> datetime:
+    """Datetimes are stored as IST wall-clock time without a timezone"""
+    if value.tzinfo is not None:
+        value = value.astimezone(IST).replace(tzinfo=None)
+    return value
+
+
+def now_ist() -> datetime:
+    return ist_naive(datetime.now(IST))
+
+
+class ISTDateTime(TypeDecorator):
+    """DateTime column that converts aware values to naive IST when bound.
+
+    asyncpg refuses aware datetimes for TIMESTAMP WITHOUT TIME ZONE, and
+    SQLite would store their offset; either way the column holds IST.
+    """
+
+    impl = DateTime
+    cache_ok = True
+
+    def process_bind_param(self, value, dialect):
+        return ist_naive(value) if value is not None else None
+
+
 class User(Base):
     __tablename__ = "users"
     id = Column(Integer, primary_key=True, index=True)
     username = Column(String, unique=True, nullable=False)
     hashed_password = Column(String, nullable=False)
     is_active = Column(Boolean, default=True)
-    created_at = Column(DateTime, default=lambda: datetime.now(IST))
+    created_at = Column(ISTDateTime, default=now_ist)
 
-    urls = relationship("URL", back_populates="owner")
+    urls = relationship(
+        "URL", back_populates="owner", primaryjoin="User.id == foreign(URL.owner_id)"
+    )
 
 
 class URL(Base):
@@ -24,14 +63,31 @@ class URL(Base):
     id = Column(Integer, primary_key=True, index=True)
     long_url = Column(String, nullable=False)
     short_code = Column(String, unique=True, index=True)
-    created_at = Column(DateTime, default=lambda: datetime.now(IST))
-    expires_at = Column(DateTime, nullable=True)
+    created_at = Column(ISTDateTime, default=now_ist)
+    expires_at = Column(ISTDateTime, nullable=True)
     is_active = Column(Boolean, default=True)
-
-    owner_id = Column(Integer, ForeignKey("users.id"), nullable=True)
-    owner = relationship("User", back_populates="urls")
+    # 16-byte hash of the normalized long_url, for deduplication per owner
+    long_url_hash = Column(LargeBinary(16), nullable=True)
+
+    # No foreign key: with shards, users live only in the primary database
+    owner_id = Column(Integer, nullable=True)
+    owner = relationship(
+        "User", back_populates="urls", primaryjoin="foreign(URL.owner_id) == User.id"
+    )
     clicks = relationship("Click", back_populates="url")
 
+    __table_args__ = (
+        Index("ix_urls_owner_id_long_url_hash", "owner_id", "long_url_hash"),
+        # Only links the expiry scheduler still has to deactivate; the
+        # predicate is written exactly as the scheduler's query so SQLite uses it
+        Index(
+            "ix_urls_active_expires_at",
+            "expires_at",
+            sqlite_where=text("is_active IS 1 AND expires_at IS NOT NULL"),
+            postgresql_where=text("is_active IS true AND expires_at IS NOT NULL"),
+        ),
+    )
+
     @property
     def status(self):
         """Get the current status of the URL"""
@@ -79,8 +135,85 @@ class Click(Base):
     __tablename__ = "clicks"
     id = Column(Integer, primary_key=True, index=True)
     url_id = Column(Integer, ForeignKey("urls.id"))
-    timestamp = Column(DateTime, default=lambda: datetime.now(IST))
+    timestamp = Column(ISTDateTime, default=now_ist)
     ip_address = Column(String)
     user_agent = Column(String)
 
     url = relationship("URL", back_populates="clicks")
+
+    __table_args__ = (
+        # Keyset pagination of one link's clicks for export
+        Index("ix_clicks_url_id_id", "url_id", "id"),
+        # Covering indexes for exact unique visitors: windowed and all-time
+        Index("ix_clicks_url_id_timestamp", "url_id", "timestamp", "ip_address"),
+        Index("ix_clicks_url_id_ip_address", "url_id", "ip_address"),
+    )
+
+
+class SchemaMigration(Base):
+    """Versions of migrations.py applied to this database"""
+
+    __tablename__ = "schema_migrations"
+    version = Column(Integer, primary_key=True)
+    name = Column(String, nullable=False)
+    applied_at = Column(ISTDateTime, default=now_ist)
+
+
+class CodeCounter(Base):
+    """High-water mark for block-leased short code counters"""
+
+    __tablename__ = "code_counters"
+    name = Column(String, primary_key=True)
+    next_value = Column(Integer, nullable=False, default=0)
+
+
+class ShardSlot(Base):
+    """Which shard holds the links whose codes hash into a slot"""
+
+    __tablename__ = "shard_slots"
+    slot = Column(Integer, primary_key=True)
+    shard = Column(Integer, nullable=False)
+
+
+class ClickRollupHourly(Base):
+    """Clicks per link per hour, maintained as clicks are ingested"""
+
+    __tablename__ = "click_rollups_hourly"
+    url_id = Column(Integer, ForeignKey("urls.id"), primary_key=True)
+    bucket = Column(ISTDateTime, primary_key=True)  # Start of the hour, IST
+    clicks = Column(Integer, nullable=False, default=0)
+
+
+class ClickRollupDaily(Base):
+    """Clicks per link per day, maintained as clicks are ingested"""
+
+    __tablename__ = "click_rollups_daily"
+    url_id = Column(Integer, ForeignKey("urls.id"), primary_key=True)
+    bucket = Column(ISTDateTime, primary_key=True)  # Midnight, IST
+    clicks = Column(Integer, nullable=False, default=0)
+
+
+class UniqueVisitorSketch(Base):
+    """Compressed HyperLogLog registers of visitor IPs per link per day"""
+
+    __tablename__ = "unique_visitor_sketches"
+    url_id = Column(Integer, ForeignKey("urls.id"), primary_key=True)
+    bucket = Column(ISTDateTime, primary_key=True)  # Midnight, IST
+    registers = Column(LargeBinary, nullable=False)
+
+
+class UniqueVisitorTotal(Base):
+    """All-time HyperLogLog registers of visitor IPs per link"""
+
+    __tablename__ = "unique_visitor_totals"
+    url_id = Column(Integer, ForeignKey("urls.id"), primary_key=True)
+    registers = Column(LargeBinary, nullable=False)
+
+
+class HeavyHitterSketch(Base):
+    """Space-Saving counters of the most frequent values of a click field"""
+
+    __tablename__ = "heavy_hitter_sketches"
+    url_id = Column(Integer, ForeignKey("urls.id"), primary_key=True)
+    dimension = Column(String, primary_key=True)  # e.g. "user_agent"
+    counters = Column(Text, nullable=False)  # JSON {value: [count, error]}
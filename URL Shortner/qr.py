@@ -0,0 +1,105 @@
+# QR code rendering off the event loop
+import asyncio
+import hashlib
+import io
+import threading
+from collections import OrderedDict
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+
+import qrcode
+import qrcode.image.svg
+
+MEDIA_TYPES = {"png": "image/png", "svg": "image/svg+xml"}
+
+
+def render_qr(data: str, fmt: str, box_size: int, border: int) -> bytes:
+    """Render a QR code; top-level so it can run in a process pool"""
+    qr = qrcode.QRCode(box_size=box_size, border=border)
+    qr.add_data(data)
+    qr.make(fit=True)
+    if fmt == "svg":
+        img = qr.make_image(image_factory=qrcode.image.svg.SvgPathImage)
+    else:
+        img = qr.make_image(fill_color="black", back_color="white")
+    buffered = io.BytesIO()
+    img.save(buffered)
+    return buffered.getvalue()
+
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """If-None-Match test: a list of entity tags compared weakly, or ``*``"""
+    tags = [tag.strip() for tag in if_none_match.split(",")]
+    if "*" in tags:
+        return True
+    opaque = etag.removeprefix("W/")
+    return any(tag.removeprefix("W/") == opaque for tag in tags)
+
+
+class QRRenderer:
+    """Renders QR images in an executor and keeps the most recent ones.
+
+    Entries are keyed by everything that affects the output and carry a
+    strong ETag derived from the image bytes.
+    """
+
+    def __init__(self, kind: str = "thread", workers: int = 2, cache_size: int = 1024):
+        self.kind = kind
+        self.workers = workers
+        self.cache_size = cache_size
+        self._executor: Executor | None = None
+        self._entries: OrderedDict[tuple, tuple[bytes, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def executor(self) -> Executor:
+        if self._executor is None:
+            if self.kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            elif self.kind == "thread":
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.workers, thread_name_prefix="qr"
+                )
+            else:
+                raise ValueError(f"Unknown QR_EXECUTOR: {self.kind}")
+        return self._executor
+
+    async def render(
+        self, data: str, fmt: str = "png", box_size: int = 10, border: int = 4
+    ) -> tuple[bytes, str]:
+        """Return (image bytes, ETag), rendering only on a cache miss"""
+        key = (data, fmt, box_size, border)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry
+        self.misses += 1
+        loop = asyncio.get_running_loop()
+        content = await loop.run_in_executor(
+            self.executor, render_qr, data, fmt, box_size, border
+        )
+        entry = (content, f'"{hashlib.sha256(content).hexdigest()[:32]}"')
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.cache_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    def stats(self) -> dict:
+        return {
+            "executor": self.kind,
+            "workers": self.workers,
+            "cached": len(self._entries),
+            "cache_size": self.cache_size,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
@@ -0,0 +1,265 @@
+# Token-bucket rate limiting per client and route
+import json
+import math
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+# "requests/seconds": a bucket holds that many requests and refills over the period
+RATE_LIMIT_REDIRECT = os.getenv("RATE_LIMIT_REDIRECT", "100/1")
+RATE_LIMIT_SHORTEN = os.getenv("RATE_LIMIT_SHORTEN", "30/60")
+RATE_LIMIT_BATCH = os.getenv("RATE_LIMIT_BATCH", "5/60")
+# Buckets kept in memory per worker; idle ones are dropped long before this
+RATE_LIMIT_MAX_BUCKETS = int(os.getenv("RATE_LIMIT_MAX_BUCKETS", "100000"))
+# memory (per worker) or redis (shared through REDIS_URL)
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+
+
+class Limit(NamedTuple):
+    capacity: float
+    rate: float  # tokens per second
+
+    @classmethod
+    def parse(cls, spec: str) -> "Limit | None":
+        """``"30/60"`` is 30 requests per 60 seconds; empty or ``0`` is no limit"""
+        if not spec or spec.strip() == "0":
+            return None
+        requests, _, seconds = spec.partition("/")
+        requests, seconds = float(requests), float(seconds or 1)
+        return cls(requests, requests / seconds)
+
+    @property
+    def refill_seconds(self) -> float:
+        """Time for an empty bucket to fill up again"""
+        return self.capacity / self.rate
+
+
+class MemoryBuckets:
+    """Token buckets in an LRU dict; every take is O(1).
+
+    A bucket left alone long enough to refill completely is equivalent to no
+    bucket at all, so each take drops up to two such buckets from the cold
+    end. Memory follows the number of recently active clients, and
+    ``max_size`` caps it under a flood of distinct keys.
+    """
+
+    def __init__(self, max_size: int = RATE_LIMIT_MAX_BUCKETS):
+        self.max_size = max_size
+        # key -> [tokens, last update, seconds until full]
+        self._buckets: OrderedDict[str, list] = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._buckets)
+
+    def take(self, key: str, limit: Limit, now: float | None = None) -> float:
+        """Take one token; returns 0 if allowed, else seconds until one is available"""
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = [limit.capacity, now, 0.0]
+            else:
+                self._buckets.move_to_end(key)
+                refill = (now - bucket[1]) * limit.rate
+                bucket[0] = min(limit.capacity, bucket[0] + refill)
+                bucket[1] = now
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                wait = 0.0
+            else:
+                wait = (1 - bucket[0]) / limit.rate
+            bucket[2] = (limit.capacity - bucket[0]) / limit.rate
+            self._evict(now)
+        return wait
+
+    def _evict(self, now: float):
+        for _ in range(2):
+            if len(self._buckets) <= 1:
+                return
+            key, (_, last, full_after) = next(iter(self._buckets.items()))
+            if now - last < full_after and len(self._buckets) <= self.max_size:
+                return
+            del self._buckets[key]
+            self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+
+
+# Atomic refill-and-take on a hash; Redis's clock is shared by every worker
+TAKE_SCRIPT = """
+local capacity = tonumber(ARGV[1])
+local rate = tonumber(ARGV[2])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'last')
+local tokens = tonumber(state[1]) or capacity
+local last = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - last) * rate)
+local wait = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+else
+    wait = (1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'last', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil((capacity - tokens) / rate * 1000) + 1000)
+return tostring(wait)
+"""
+
+
+class RedisBuckets:
+    """Buckets shared by all workers; idle ones expire once they would be full"""
+
+    def __init__(self, redis, prefix: str = "ratelimit:"):
+        self.redis = redis
+        self.prefix = prefix
+
+    async def take(self, key: str, limit: Limit) -> float:
+        wait = await self.redis.eval(
+            TAKE_SCRIPT, 1, self.prefix + key, limit.capacity, limit.rate
+        )
+        return float(wait)
+
+
+class RateLimiter:
+    """Per-route limits applied to a client key, IP or user.
+
+    With a shared backend the limits hold across workers; if it cannot be
+    reached the worker falls back to its own buckets rather than refusing or
+    waving through every request.
+    """
+
+    def __init__(self, limits: dict[str, Limit], shared=None, local=None):
+        self.limits = {route: limit for route, limit in limits.items() if limit}
+        self.shared = shared
+        self.local = local if local is not None else MemoryBuckets()
+        self.allowed: dict[str, int] = {route: 0 for route in self.limits}
+        self.rejected: dict[str, int] = {route: 0 for route in self.limits}
+        self.backend_errors = 0
+
+    async def check(self, route: str, client: str) -> float:
+        """0 if the request may proceed, else seconds to wait before retrying"""
+        limit = self.limits.get(route)
+        if limit is None:
+            return 0.0
+        key = f"{route}|{client}"
+        if self.shared is not None:
+            try:
+                wait = await self.shared.take(key, limit)
+            except Exception as e:
+                self.backend_errors += 1
+                print(f"Error talking to rate limit backend: {e}")
+                wait = self.local.take(key, limit)
+        else:
+            wait = self.local.take(key, limit)
+        if wait > 0:
+            self.rejected[route] += 1
+        else:
+            self.allowed[route] += 1
+        return wait
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis" if self.shared is not None else "memory",
+            "limits": {
+                route: {"requests": limit.capacity, "per_seconds": limit.refill_seconds}
+                for route, limit in self.limits.items()
+            },
+            "allowed": self.allowed,
+            "rejected": self.rejected,
+            "local_buckets": len(self.local),
+            "backend_errors": self.backend_errors,
+        }
+
+
+class RateLimitMiddleware:
+    """ASGI middleware answering 429 with Retry-After once a bucket is empty.
+
+    Requests are matched to a route template without running the router:
+    fixed paths of the app by lookup, any other single-segment GET as the
+    redirect route. Authenticated requests are keyed by user, the rest by
+    client IP. ``identify`` maps a bearer token to a user name, or None; it
+    runs on every request, so it should be a cache lookup, not a JWT check.
+    """
+
+    def __init__(self, app, limiter: RateLimiter, identify=None):
+        self.app = app
+        self.limiter = limiter
+        self.identify = identify
+        self._paths: set[str] | None = None
+
+    def route_for(self, scope) -> str | None:
+        if self._paths is None:
+            self._paths = {
+                route.path
+                for route in scope["app"].routes
+                if "{" not in getattr(route, "path", "{")
+            }
+        path = scope["path"]
+        if path in self._paths:
+            return path
+        if scope["method"] == "GET" and path.count("/") == 1 and len(path) > 1:
+            return "/{short_code}"
+        return None
+
+    def client_for(self, scope) -> str:
+        if self.identify is not None:
+            for name, value in scope["headers"]:
+                if name == b"authorization":
+                    scheme, _, token = value.decode("latin-1").partition(" ")
+                    user = self.identify(token) if scheme.lower() == "bearer" else None
+                    if user is not None:
+                        return f"user:{user}"
+                    break
+        client = scope.get("client")
+        return f"ip:{client[0] if client else 'unknown'}"
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = self.route_for(scope)
+        wait = 0.0
+        if route in self.limiter.limits:
+            wait = await self.limiter.check(route, self.client_for(scope))
+        if wait <= 0:
+            await self.app(scope, receive, send)
+            return
+        body = json.dumps({"detail": "Too many requests"}).encode()
+        await send(
+            {
+                "type": "http.response.start",
+                "status": 429,
+                "headers": [
+                    (b"content-type", b"application/json"),
+                    (b"content-length", str(len(body)).encode()),
+                    (b"retry-after", str(math.ceil(wait)).encode()),
+                ],
+            }
+        )
+        await send({"type": "http.response.body", "body": body})
+
+
+def build_limiter() -> RateLimiter:
+    limits = {
+        "/{short_code}": Limit.parse(RATE_LIMIT_REDIRECT),
+        "/shorten": Limit.parse(RATE_LIMIT_SHORTEN),
+        "/shorten/batch": Limit.parse(RATE_LIMIT_BATCH),
+    }
+    shared = None
+    if RATE_LIMIT_BACKEND == "redis":
+        from cache import REDIS_URL, shared_backend
+
+        if not REDIS_URL:
+            raise ValueError("RATE_LIMIT_BACKEND=redis needs a Redis REDIS_URL")
+        shared = RedisBuckets(shared_backend(REDIS_URL))
+    elif RATE_LIMIT_BACKEND != "memory":
+        raise ValueError(f"Unknown RATE_LIMIT_BACKEND: {RATE_LIMIT_BACKEND}")
+    return RateLimiter(limits, shared)
@@ -0,0 +1,228 @@
+# Read replicas for redirect and analytics lookups
+import argparse
+import asyncio
+import itertools
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from database import create_engines, settings
+
+# Replicas of DATABASE_URL; with SHARD_URLS, one comma-separated group per
+# shard, groups separated by ";" in shard order
+REPLICA_URLS = [
+    [url.strip() for url in group.split(",") if url.strip()]
+    for group in os.getenv("REPLICA_URLS", "").split(";")
+]
+# Seconds between health checks, and how long one may take
+REPLICA_CHECK_INTERVAL = float(os.getenv("REPLICA_CHECK_INTERVAL", "5"))
+REPLICA_CHECK_TIMEOUT = float(os.getenv("REPLICA_CHECK_TIMEOUT", "1"))
+# Seconds after a link is created during which its reads stay on the primary
+READ_YOUR_WRITES_SECONDS = float(os.getenv("READ_YOUR_WRITES_SECONDS", "5"))
+# Seconds between refreshes of SQLite backup-copy replicas by `python replicas.py`
+REPLICA_REFRESH_INTERVAL = float(os.getenv("REPLICA_REFRESH_INTERVAL", "2"))
+
+
+class Replica:
+    """One read-only copy of a database and its health"""
+
+    def __init__(self, url: str, sync_engine, aio_engine):
+        self.url = url
+        self.engine = sync_engine
+        self.async_engine = aio_engine
+        self.session = async_sessionmaker(
+            bind=aio_engine, autoflush=False, expire_on_commit=False
+        )
+        self.healthy = True
+        self.reads = 0
+        self.failures = 0
+        self.last_error: str | None = None
+
+
+class ReplicaSet:
+    """Round-robin over the healthy replicas of one database.
+
+    Reads fall back to the primary when no replica is healthy, when the
+    replica fails, or when its answer may be stale: right after a link is
+    created (``wrote``) and whenever the caller's ``stale`` check says so,
+    e.g. a code the replica does not know yet. A failed replica is skipped
+    until the next health check succeeds.
+    """
+
+    def __init__(
+        self,
+        replicas: list[Replica] = (),
+        check_interval: float = REPLICA_CHECK_INTERVAL,
+        check_timeout: float = REPLICA_CHECK_TIMEOUT,
+        window: float = READ_YOUR_WRITES_SECONDS,
+    ):
+        self.replicas = list(replicas)
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.window = window
+        self._turn = itertools.count()
+        # key -> deadline; deadlines only grow, so the oldest entry is first
+        self._recent: OrderedDict[str, float] = OrderedDict()
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+        self.primary_reads = 0
+        self.fallbacks = 0
+
+    def wrote(self, *keys: str, now: float | None = None):
+        """Keep reads of keys on the primary for the read-your-writes window"""
+        if not self.replicas or self.window <= 0:
+            return
+        deadline = (time.monotonic() if now is None else now) + self.window
+        with self._lock:
+            for key in keys:
+                self._recent.pop(key, None)
+                self._recent[key] = deadline
+
+    def recently_written(self, key: str, now: float | None = None) -> bool:
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            # Lazy eviction: drop expired entries from the front
+            while self._recent and next(iter(self._recent.values())) <= now:
+                self._recent.popitem(last=False)
+            return self._recent.get(key, 0.0) > now
+
+    def pick(self, *keys: str) -> Replica | None:
+        """Next healthy replica in turn, or None to read from the primary"""
+        healthy = [replica for replica in self.replicas if replica.healthy]
+        if not healthy or any(self.recently_written(key) for key in keys):
+            return None
+        return healthy[next(self._turn) % len(healthy)]
+
+    def mark_down(self, replica: Replica, error: Exception):
+        replica.healthy = False
+        replica.failures += 1
+        replica.last_error = str(error).splitlines()[0][:200]
+
+    async def read(self, primary, fn, *args, keys=(), stale=None):
+        """Await fn(db, *args) on a replica, or on a session from primary"""
+        replica = self.pick(*keys)
+        if replica is not None:
+            try:
+                async with replica.session() as db:
+                    result = await fn(db, *args)
+                replica.reads += 1
+                if stale is None or not stale(result):
+                    return result
+            except (DBAPIError, OSError) as e:
+                self.mark_down(replica, e)
+                print(f"Replica {replica.url} failed, reading from primary: {e}")
+            self.fallbacks += 1
+        self.primary_reads += 1
+        async with primary() as db:
+            return await fn(db, *args)
+
+    async def check(self):
+        """Probe every replica, healthy or not, with a trivial query"""
+        for replica in self.replicas:
+            try:
+                async with replica.async_engine.connect() as conn:
+                    await asyncio.wait_for(
+                        conn.execute(text("SELECT 1")), self.check_timeout
+                    )
+            except Exception as e:
+                self.mark_down(replica, e)
+            else:
+                replica.healthy = True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.check_interval)
+            await self.check()
+
+    async def start(self):
+        if self.replicas and self._task is None:
+            await self.check()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        return {
+            "replicas": [
+                {
+                    "url": replica.async_engine.url.render_as_string(
+                        hide_password=True
+                    ),
+                    "healthy": replica.healthy,
+                    "reads": replica.reads,
+                    "failures": replica.failures,
+                    "last_error": replica.last_error,
+                }
+                for replica in self.replicas
+            ],
+            "primary_reads": self.primary_reads,
+            "fallbacks": self.fallbacks,
+            "read_your_writes": len(self._recent),
+        }
+
+
+def build_replicas(urls: list[str]) -> ReplicaSet:
+    return ReplicaSet([Replica(url, *create_engines(url, settings)) for url in urls])
+
+
+def sqlite_path(url: str) -> str:
+    parsed = make_url(url)
+    if parsed.get_backend_name() != "sqlite" or not parsed.database:
+        raise ValueError(f"Not a SQLite file database: {url}")
+    return parsed.database
+
+
+def refresh_sqlite_copy(source_url: str, replica_url: str):
+    """Overwrite a SQLite replica with a consistent copy of its source.
+
+    The copy is made in place with the online backup API, so connections
+    already open on the replica see the new contents.
+    """
+    source = sqlite3.connect(sqlite_path(source_url))
+    target = sqlite3.connect(sqlite_path(replica_url), timeout=30)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Keep SQLite replicas refreshed as backup copies of their source"
+    )
+    parser.add_argument("--interval", type=float, default=REPLICA_REFRESH_INTERVAL)
+    parser.add_argument("--once", action="store_true")
+    args = parser.parse_args()
+
+    from sharding import router
+
+    pairs = [
+        (shard.url, replica.url)
+        for shard in router.shards
+        for replica in shard.replicas.replicas
+    ]
+    if not pairs:
+        parser.error("REPLICA_URLS is not set")
+    while True:
+        start = time.perf_counter()
+        for source_url, replica_url in pairs:
+            refresh_sqlite_copy(source_url, replica_url)
+        print(f"Refreshed {len(pairs)} replicas in {time.perf_counter() - start:.3f}s")
+        if args.once:
+            break
+        time.sleep(args.interval)
@@ -0,0 +1,223 @@
+# Click retention: archive old raw clicks to Parquet and delete them
+import argparse
+import os
+from datetime import datetime, timedelta
+
+from sqlalchemy import delete, select, text
+
+from models import IST, Click
+from rollups import ist_naive
+
+CLICK_RETENTION_DAYS = int(os.getenv("CLICK_RETENTION_DAYS", "90"))
+CLICK_ARCHIVE_DIR = os.getenv("CLICK_ARCHIVE_DIR", "archives")
+COLUMNS = ("id", "url_id", "timestamp", "ip_address", "user_agent")
+
+
+def archive_schema():
+    import pyarrow as pa
+
+    return pa.schema(
+        [
+            ("id", pa.int64()),
+            ("url_id", pa.int64()),
+            ("timestamp", pa.timestamp("us")),
+            ("ip_address", pa.string()),
+            ("user_agent", pa.string()),
+        ]
+    )
+
+
+def has_archives(archive_dir: str) -> bool:
+    # Sharded deployments archive each shard under shard=<index>/month=...
+    return os.path.isdir(archive_dir) and any(
+        name.startswith(("month=", "shard=")) for name in os.listdir(archive_dir)
+    )
+
+
+def write_part(archive_dir: str, month: str, rows: list[dict]) -> int:
+    """Write one Parquet file for a month; the name is derived from its id range.
+
+    Re-archiving the same rows after a crash between write and delete
+    rewrites the same file instead of duplicating it.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    directory = os.path.join(archive_dir, f"month={month}")
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, f"part-{rows[0]['id']}-{rows[-1]['id']}.parquet")
+    table = pa.Table.from_pylist(rows, schema=archive_schema())
+    tmp_path = path + ".tmp"
+    pq.write_table(table, tmp_path, compression="zstd")
+    os.replace(tmp_path, path)
+    return os.path.getsize(path)
+
+
+def archive_clicks(
+    db, cutoff: datetime, archive_dir: str = CLICK_ARCHIVE_DIR, batch_size: int = 5000
+) -> dict:
+    """Move clicks older than cutoff into monthly Parquet files.
+
+    Works through the table in id order, one batch per transaction: the
+    batch is written to disk first and then deleted, so the write lock is
+    held only for one short DELETE at a time.
+    """
+    cutoff = ist_naive(cutoff)
+    report = {"rows": 0, "files": 0, "archive_bytes": 0, "batches": 0}
+    last_id = 0
+    while True:
+        rows = db.execute(
+            select(*(getattr(Click, column) for column in COLUMNS))
+            .where(Click.id > last_id, Click.timestamp < cutoff)
+            .order_by(Click.id)
+            .limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        by_month: dict[str, list[dict]] = {}
+        for row in rows:
+            by_month.setdefault(row.timestamp.strftime("%Y-%m"), []).append(
+                row._asdict()
+            )
+        for month, month_rows in by_month.items():
+            report["archive_bytes"] += write_part(archive_dir, month, month_rows)
+            report["files"] += 1
+
+        first_id, last_id = rows[0].id, rows[-1].id
+        db.execute(
+            delete(Click).where(
+                Click.id >= first_id, Click.id <= last_id, Click.timestamp < cutoff
+            )
+        )
+        db.commit()
+        report["rows"] += len(rows)
+        report["batches"] += 1
+    return report
+
+
+def archived_dataset(archive_dir: str):
+    import pyarrow.dataset as ds
+
+    return ds.dataset(
+        archive_dir, format="parquet", partitioning="hive", schema=archive_schema()
+    )
+
+
+def iter_archived_clicks(
+    archive_dir: str = CLICK_ARCHIVE_DIR,
+    url_ids: list[int] | None = None,
+    batch_size=10_000,
+):
+    """Yield archived clicks in lists of row dicts, as ingest_clicks takes them"""
+    if not has_archives(archive_dir):
+        return
+    import pyarrow.dataset as ds
+
+    flt = ds.field("url_id").isin(url_ids) if url_ids is not None else None
+    scanner = archived_dataset(archive_dir).scanner(
+        columns=list(COLUMNS[1:]), filter=flt, batch_size=batch_size
+    )
+    for record_batch in scanner.to_batches():
+        if record_batch.num_rows:
+            yield record_batch.to_pylist()
+
+
+def archived_ips(
+    url_id: int, since: datetime | None = None, archive_dir: str = CLICK_ARCHIVE_DIR
+) -> set[str]:
+    """Distinct visitor IPs of a link among archived clicks"""
+    if not has_archives(archive_dir):
+        return set()
+    import pyarrow.dataset as ds
+
+    flt = ds.field("url_id") == url_id
+    if since is not None:
+        flt = flt & (ds.field("timestamp") >= ist_naive(since))
+    table = archived_dataset(archive_dir).to_table(columns=["ip_address"], filter=flt)
+    return set(table.column("ip_address").to_pylist())
+
+
+def database_space(db) -> dict | None:
+    """Size of the SQLite file and how much of it sits in free pages"""
+    if db.get_bind().dialect.name != "sqlite":
+        return None
+    pragma = lambda name: db.execute(text(f"PRAGMA {name}")).scalar()
+    page_size = pragma("page_size")
+    return {
+        "file_bytes": pragma("page_count") * page_size,
+        "free_bytes": pragma("freelist_count") * page_size,
+    }
+
+
+def vacuum(db):
+    """Rebuild the SQLite file to return free pages to the filesystem"""
+    db.commit()
+    with db.get_bind().connect() as conn:
+        conn.execution_options(isolation_level="AUTOCOMMIT").exec_driver_sql("VACUUM")
+
+
+def run_retention(
+    db,
+    days: int = CLICK_RETENTION_DAYS,
+    archive_dir: str = CLICK_ARCHIVE_DIR,
+    batch_size: int = 5000,
+    compact: bool = False,
+) -> dict:
+    """Archive and delete clicks older than days, and report the space reclaimed.
+
+    Without ``compact`` the deleted rows become free pages that SQLite reuses
+    for new clicks; with it the file is vacuumed, which locks the database for
+    the duration and is best run off-peak.
+    """
+    before = database_space(db)
+    cutoff = datetime.now(IST) - timedelta(days=days)
+    report = {"cutoff": ist_naive(cutoff).isoformat()}
+    report.update(archive_clicks(db, cutoff, archive_dir, batch_size))
+    if compact and before is not None:
+        vacuum(db)
+    after = database_space(db)
+    if before is not None:
+        report.update(
+            file_bytes_before=before["file_bytes"],
+            file_bytes_after=after["file_bytes"],
+            free_bytes=after["free_bytes"],
+            # Returned to the filesystem, plus pages freed for reuse by new rows
+            reclaimed_bytes=before["file_bytes"]
+            - after["file_bytes"]
+            + after["free_bytes"]
+            - before["free_bytes"],
+        )
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Archive old clicks to Parquet and delete them from the database"
+    )
+    parser.add_argument("--days", type=int, default=CLICK_RETENTION_DAYS)
+    parser.add_argument("--archive-dir", default=CLICK_ARCHIVE_DIR)
+    parser.add_argument("--batch-size", type=int, default=5000)
+    parser.add_argument(
+        "--compact", action="store_true", help="VACUUM afterwards to shrink the file"
+    )
+    args = parser.parse_args()
+
+    from sharding import router
+
+    router.prepare()
+    for shard in router.shards:
+        # Click ids are per shard, so each shard gets its own part files
+        archive_dir = args.archive_dir
+        if router.sharded:
+            archive_dir = os.path.join(archive_dir, f"shard={shard.index}")
+        db = shard.session()
+        try:
+            report = run_retention(
+                db, args.days, archive_dir, args.batch_size, args.compact
+            )
+        finally:
+            db.close()
+        if router.sharded:
+            print(f"shard {shard.index}:")
+        for key, value in report.items():
+            print(f"{key:>18}: {value}")
@@ -0,0 +1,119 @@
+# Hourly and daily click rollups
+from collections import Counter
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, delete, func, insert, or_, update
+from sqlalchemy.dialects import postgresql, sqlite
+
+from models import IST, ClickRollupDaily, ClickRollupHourly, ist_naive
+
+WINDOWS = {"last_24h_clicks": 1, "last_7d_clicks": 7, "last_30d_clicks": 30}
+
+
+def hour_bucket(value: datetime) -> datetime:
+    return ist_naive(value).replace(minute=0, second=0, microsecond=0)
+
+
+def day_bucket(value: datetime) -> datetime:
+    return ist_naive(value).replace(hour=0, minute=0, second=0, microsecond=0)
+
+
+def increment(db, model, counts: Counter):
+    """Add counts keyed by (url_id, bucket) onto a rollup table"""
+    if not counts:
+        return
+    rows = [
+        {"url_id": url_id, "bucket": bucket, "clicks": clicks}
+        for (url_id, bucket), clicks in counts.items()
+    ]
+    dialect = db.get_bind().dialect.name
+    if dialect in ("sqlite", "postgresql"):
+        upsert = sqlite.insert if dialect == "sqlite" else postgresql.insert
+        stmt = upsert(model)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[model.url_id, model.bucket],
+            set_={"clicks": model.clicks + stmt.excluded.clicks},
+        )
+        db.execute(stmt, rows)
+        return
+    for row in rows:
+        result = db.execute(
+            update(model)
+            .where(model.url_id == row["url_id"], model.bucket == row["bucket"])
+            .values(clicks=model.clicks + row["clicks"])
+        )
+        if result.rowcount == 0:
+            db.execute(insert(model).values(**row))
+
+
+def clear_rollups(db, url_ids: list[int] | None = None):
+    for model in (ClickRollupHourly, ClickRollupDaily):
+        stmt = delete(model)
+        if url_ids is not None:
+            stmt = stmt.where(model.url_id.in_(url_ids))
+        db.execute(stmt)
+
+
+def update_rollups(db, rows: list[dict]):
+    """Fold a batch of freshly ingested click rows into the rollups"""
+    hourly = Counter((row["url_id"], hour_bucket(row["timestamp"])) for row in rows)
+    daily = Counter()
+    for (url_id, bucket), clicks in hourly.items():
+        daily[(url_id, day_bucket(bucket))] += clicks
+    increment(db, ClickRollupHourly, hourly)
+    increment(db, ClickRollupDaily, daily)
+
+
+def click_windows(db, url_id: int, now: datetime | None = None) -> dict:
+    """Total clicks and 24h/7d/30d windows, to hour precision.
+
+    Each window starts at the top of the hour it would begin in. Whole days
+    are read from the daily rollup and the partial first day from the hourly
+    one, so only a few dozen rows are summed whatever the click volume.
+    """
+    now = ist_naive(now or datetime.now(IST))
+    starts = {
+        name: hour_bucket(now - timedelta(days=days)) for name, days in WINDOWS.items()
+    }
+    # First midnight at or after each window start
+    full_days = {
+        name: start if start == day_bucket(start) else day_bucket(start) + timedelta(days=1)
+        for name, start in starts.items()
+    }
+
+    total = (
+        db.query(func.coalesce(func.sum(ClickRollupDaily.clicks), 0))
+        .filter(ClickRollupDaily.url_id == url_id)
+        .scalar()
+    )
+    daily = (
+        db.query(ClickRollupDaily.bucket, ClickRollupDaily.clicks)
+        .filter(
+            ClickRollupDaily.url_id == url_id,
+            ClickRollupDaily.bucket >= min(full_days.values()),
+        )
+        .all()
+    )
+    hourly = (
+        db.query(ClickRollupHourly.bucket, ClickRollupHourly.clicks)
+        .filter(
+            ClickRollupHourly.url_id == url_id,
+            or_(
+                *[
+                    and_(
+                        ClickRollupHourly.bucket >= starts[name],
+                        ClickRollupHourly.bucket < full_days[name],
+                    )
+                    for name in WINDOWS
+                ]
+            ),
+        )
+        .all()
+    )
+
+    result = {"total_clicks": total}
+    for name in WINDOWS:
+        result[name] = sum(c for bucket, c in daily if bucket >= full_days[name]) + sum(
+            c for bucket, c in hourly if starts[name] <= bucket < full_days[name]
+        )
+    return result
@@ -0,0 +1,579 @@
+# Hash-sharded storage of links and their clicks
+import argparse
+import asyncio
+import hashlib
+import os
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+
+from database import (
+    DATABASE_URL,
+    AsyncSessionLocal,
+    SessionLocal,
+    async_engine,
+    create_engines,
+    engine,
+    settings,
+)
+from models import (
+    URL,
+    Click,
+    ClickRollupDaily,
+    ClickRollupHourly,
+    CodeCounter,
+    HeavyHitterSketch,
+    ShardSlot,
+    UniqueVisitorSketch,
+    UniqueVisitorTotal,
+)
+from migrations import migrate
+from replicas import REPLICA_URLS, ReplicaSet, build_replicas
+
+# Comma-separated database URLs, one per shard; unset keeps links in DATABASE_URL
+SHARD_URLS = [
+    url.strip() for url in os.getenv("SHARD_URLS", "").split(",") if url.strip()
+]
+# Virtual slots codes hash into; fixed for the life of a deployment
+SHARD_SLOTS = int(os.getenv("SHARD_SLOTS", "256"))
+# Seconds between reloads of the slot map written by the resharding tool
+SHARD_MAP_REFRESH = float(os.getenv("SHARD_MAP_REFRESH", "5"))
+
+# Link ids are counter * SHARD_ID_STRIDE + shard index, so they stay unique
+# when a link moves to another shard; this also caps the number of shards
+SHARD_ID_STRIDE = 64
+URL_ID_COUNTER = "url_ids"
+
+# Tables keyed by url_id that move with their link, besides raw clicks
+AGGREGATES = (
+    ClickRollupHourly,
+    ClickRollupDaily,
+    UniqueVisitorSketch,
+    UniqueVisitorTotal,
+    HeavyHitterSketch,
+)
+
+
+def slot_for(short_code: str, slots: int = SHARD_SLOTS) -> int:
+    """Stable across processes and restarts, unlike hash()"""
+    digest = hashlib.blake2b(short_code.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big") % slots
+
+
+class Shard:
+    """One database holding a share of the links, their clicks and aggregates"""
+
+    def __init__(
+        self, index: int, url: str, sync_engine, aio_engine, replicas=None
+    ):
+        self.index = index
+        self.url = url
+        self.engine = sync_engine
+        self.async_engine = aio_engine
+        # Read-only copies for redirect and analytics lookups
+        self.replicas = replicas if replicas is not None else ReplicaSet()
+        if sync_engine is engine:
+            self.session = SessionLocal
+            self.async_session = AsyncSessionLocal
+        else:
+            self.session = sessionmaker(bind=sync_engine, autoflush=False)
+            self.async_session = async_sessionmaker(
+                bind=aio_engine, autoflush=False, expire_on_commit=False
+            )
+
+
+class ShardRouter:
+    """Maps short codes to shards through a persisted slot map.
+
+    Codes hash into ``slots`` virtual slots and each slot lives on one
+    shard. The map is stored in ``shard_slots`` on the primary database, so
+    slots can be moved between shards online (see ``move_slots``); workers
+    reload it every ``refresh_interval`` seconds. With a single shard every
+    slot maps to it and nothing else changes.
+    """
+
+    def __init__(
+        self,
+        shards: list[Shard],
+        slots: int = SHARD_SLOTS,
+        refresh_interval: float = SHARD_MAP_REFRESH,
+        primary_session=SessionLocal,
+    ):
+        if len(shards) > SHARD_ID_STRIDE:
+            raise ValueError(f"At most {SHARD_ID_STRIDE} shards are supported")
+        self.shards = shards
+        self.slots = slots
+        self.refresh_interval = refresh_interval
+        self.primary_session = primary_session
+        self.slot_map = [slot % len(shards) for slot in range(slots)]
+        self._lock = threading.Lock()
+        self._task: asyncio.Task | None = None
+        self.refreshes = 0
+
+    @property
+    def sharded(self) -> bool:
+        return len(self.shards) > 1
+
+    @property
+    def id_stride(self) -> int:
+        return SHARD_ID_STRIDE if self.sharded else 1
+
+    def index_for(self, short_code: str) -> int:
+        return self.slot_map[slot_for(short_code, self.slots)]
+
+    def shard_for(self, short_code: str) -> Shard:
+        return self.shards[self.index_for(short_code)]
+
+    def async_session(self, short_code: str):
+        """AsyncSession on the shard holding short_code"""
+        return self.shard_for(short_code).async_session()
+
+    def prepare(self):
+        """Migrate every shard, persist the slot map and seed id counters"""
+        for shard in self.shards:
+            migrate(shard.engine)
+        db = self.primary_session()
+        try:
+            if db.query(ShardSlot).count() == 0:
+                try:
+                    db.execute(
+                        insert(ShardSlot),
+                        [
+                            {"slot": slot, "shard": shard}
+                            for slot, shard in enumerate(self.slot_map)
+                        ],
+                    )
+                    db.commit()
+                except IntegrityError:
+                    # Another worker wrote the map first
+                    db.rollback()
+            self.load_map(db)
+        finally:
+            db.close()
+        if self.sharded:
+            self.seed_id_counters()
+
+    def seed_id_counters(self):
+        """Start each shard's id counter above every id already in use"""
+        highest = 0
+        for shard in self.shards:
+            with shard.session() as db:
+                highest = max(highest, db.query(func.max(URL.id)).scalar() or 0)
+        for shard in self.shards:
+            with shard.session() as db:
+                exists = db.get(CodeCounter, URL_ID_COUNTER)
+                if exists is None:
+                    db.add(
+                        CodeCounter(
+                            name=URL_ID_COUNTER,
+                            next_value=highest // SHARD_ID_STRIDE + 1,
+                        )
+                    )
+                    try:
+                        db.commit()
+                    except IntegrityError:
+                        db.rollback()
+
+    def load_map(self, db=None):
+        """Read the slot map from the primary database"""
+        own = db is None
+        db = self.primary_session() if own else db
+        try:
+            rows = db.execute(select(ShardSlot.slot, ShardSlot.shard)).all()
+        finally:
+            if own:
+                db.close()
+        slot_map = list(self.slot_map)
+        for slot, shard in rows:
+            if slot < self.slots and shard < len(self.shards):
+                slot_map[slot] = shard
+        with self._lock:
+            self.slot_map = slot_map
+        self.refreshes += 1
+
+    async def next_url_ids(self, db, shard: Shard, count: int) -> list[int | None]:
+        """Ids for count new links on shard, reserved in the caller's transaction.
+
+        The counter update holds the shard's write lock until the insert
+        commits, so ids on a shard grow in commit order. Unsharded links keep
+        their autoincrement ids (``None``).
+        """
+        if not self.sharded:
+            return [None] * count
+        await db.execute(
+            update(CodeCounter)
+            .where(CodeCounter.name == URL_ID_COUNTER)
+            .values(next_value=CodeCounter.next_value + count)
+        )
+        end = (
+            await db.execute(
+                select(CodeCounter.next_value).where(
+                    CodeCounter.name == URL_ID_COUNTER
+                )
+            )
+        ).scalar_one()
+        return [
+            value * SHARD_ID_STRIDE + shard.index for value in range(end - count, end)
+        ]
+
+    async def fan_out(self, fn, *args) -> list:
+        """Await fn(db, *args) on every shard concurrently; results in shard order"""
+
+        async def run(shard):
+            async with shard.async_session() as db:
+                return await fn(db, *args)
+
+        return await asyncio.gather(*(run(shard) for shard in self.shards))
+
+    async def run_sync(self, fn, *args):
+        """Call fn with a sync session of every shard, in shard order, off the loop"""
+
+        def call():
+            sessions = [shard.session() for shard in self.shards]
+            try:
+                return fn(*sessions, *args)
+            finally:
+                for db in sessions:
+                    db.close()
+
+        return await asyncio.to_thread(call)
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await asyncio.to_thread(self.load_map)
+            except Exception as e:
+                print(f"Error reloading shard map: {e}")
+
+    async def start(self):
+        """Keep the slot map current while slots are being moved"""
+        for shard in self.shards:
+            await shard.replicas.start()
+        if self.sharded and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        for shard in self.shards:
+            await shard.replicas.stop()
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> dict:
+        slots = Counter(self.slot_map)
+        return {
+            "shards": [
+                {
+                    "index": shard.index,
+                    "url": shard.engine.url.render_as_string(hide_password=True),
+                    "slots": slots[shard.index],
+                    **shard.replicas.stats(),
+                }
+                for shard in self.shards
+            ],
+            "slots": self.slots,
+            "map_refreshes": self.refreshes,
+        }
+
+
+def build_router(
+    urls: list[str] = SHARD_URLS, replica_urls: list[list[str]] = REPLICA_URLS
+) -> ShardRouter:
+    """Router over SHARD_URLS; the primary engines are reused for DATABASE_URL"""
+    urls = urls or [DATABASE_URL]
+    if len(replica_urls) > len(urls):
+        raise ValueError("REPLICA_URLS has more groups than there are shards")
+    shards = []
+    for index, url in enumerate(urls):
+        engines = (
+            (engine, async_engine)
+            if url == DATABASE_URL
+            else create_engines(url, settings)
+        )
+        replicas = build_replicas(
+            replica_urls[index] if index < len(replica_urls) else []
+        )
+        shards.append(Shard(index, url, *engines, replicas))
+    return ShardRouter(shards)
+
+
+router = build_router()
+
+
+def chunks(values: list, size: int = 500):
+    for start in range(0, len(values), size):
+        yield values[start : start + size]
+
+
+def slot_links(db, router: ShardRouter, slots: set[int]) -> list[int]:
+    """Ids of the links on db whose codes hash into slots"""
+    ids = []
+    last_id = None
+    while True:
+        query = select(URL.id, URL.short_code).order_by(URL.id).limit(10_000)
+        if last_id is not None:
+            query = query.where(URL.id > last_id)
+        rows = db.execute(query).all()
+        if not rows:
+            return ids
+        ids.extend(
+            url_id
+            for url_id, short_code in rows
+            if slot_for(short_code, router.slots) in slots
+        )
+        last_id = rows[-1].id
+
+
+def click_rows(rows) -> list[dict]:
+    """Clicks get new ids on the target shard; their order is kept"""
+    return [
+        {
+            "url_id": row.url_id,
+            "timestamp": row.timestamp,
+            "ip_address": row.ip_address,
+            "user_agent": row.user_agent,
+        }
+        for row in rows
+    ]
+
+
+CLICK_COLUMNS = (
+    Click.id,
+    Click.url_id,
+    Click.timestamp,
+    Click.ip_address,
+    Click.user_agent,
+)
+
+
+def copy_snapshot(
+    source, target, url_ids: list[int], batch_size: int
+) -> tuple[int, int]:
+    """Copy links and their clicks up to the current highest click id.
+
+    Returns (clicks copied, highest source click id covered). The source's
+    aggregates are not copied: its reads are separate statements, not one
+    snapshot, so they could already count clicks above the high-water mark
+    that ``catch_up`` copies again. They are rebuilt on the target from
+    exactly the clicks copied, plus archived ones. Leftovers of an earlier
+    attempt that failed before the slot map changed are removed first.
+    """
+    from clicks import rebuild_aggregates
+
+    purge(target, url_ids, batch_size)
+    high_water = source.execute(select(func.max(Click.id))).scalar() or 0
+    copied = 0
+    for ids in chunks(url_ids):
+        table = URL.__table__
+        rows = source.execute(select(table).where(table.c.id.in_(ids))).all()
+        target.execute(insert(table), [row._asdict() for row in rows])
+        last_id = 0
+        while True:
+            rows = source.execute(
+                select(*CLICK_COLUMNS)
+                .where(
+                    Click.url_id.in_(ids), Click.id > last_id, Click.id <= high_water
+                )
+                .order_by(Click.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            target.execute(insert(Click), click_rows(rows))
+            copied += len(rows)
+            last_id = rows[-1].id
+        rebuild_aggregates(target, ids, batch_size)
+    source.rollback()
+    return copied, high_water
+
+
+def catch_up(source, target, url_ids: list[int], high_water: int, batch_size: int):
+    """Copy clicks written to source after the snapshot, with their aggregates"""
+    from clicks import ingest_clicks
+
+    copied = 0
+    for ids in chunks(url_ids):
+        # Links deactivated on the old shard stay deactivated
+        inactive = source.execute(
+            select(URL.id).where(URL.id.in_(ids), URL.is_active.is_(False))
+        ).scalars().all()
+        if inactive:
+            target.execute(
+                update(URL).where(URL.id.in_(inactive)).values(is_active=False)
+            )
+        last_id = high_water
+        while True:
+            rows = source.execute(
+                select(*CLICK_COLUMNS)
+                .where(Click.url_id.in_(ids), Click.id > last_id)
+                .order_by(Click.id)
+                .limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            last_id = rows[-1].id
+            ingest_clicks(target, click_rows(rows))
+            copied += len(rows)
+        target.commit()
+    return copied
+
+
+def purge(db, url_ids: list[int], batch_size: int):
+    """Delete moved links and everything hanging off them, in short transactions"""
+    for ids in chunks(url_ids):
+        while True:
+            click_ids = db.execute(
+                select(Click.id).where(Click.url_id.in_(ids)).limit(batch_size)
+            ).scalars().all()
+            if not click_ids:
+                break
+            db.execute(delete(Click).where(Click.id.in_(click_ids)))
+            db.commit()
+        for model in AGGREGATES:
+            db.execute(delete(model).where(model.url_id.in_(ids)))
+        db.execute(delete(URL).where(URL.id.in_(ids)))
+        db.commit()
+
+
+def move_slots(
+    router: ShardRouter,
+    slots: set[int],
+    target: int,
+    grace: float = 2 * SHARD_MAP_REFRESH + 1,
+    batch_size: int = 5000,
+) -> dict:
+    """Move every link in slots to the target shard while the service keeps running.
+
+    1. Copy the links and clicks of each source and rebuild their aggregates.
+    2. Point the slots at the target in the primary slot map.
+    3. Wait ``grace`` seconds for every worker to reload the map and flush
+       clicks it buffered for the old shard.
+    4. Copy links created and clicks written on the source since the snapshot.
+    5. Delete the moved rows from the source.
+    6. Drop cached "not found" entries for the links created late.
+
+    Between 2 and 4 the target can miss clicks still landing on the source;
+    they show up in analytics once the catch-up has run. Links created on the
+    source in that window answer 404 from the target until step 6; without a
+    shared cache, workers forget the miss after ``NEGATIVE_CACHE_TTL``.
+    """
+    from cache import invalidate
+
+    start = time.perf_counter()
+    router.load_map()
+    report = {"slots": 0, "links": 0, "clicks": 0}
+    late_codes = []
+    by_source: dict[int, set[int]] = {}
+    for slot in slots:
+        source = router.slot_map[slot]
+        if source != target:
+            by_source.setdefault(source, set()).add(slot)
+
+    moved = {}
+    target_shard = router.shards[target]
+    for source_index, source_slots in by_source.items():
+        source_shard = router.shards[source_index]
+        with source_shard.session() as source, target_shard.session() as dest:
+            url_ids = slot_links(source, router, source_slots)
+            clicks, high_water = copy_snapshot(source, dest, url_ids, batch_size)
+        moved[source_index] = (url_ids, high_water)
+        report["clicks"] += clicks
+
+    moving = [slot for group in by_source.values() for slot in group]
+    with router.primary_session() as db:
+        db.execute(
+            update(ShardSlot).where(ShardSlot.slot.in_(moving)).values(shard=target)
+        )
+        db.commit()
+    router.load_map()
+    time.sleep(grace)
+
+    for source_index, (url_ids, high_water) in moved.items():
+        source_shard = router.shards[source_index]
+        with source_shard.session() as source, target_shard.session() as dest:
+            # Links created on the old shard by workers that had not reloaded yet
+            late = sorted(
+                set(slot_links(source, router, by_source[source_index])) - set(url_ids)
+            )
+            if late:
+                clicks, _ = copy_snapshot(source, dest, late, batch_size)
+                report["clicks"] += clicks
+                late_codes += dest.execute(
+                    select(URL.short_code).where(URL.id.in_(late))
+                ).scalars().all()
+            report["clicks"] += catch_up(source, dest, url_ids, high_water, batch_size)
+            purge(source, url_ids + late, batch_size)
+        report["links"] += len(url_ids) + len(late)
+        report["slots"] += len(by_source[source_index])
+    if late_codes:
+        asyncio.run(invalidate(*late_codes))
+    report["seconds"] = round(time.perf_counter() - start, 3)
+    return report
+
+
+def rebalance_plan(router: ShardRouter) -> dict[int, set[int]]:
+    """Slots to move to each shard so every shard holds an even share"""
+    counts = Counter(router.slot_map)
+    share, extra = divmod(router.slots, len(router.shards))
+    wanted = {shard.index: share + (shard.index < extra) for shard in router.shards}
+    surplus = []
+    for slot, shard in enumerate(router.slot_map):
+        if counts[shard] > wanted[shard]:
+            surplus.append(slot)
+            counts[shard] -= 1
+    plan: dict[int, set[int]] = {}
+    for shard in router.shards:
+        while counts[shard.index] < wanted[shard.index]:
+            plan.setdefault(shard.index, set()).add(surplus.pop())
+            counts[shard.index] += 1
+    return plan
+
+
+def parse_slots(text: str) -> set[int]:
+    slots = set()
+    for part in text.split(","):
+        first, _, last = part.partition("-")
+        slots.update(range(int(first), int(last or first) + 1))
+    return slots
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect and move link shards")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="Slots and links per shard")
+    move = commands.add_parser("move", help="Move slots to a shard")
+    move.add_argument("--slots", required=True, help="e.g. 0-15,40")
+    move.add_argument("--to", type=int, required=True)
+    rebalance = commands.add_parser(
+        "rebalance", help="Spread slots evenly, e.g. after adding a shard"
+    )
+    for command in (move, rebalance):
+        command.add_argument("--grace", type=float, default=2 * SHARD_MAP_REFRESH + 1)
+        command.add_argument("--batch-size", type=int, default=5000)
+    args = parser.parse_args()
+
+    router.prepare()
+    if args.command == "move":
+        slots = parse_slots(args.slots)
+        print(move_slots(router, slots, args.to, args.grace, args.batch_size))
+    elif args.command == "rebalance":
+        for target, slots in rebalance_plan(router).items():
+            print(f"Moving {len(slots)} slots to shard {target}")
+            print(move_slots(router, slots, target, args.grace, args.batch_size))
+    for shard in router.stats()["shards"]:
+        with router.shards[shard["index"]].session() as db:
+            links = db.query(func.count(URL.id)).scalar()
+        print(
+            f"shard {shard['index']}: {shard['slots']} slots, {links} links, "
+            f"{shard['url']}"
+        )
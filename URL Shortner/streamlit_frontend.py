@@ -95,11 +95,12 @@ else:
         with col2:
             expiry_minutes = st.number_input("Expiry in minutes (optional)", min_value=0, value=0)
             st.write("Leave both expiry fields empty for no expiration")
+            dedupe = st.checkbox("Reuse my existing short link for this URL")
 
         submit_shorten = st.form_submit_button("Shorten URL")
         if submit_shorten:
             headers = {"Authorization": f"Bearer {st.session_state.auth_token}"}
-            payload = {"long_url": long_url}
+            payload = {"long_url": long_url, "dedupe": dedupe}
             
             if custom_code:
                 payload["custom_code"] = custom_code
@@ -115,6 +116,8 @@ else:
                 if response.status_code == 200:
                     data = response.json()
                     st.success(f"Shortened URL: {data['short_url']}")
+                    if data.get('deduplicated'):
+                        st.info("You already had a link for this URL, so it was reused")
                     
                     # Display QR Code if available
                     if 'qr_code' in data:
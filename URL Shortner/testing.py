@@ -1,14 +1,270 @@
 import unittest
 from fastapi.testclient import TestClient
-from main import app
-from database import SessionLocal, engine
-from models import Base, URL, Click
-from datetime import datetime, timedelta
+from main import (
+    ADMIN_USERS,
+    app,
+    click_buffer,
+    code_filter,
+    create_access_token,
+    expiry_scheduler,
+    get_current_user,
+    metrics,
+    password_hasher,
+    rate_limiter,
+    token_cache,
+    token_user,
+)
+from database import (
+    SessionLocal,
+    async_engine,
+    create_engines,
+    effective_settings,
+    engine,
+    load_settings,
+    sync_url,
+)
+from models import (
+    Base,
+    URL,
+    Click,
+    ClickRollupDaily,
+    ClickRollupHourly,
+    UniqueVisitorSketch,
+    UniqueVisitorTotal,
+    HeavyHitterSketch,
+    IST,
+    ShardSlot,
+    User,
+)
+from allocator import (
+    FeistelCodeAllocator,
+    FeistelPermutation,
+    base62_decode,
+    base62_encode,
+)
+from clicks import ClickBuffer, ingest_clicks, rebuild_aggregates
+from rollups import click_windows
+from hll import HyperLogLog, estimate_unique_visitors, unique_visitors
+from heavy_hitters import SpaceSaving, top_items
+from bloom import BloomFilter, ShortCodeFilter
+from cache import (
+    NOT_FOUND,
+    CachedURL,
+    LRUCache,
+    TwoTierCache,
+    cache,
+    cache_missing,
+    get_cached_url,
+    ttl_for,
+)
+from qr import QRRenderer, etag_matches
+from expiry import ExpiryScheduler
+from warmup import ranked_links, warm_cache
+from utils import validate_custom_code
+from metrics import Histogram, Metrics
+from auth_cache import TokenCache, UserSnapshot
+from hashing import HashingPoolFull, PasswordHasher
+from retention import archive_clicks, archived_ips, run_retention
+from export import export_clicks, live_click_pages
+from dedup import backfill_hashes, duplicate_query, normalize_url, url_hash
+from migrations import MIGRATIONS, applied_versions, migrate
+from ratelimit import Limit, MemoryBuckets, RateLimiter
+from replicas import Replica, ReplicaSet, refresh_sqlite_copy
+from sharding import (
+    SHARD_ID_STRIDE,
+    Shard,
+    ShardRouter,
+    move_slots,
+    rebalance_plan,
+    router,
+    slot_for,
+)
+from database import AsyncSessionLocal
+from rollups import ist_naive
+import time
+from sqlalchemy import event, insert, inspect, select, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.asyncio import async_sessionmaker
+from sqlalchemy.orm import sessionmaker
+import asyncio
+import csv
+import fnmatch
+import gzip
+import json
+import os
+import random
+import tempfile
+from collections import Counter
+from unittest import mock
+from datetime import datetime, timedelta, timezone
 
 client = TestClient(app)
 Base.metadata.create_all(bind=engine)
 
 
+def authenticate(username="testuser", password="testpass"):
+    """Register (if needed) and log in, attaching the token to the test client"""
+    client.post("/register", json={"username": username, "password": password})
+    response = client.post(
+        "/token", data={"username": username, "password": password}
+    )
+    client.headers["Authorization"] = f"Bearer {response.json()['access_token']}"
+
+
+authenticate()
+ADMIN_USERS.add("testuser")
+
+
+class QueryRecorder:
+    """Collect SQL statements executed on the engine inside a with-block"""
+
+    engines = (engine, async_engine.sync_engine)
+
+    def __enter__(self):
+        self.statements = []
+        for target in self.engines:
+            event.listen(target, "before_cursor_execute", self._record)
+        return self
+
+    def __exit__(self, *exc):
+        for target in self.engines:
+            event.remove(target, "before_cursor_execute", self._record)
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        self.statements.append(statement)
+
+
+def query_plan(db, statement) -> str:
+    """SQLite's EXPLAIN QUERY PLAN for a SQLAlchemy statement, as one string"""
+    compiled = statement.compile(dialect=db.get_bind().dialect)
+    params = tuple(compiled.params[name] for name in compiled.positiontup)
+    rows = db.connection().exec_driver_sql(
+        f"EXPLAIN QUERY PLAN {compiled.string}", params
+    )
+    return " | ".join(row[-1] for row in rows)
+
+
+class PlanRecorder(QueryRecorder):
+    """Query plans of the SELECTs executed inside a with-block"""
+
+    def _record(self, conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            self.statements.append((statement, parameters))
+
+    def plans(self, db) -> list[str]:
+        conn = db.connection()
+        return [
+            " | ".join(
+                row[-1]
+                for row in conn.exec_driver_sql(
+                    f"EXPLAIN QUERY PLAN {statement}", tuple(parameters)
+                )
+            )
+            for statement, parameters in self.statements
+        ]
+
+
+class FakeRedis:
+    """In-memory stand-in for the subset of redis.asyncio.Redis the cache uses.
+
+    One instance shared by several caches behaves like one Redis server
+    shared by several workers, pub/sub included.
+    """
+
+    def __init__(self):
+        self._data: dict[str, tuple[bytes, float | None]] = {}
+        self._subscribers: dict[str, list[asyncio.Queue]] = {}
+
+    async def get(self, key: str):
+        entry = self._data.get(key)
+        if entry is None or (entry[1] is not None and entry[1] <= time.time()):
+            self._data.pop(key, None)
+            return None
+        return entry[0]
+
+    async def set(self, key: str, value, px: int | None = None):
+        if isinstance(value, str):
+            value = value.encode()
+        self._data[key] = (value, time.time() + px / 1000 if px else None)
+        return True
+
+    async def delete(self, *keys):
+        keys = [key.decode() if isinstance(key, bytes) else key for key in keys]
+        return sum(self._data.pop(key, None) is not None for key in keys)
+
+    async def scan_iter(self, match: str = "*", count: int | None = None):
+        for key in list(self._data):
+            if fnmatch.fnmatchcase(key, match):
+                yield key.encode()
+
+    async def publish(self, channel: str, message):
+        if isinstance(message, str):
+            message = message.encode()
+        queues = self._subscribers.get(channel, [])
+        for queue in queues:
+            queue.put_nowait({"type": "message", "channel": channel, "data": message})
+        return len(queues)
+
+    def pipeline(self):
+        return FakePipeline(self)
+
+    def pubsub(self):
+        return FakePubSub(self)
+
+
+class FakePipeline:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self._commands = []
+
+    def set(self, key: str, value, px: int | None = None):
+        self._commands.append((key, value, px))
+        return self
+
+    async def execute(self):
+        return [await self.redis.set(*command) for command in self._commands]
+
+
+class FakePubSub:
+    def __init__(self, redis: FakeRedis):
+        self.redis = redis
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.channels: list[str] = []
+
+    async def subscribe(self, *channels: str):
+        for channel in channels:
+            self.redis._subscribers.setdefault(channel, []).append(self.queue)
+            self.channels.append(channel)
+
+    async def get_message(self, ignore_subscribe_messages=True, timeout=1.0):
+        try:
+            return await asyncio.wait_for(self.queue.get(), timeout)
+        except asyncio.TimeoutError:
+            return None
+
+    async def aclose(self):
+        for channel in self.channels:
+            self.redis._subscribers[channel].remove(self.queue)
+        self.channels = []
+
+
+def reset_database(db):
+    """Drain buffered clicks, clear the cache and delete all links and clicks"""
+    click_buffer.flush()
+    asyncio.run(cache.clear())
+    for model in (
+        ClickRollupHourly,
+        ClickRollupDaily,
+        UniqueVisitorSketch,
+        UniqueVisitorTotal,
+        HeavyHitterSketch,
+        Click,
+        URL,
+    ):
+        db.query(model).delete()
+    db.commit()
+
+
 def create_dummy_url(
     db,
     long_url="https://example.com",
@@ -16,12 +272,14 @@ def create_dummy_url(
     expires_at=None,
     is_active=True,
 ):
+    owner = db.query(User).filter(User.username == "testuser").first()
     url = URL(
         long_url=long_url,
         short_code=short_code,
         created_at=datetime.now(),
         expires_at=expires_at,
         is_active=is_active,
+        owner_id=owner.id if owner else None,
     )
     db.add(url)
     db.commit()
@@ -33,9 +291,7 @@ class TestURLShortener(unittest.TestCase):
 
     def setUp(self):
         self.db = SessionLocal()
-        self.db.query(Click).delete()
-        self.db.query(URL).delete()
-        self.db.commit()
+        reset_database(self.db)
 
     def tearDown(self):
         self.db.close()
@@ -96,6 +352,7 @@ class TestURLShortener(unittest.TestCase):
         url = create_dummy_url(self.db, short_code="track123")
         initial_clicks = self.db.query(Click).filter(Click.url_id == url.id).count()
         client.get(f"/{url.short_code}")
+        click_buffer.flush()
         final_clicks = self.db.query(Click).filter(Click.url_id == url.id).count()
         self.assertEqual(final_clicks, initial_clicks + 1)
 
@@ -156,6 +413,7 @@ class TestURLShortener(unittest.TestCase):
         for case in test_cases:
             headers = {"user-agent": case["agent"]}
             client.get(f"/{url.short_code}", headers=headers)
+        click_buffer.flush()
 
         final_clicks = self.db.query(Click).filter(Click.url_id == url.id).count()
         self.assertEqual(final_clicks, initial_clicks + len(test_cases))
@@ -249,5 +507,1988 @@ class TestURLShortener(unittest.TestCase):
         self.assertIn("expired", response.text.lower())
 
 
+class TestShortCodeAllocator(unittest.TestCase):
+
+    def test_base62_round_trip(self):
+        for value in [0, 1, 61, 62, 123456789]:
+            self.assertEqual(base62_decode(base62_encode(value, 6)), value)
+        with self.assertRaises(ValueError):
+            base62_encode(62**2, 2)
+
+    def test_permutation_is_bijection(self):
+        permutation = FeistelPermutation(b"key", 62**2)
+        images = {permutation.permute(i) for i in range(62**2)}
+        self.assertEqual(images, set(range(62**2)))
+
+    def test_codes_unique_and_grow_with_density(self):
+        allocator = FeistelCodeAllocator(
+            b"key", min_length=2, max_fill=0.5, block_size=100, counter_name="test"
+        )
+        self.assertEqual(allocator.tier_for(0), (2, 0))
+        self.assertEqual(allocator.tier_for(62**2 // 2), (3, 0))
+
+        codes = [allocator.code_for(n) for n in range(62**2)]
+        self.assertEqual(len(set(codes)), len(codes))
+        self.assertEqual({len(c) for c in codes[: 62**2 // 2]}, {2})
+        self.assertEqual({len(c) for c in codes[62**2 // 2 :]}, {3})
+        self.assertNotEqual(codes[:5], sorted(codes[:5]))
+
+    def test_block_leases_do_not_overlap(self):
+        first = FeistelCodeAllocator(b"key", block_size=10, counter_name="lease")
+        second = FeistelCodeAllocator(b"key", block_size=10, counter_name="lease")
+        values = [first.next_counter() for _ in range(15)]
+        values += [second.next_counter() for _ in range(15)]
+        self.assertEqual(len(set(values)), len(values))
+
+    def test_shorten_runs_no_existence_query(self):
+        with QueryRecorder() as recorder:
+            response = client.post("/shorten", json={"long_url": "https://test.com"})
+        self.assertEqual(response.status_code, 200)
+        lookups = [s for s in recorder.statements if "urls.short_code =" in s]
+        self.assertEqual(lookups, [])
+
+    def test_duplicate_custom_code_rejected(self):
+        payload = {"long_url": "https://test.com", "custom_code": "dupe1234"}
+        self.assertEqual(client.post("/shorten", json=payload).status_code, 200)
+        response = client.post("/shorten", json=payload)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("already exists", response.text)
+
+    def test_route_names_rejected_as_custom_codes(self):
+        for code in ("urls", "metrics", "Admin", "analytics", "shorten"):
+            payload = {"long_url": "https://test.com", "custom_code": code}
+            response = client.post("/shorten", json=payload)
+            self.assertEqual(response.status_code, 400, code)
+        self.assertTrue(validate_custom_code("urls2"))
+
+
+class TestClickBuffer(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+        self.url = create_dummy_url(self.db, short_code="buffer123")
+
+    def tearDown(self):
+        self.db.close()
+
+    def count_clicks(self):
+        return self.db.query(Click).filter(Click.url_id == self.url.id).count()
+
+    def test_redirect_does_not_write_click(self):
+        with QueryRecorder() as recorder:
+            response = client.get("/buffer123", follow_redirects=False)
+        self.assertEqual(response.status_code, 307)
+        self.assertFalse(any("INSERT INTO clicks" in s for s in recorder.statements))
+        self.assertEqual(click_buffer.flush(), 1)
+        self.assertEqual(self.count_clicks(), 1)
+
+    def test_flush_writes_in_batches(self):
+        buffer = ClickBuffer(batch_size=4)
+        for i in range(10):
+            buffer.record(self.url.id, f"10.0.0.{i}", "Agent")
+        self.assertEqual(buffer.flush(), 10)
+        self.assertEqual(buffer.batches, 3)
+        self.assertEqual(self.count_clicks(), 10)
+
+    def test_full_buffer_drops_and_counts(self):
+        buffer = ClickBuffer(max_size=3)
+        results = [buffer.record(self.url.id, "1.1.1.1", "Agent") for _ in range(5)]
+        self.assertEqual(results, [True, True, True, False, False])
+        self.assertEqual(buffer.stats()["dropped"], 2)
+        self.assertEqual(len(buffer), 3)
+
+    def test_background_task_flushes_and_stop_drains(self):
+        async def scenario():
+            buffer = ClickBuffer(batch_size=2, flush_interval=0.05)
+            await buffer.start()
+            buffer.record(self.url.id, "1.1.1.1", "Agent")
+            await asyncio.sleep(0.2)
+            flushed_by_timer = buffer.flushed
+            buffer.record(self.url.id, "1.1.1.2", "Agent")
+            await buffer.stop()
+            return flushed_by_timer, buffer.flushed
+
+        by_timer, total = asyncio.run(scenario())
+        self.assertEqual(by_timer, 1)
+        self.assertEqual(total, 2)
+        self.assertEqual(self.count_clicks(), 2)
+
+    def test_bad_click_is_dropped_after_retries(self):
+        buffer = ClickBuffer(batch_size=10, max_retries=2)
+        buffer.record(self.url.id, "1.1.1.1", "Agent")
+        buffer.record(self.url.id, object(), "Agent")  # cannot be bound
+        buffer.record(self.url.id, "1.1.1.2", "Agent")
+        self.assertEqual(buffer.flush(), 0)
+        self.assertEqual(len(buffer), 3)
+        # Out of retries, the good clicks are written one by one
+        self.assertEqual(buffer.flush(), 2)
+        self.assertEqual(len(buffer), 0)
+        self.assertEqual(buffer.stats()["dead_lettered"], 1)
+        self.assertEqual(self.count_clicks(), 2)
+
+    def test_outage_keeps_clicks_and_backs_off(self):
+        buffer = ClickBuffer(batch_size=10, max_retries=2, max_backoff=4.0)
+        for i in range(3):
+            buffer.record(self.url.id, f"10.0.0.{i}", "Agent")
+        outage = OperationalError("INSERT", {}, Exception("database is locked"))
+        with mock.patch("clicks.ingest_clicks", side_effect=outage):
+            delays = []
+            for _ in range(5):
+                self.assertEqual(buffer.flush(), 0)
+                delays.append(buffer.retry_delay())
+        # Well past max_retries, yet nothing is dropped while the database is down
+        self.assertEqual(len(buffer), 3)
+        self.assertEqual(buffer.stats()["dead_lettered"], 0)
+        self.assertEqual(delays, [1.0, 2.0, 4.0, 4.0, 4.0])
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(buffer.retry_delay(), 0.0)
+        self.assertEqual(self.count_clicks(), 3)
+
+
+class TestRedirectCache(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_cache_hit_skips_database(self):
+        create_dummy_url(self.db, long_url="https://cached.com", short_code="cached1")
+        client.get("/cached1", follow_redirects=False)
+        with QueryRecorder() as recorder:
+            response = client.get("/cached1", follow_redirects=False)
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(response.headers["location"], "https://cached.com")
+        self.assertEqual(recorder.statements, [])
+
+    def test_cached_record_is_compact(self):
+        url = create_dummy_url(self.db, short_code="record1")
+        client.get("/record1", follow_redirects=False)
+        record = asyncio.run(get_cached_url("record1"))
+        self.assertEqual(
+            record, CachedURL("https://example.com", url.id, True, None)
+        )
+
+    def test_unknown_code_negatively_cached(self):
+        self.assertEqual(client.get("/nosuchcode").status_code, 404)
+        self.assertEqual(asyncio.run(get_cached_url("nosuchcode")), NOT_FOUND)
+        with QueryRecorder() as recorder:
+            self.assertEqual(client.get("/nosuchcode").status_code, 404)
+        self.assertEqual(recorder.statements, [])
+
+    def test_shorten_replaces_negative_entry(self):
+        client.get("/fresh1234")
+        response = client.post(
+            "/shorten", json={"long_url": "https://new.com", "custom_code": "fresh1234"}
+        )
+        self.assertEqual(response.status_code, 200)
+        with QueryRecorder() as recorder:
+            response = client.get("/fresh1234", follow_redirects=False)
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(recorder.statements, [])
+
+    def test_ttl_capped_at_expiry(self):
+        now = 1_000_000.0
+        expiring = CachedURL("https://a.com", 1, True, now + 90)
+        self.assertEqual(ttl_for(expiring, now), 90)
+        self.assertEqual(ttl_for(CachedURL("https://a.com", 1, True, None), now), 3600)
+        self.assertEqual(ttl_for(CachedURL("https://a.com", 1, False, None), now), 30)
+
+    def test_inactive_served_from_cache(self):
+        create_dummy_url(self.db, short_code="gone1234", is_active=False)
+        client.get("/gone1234")
+        with QueryRecorder() as recorder:
+            response = client.get("/gone1234")
+        self.assertEqual(response.status_code, 410)
+        self.assertEqual(recorder.statements, [])
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+
+    def tearDown(self):
+        code_filter.bloom = None
+        self.db.close()
+
+    def test_no_false_negatives_and_bounded_false_positives(self):
+        bloom = BloomFilter(10_000, error_rate=0.01)
+        for i in range(10_000):
+            bloom.add(f"code{i}")
+        self.assertTrue(all(f"code{i}" in bloom for i in range(10_000)))
+        false_positives = sum(f"other{i}" in bloom for i in range(10_000))
+        self.assertLess(false_positives / 10_000, 0.02)
+        self.assertAlmostEqual(bloom.false_positive_rate, 0.01, delta=0.005)
+
+    def test_unknown_code_rejected_without_database(self):
+        create_dummy_url(self.db, short_code="known123")
+        code_filter.load(self.db)
+        code_filter.sync_interval = 60
+        with QueryRecorder() as recorder:
+            response = client.get("/zZ9qQ1")
+            response = client.get("/wp-login")
+        self.assertEqual(response.status_code, 404)
+        self.assertEqual(recorder.statements, [])
+        response = client.get("/known123", follow_redirects=False)
+        self.assertEqual(response.status_code, 307)
+
+    def test_codes_from_other_workers_found_after_sync(self):
+        code_filter.load(self.db)
+        code_filter.sync_interval = 0
+        create_dummy_url(self.db, short_code="elsewhere1")
+        response = client.get("/elsewhere1", follow_redirects=False)
+        self.assertEqual(response.status_code, 307)
+
+    def test_late_committed_code_found_by_lookup(self):
+        create_dummy_url(self.db, short_code="early1")
+        code_filter.load(self.db)
+        code_filter.sync_interval = 0
+        # Committed after a higher id was synced, like a slow transaction
+        # on a sequence or a link copied in by a slot move
+        self.db.add(URL(id=0, long_url="https://example.com/", short_code="late1"))
+        self.db.commit()
+        code_filter.sync(self.db)
+        self.assertFalse(code_filter.might_contain("late1"))
+        response = client.get("/late1", follow_redirects=False)
+        self.assertEqual(response.status_code, 307)
+        self.assertTrue(code_filter.might_contain("late1"))
+
+    def test_shorten_adds_code(self):
+        code_filter.load(self.db)
+        code_filter.sync_interval = 60
+        client.post(
+            "/shorten", json={"long_url": "https://a.com", "custom_code": "added123"}
+        )
+        self.assertTrue(code_filter.might_contain("added123"))
+
+    def test_filter_grows_when_table_outgrows_it(self):
+        shortcode_filter = ShortCodeFilter(capacity=2, sync_interval=0)
+        shortcode_filter.load(self.db)
+        for i in range(5):
+            create_dummy_url(self.db, short_code=f"grow{i}")
+        shortcode_filter.sync(self.db)
+        self.assertTrue(shortcode_filter.might_contain("grow4"))
+        self.assertGreaterEqual(shortcode_filter.bloom.capacity, 10)
+
+    def test_stats_endpoint(self):
+        code_filter.load(self.db)
+        data = client.get("/admin/stats").json()
+        self.assertTrue(data["bloom_filter"]["ready"])
+        for key in ["size_bytes", "fill_ratio", "false_positive_rate"]:
+            self.assertIn(key, data["bloom_filter"])
+
+
+class TestClickRollups(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+        self.url = create_dummy_url(self.db, short_code="rollup123")
+        self.now = datetime(2024, 6, 15, 12, 30)
+
+    def tearDown(self):
+        self.db.close()
+
+    def ingest(self, *ages):
+        rows = [
+            {
+                "url_id": self.url.id,
+                "timestamp": self.now - age,
+                "ip_address": "1.1.1.1",
+                "user_agent": "Agent",
+            }
+            for age in ages
+        ]
+        ingest_clicks(self.db, rows)
+        self.db.commit()
+
+    def test_windows_from_rollups(self):
+        self.ingest(
+            timedelta(minutes=5),
+            timedelta(hours=12),
+            timedelta(days=2),
+            timedelta(days=10),
+            timedelta(days=40),
+        )
+        self.assertEqual(
+            click_windows(self.db, self.url.id, self.now),
+            {
+                "total_clicks": 5,
+                "last_24h_clicks": 2,
+                "last_7d_clicks": 3,
+                "last_30d_clicks": 4,
+            },
+        )
+
+    def test_window_boundaries_are_hourly(self):
+        # 24h window starts at 12:00 the previous day
+        self.ingest(timedelta(hours=24, minutes=20), timedelta(hours=24, minutes=40))
+        self.assertEqual(click_windows(self.db, self.url.id, self.now)["last_24h_clicks"], 1)
+
+    def test_repeated_batches_accumulate(self):
+        self.ingest(timedelta(minutes=1), timedelta(minutes=2))
+        self.ingest(timedelta(minutes=3))
+        row = self.db.query(ClickRollupHourly).filter_by(url_id=self.url.id).one()
+        self.assertEqual(row.clicks, 3)
+
+    def test_rebuild_matches_raw_clicks(self):
+        for age in [timedelta(hours=1), timedelta(days=3), timedelta(days=20)]:
+            self.db.add(Click(url_id=self.url.id, timestamp=self.now - age))
+        self.db.commit()
+        self.assertEqual(click_windows(self.db, self.url.id, self.now)["total_clicks"], 0)
+
+        self.assertEqual(rebuild_aggregates(self.db), 3)
+        windows = click_windows(self.db, self.url.id, self.now)
+        self.assertEqual(windows["total_clicks"], 3)
+        self.assertEqual(windows["last_7d_clicks"], 2)
+
+        # Rebuilding twice does not double count
+        rebuild_aggregates(self.db, [self.url.id])
+        self.assertEqual(click_windows(self.db, self.url.id, self.now)["total_clicks"], 3)
+
+    def test_analytics_reads_rollups(self):
+        for _ in range(3):
+            client.get("/rollup123", follow_redirects=False)
+        click_buffer.flush()
+        with QueryRecorder() as recorder:
+            data = client.get("/analytics/rollup123").json()
+        self.assertEqual(data["analytics"]["total_clicks"], 3)
+        self.assertEqual(data["analytics"]["last_24h_clicks"], 3)
+        window_scans = [s for s in recorder.statements if "clicks.timestamp" in s]
+        self.assertEqual(window_scans, [])
+
+
+class TestUniqueVisitorSketches(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+        self.url = create_dummy_url(self.db, short_code="unique123")
+        self.now = datetime(2024, 6, 15, 12, 30)
+
+    def tearDown(self):
+        self.db.close()
+
+    def ingest(self, addresses, age=timedelta(0)):
+        rows = [
+            {
+                "url_id": self.url.id,
+                "timestamp": self.now - age,
+                "ip_address": address,
+                "user_agent": "Agent",
+            }
+            for address in addresses
+        ]
+        ingest_clicks(self.db, rows)
+        self.db.commit()
+
+    def test_estimate_within_error_bound(self):
+        for true_count in [10, 1000, 50_000]:
+            hll = HyperLogLog()
+            for i in range(true_count):
+                hll.add(f"10.{i // 65536}.{i // 256 % 256}.{i % 256}")
+            error = abs(hll.count() - true_count) / true_count
+            self.assertLess(error, 3 * hll.relative_error)
+
+    def test_merge_is_union(self):
+        first, second = HyperLogLog(), HyperLogLog()
+        for i in range(3000):
+            first.add(f"a{i}")
+            second.add(f"a{i + 1500}")
+        first.merge(second)
+        self.assertAlmostEqual(first.count(), 4500, delta=4500 * 0.05)
+        self.assertLess(len(first.to_bytes()), first.num_registers)
+
+    def test_daily_sketches_merged_per_window(self):
+        self.ingest(["1.1.1.1", "2.2.2.2"])
+        self.ingest(["1.1.1.1", "2.2.2.2"])
+        self.ingest(["3.3.3.3"], age=timedelta(days=3))
+        self.ingest(["4.4.4.4", "5.5.5.5"], age=timedelta(days=20))
+        self.ingest(["6.6.6.6"], age=timedelta(days=90))
+        self.assertEqual(self.db.query(UniqueVisitorSketch).count(), 4)
+        estimates, relative_error = unique_visitors(
+            self.db, self.url.id, {"last_7d": 7, "last_30d": 30}, self.now
+        )
+        self.assertEqual(estimates, {"total": 6, "last_7d": 3, "last_30d": 5})
+        self.assertGreater(relative_error, 0)
+
+    def test_total_is_read_from_the_all_time_sketch(self):
+        self.ingest(["1.1.1.1", "2.2.2.2"])
+        self.ingest(["3.3.3.3"], age=timedelta(days=400))
+        self.assertEqual(self.db.query(UniqueVisitorTotal).count(), 1)
+        # Daily sketches outside every window are not read at all
+        self.db.query(UniqueVisitorSketch).filter(
+            UniqueVisitorSketch.bucket < self.now - timedelta(days=30)
+        ).delete()
+        self.db.commit()
+
+        async def estimate():
+            async with AsyncSessionLocal() as db:
+                return await estimate_unique_visitors(
+                    db, self.url.id, {"last_7d": 7}, self.now
+                )
+
+        with mock.patch("hll.asyncio.to_thread", wraps=asyncio.to_thread) as thread:
+            estimates, _ = asyncio.run(estimate())
+        self.assertEqual(estimates, {"total": 3, "last_7d": 2})
+        thread.assert_called_once()
+
+    def test_analytics_estimate_and_exact_mode(self):
+        for _ in range(5):
+            client.get("/unique123", follow_redirects=False)
+        click_buffer.flush()
+        with QueryRecorder() as recorder:
+            data = client.get("/analytics/unique123").json()["analytics"]
+        self.assertFalse(any("DISTINCT" in s for s in recorder.statements))
+        self.assertEqual(data["unique_visitors"], 1)
+        self.assertFalse(data["unique_visitors_exact"])
+        self.assertIn("unique_visitors_error", data)
+
+        data = client.get("/analytics/unique123?exact_unique=true").json()["analytics"]
+        self.assertTrue(data["unique_visitors_exact"])
+        self.assertEqual(data["unique_visitors"], 1)
+        self.assertEqual(data["unique_visitors_error"], 0)
+
+    def test_rebuild_regenerates_sketches(self):
+        for address in ["1.1.1.1", "2.2.2.2", "1.1.1.1"]:
+            self.db.add(
+                Click(url_id=self.url.id, timestamp=self.now, ip_address=address)
+            )
+        self.db.commit()
+        rebuild_aggregates(self.db, [self.url.id])
+        estimates, _ = unique_visitors(self.db, self.url.id, {}, self.now)
+        self.assertEqual(estimates["total"], 2)
+
+
+def zipf_stream(n, distinct=1000, s=1.1, seed=7):
+    """Synthetic user agents whose frequencies follow a Zipf distribution"""
+    weights = [1 / rank**s for rank in range(1, distinct + 1)]
+    agents = [f"Agent/{rank}" for rank in range(1, distinct + 1)]
+    return random.Random(seed).choices(agents, weights=weights, k=n)
+
+
+class TestHeavyHitters(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+        self.url = create_dummy_url(self.db, short_code="heavy123")
+
+    def tearDown(self):
+        self.db.close()
+
+    def assert_matches_exact(self, top, exact: Counter):
+        self.assertEqual([item for item, _, _ in top], [a for a, _ in exact.most_common(5)])
+        for item, count, error in top:
+            self.assertLessEqual(count - error, exact[item])
+            self.assertGreaterEqual(count, exact[item])
+
+    def test_zipfian_top5_matches_exact(self):
+        stream = zipf_stream(50_000)
+        summary = SpaceSaving(capacity=50)
+        for agent in stream:
+            summary.update(agent)
+        self.assert_matches_exact(summary.top(5), Counter(stream))
+
+    def test_persisted_summary_across_batches(self):
+        stream = zipf_stream(20_000, seed=11)
+        for start in range(0, len(stream), 500):
+            rows = [
+                {
+                    "url_id": self.url.id,
+                    "timestamp": datetime(2024, 6, 15),
+                    "ip_address": "1.1.1.1",
+                    "user_agent": agent,
+                }
+                for agent in stream[start : start + 500]
+            ]
+            ingest_clicks(self.db, rows)
+        self.db.commit()
+        self.assert_matches_exact(
+            top_items(self.db, self.url.id, "user_agent"), Counter(stream)
+        )
+
+    def test_analytics_top_browsers_without_group_by(self):
+        for agent in ["Chrome"] * 3 + ["Safari"] * 2 + ["Firefox"]:
+            client.get("/heavy123", headers={"user-agent": agent}, follow_redirects=False)
+        click_buffer.flush()
+        with QueryRecorder() as recorder:
+            data = client.get("/analytics/heavy123").json()["analytics"]
+        self.assertFalse(any("GROUP BY" in s for s in recorder.statements))
+        self.assertEqual(
+            data["top_browsers"],
+            [
+                {"browser": "Chrome", "clicks": 3},
+                {"browser": "Safari", "clicks": 2},
+                {"browser": "Firefox", "clicks": 1},
+            ],
+        )
+
+
+class TestDatabaseSettings(unittest.TestCase):
+
+    def test_production_profile_with_overrides(self):
+        settings = load_settings(
+            "production", {"SQLITE_MMAP_SIZE": "1024", "DB_POOL_SIZE": "5"}
+        )
+        self.assertEqual(settings["sqlite_pragmas"]["journal_mode"], "WAL")
+        self.assertEqual(settings["sqlite_pragmas"]["mmap_size"], "1024")
+        self.assertEqual(settings["pool"]["pool_size"], 5)
+        self.assertTrue(settings["pool"]["pool_pre_ping"])
+        with self.assertRaises(ValueError):
+            load_settings("turbo", {})
+
+    def test_pragmas_applied_on_connect(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = f"sqlite:///{os.path.join(tmp, 'tuned.db')}"
+            sync_engine, aio_engine = create_engines(url, load_settings("production", {}))
+
+            with sync_engine.connect() as conn:
+                pragma = lambda name: conn.exec_driver_sql(f"PRAGMA {name}").scalar()
+                self.assertEqual(pragma("journal_mode"), "wal")
+                self.assertEqual(pragma("synchronous"), 1)  # NORMAL
+                self.assertEqual(pragma("busy_timeout"), 5000)
+                self.assertEqual(pragma("cache_size"), -65536)
+
+            async def async_synchronous():
+                async with aio_engine.connect() as conn:
+                    result = await conn.exec_driver_sql("PRAGMA synchronous")
+                    value = result.scalar()
+                await aio_engine.dispose()
+                return value
+
+            self.assertEqual(asyncio.run(async_synchronous()), 1)
+            sync_engine.dispose()
+
+    def test_startup_report(self):
+        report = asyncio.run(effective_settings())
+        self.assertEqual(report["profile"], "development")
+        self.assertEqual(report["sqlite_pragmas"]["busy_timeout"], 5000)
+        self.assertIn("database", client.get("/admin/stats").json())
+
+    def test_postgres_urls_use_psycopg(self):
+        self.assertEqual(
+            sync_url("postgresql://app:pw@db/urls"),
+            "postgresql+psycopg://app:pw@db/urls",
+        )
+        explicit = "postgresql+psycopg2://app:pw@db/urls"
+        self.assertEqual(sync_url(explicit), explicit)
+        self.assertEqual(sync_url("sqlite:///./urls.db"), "sqlite:///./urls.db")
+
+    def test_aware_datetimes_stored_as_naive_ist(self):
+        db = SessionLocal()
+        reset_database(db)
+        expires = datetime(2030, 1, 1, 0, 0, tzinfo=timezone.utc)
+        db.add(URL(long_url="https://a.example/", short_code="tz1", expires_at=expires))
+        db.commit()
+        stored = db.execute(
+            text("SELECT expires_at FROM urls WHERE short_code = 'tz1'")
+        ).scalar()
+        db.close()
+        self.assertEqual(stored, "2030-01-01 05:30:00.000000")
+
+    @unittest.skipUnless(os.getenv("TEST_POSTGRES_URL"), "TEST_POSTGRES_URL is not set")
+    def test_postgres_smoke(self):
+        """Create a link with the async engine, then flush a click with the sync one"""
+        url = os.environ["TEST_POSTGRES_URL"]
+        sync_engine, aio_engine = create_engines(url, load_settings("development", {}))
+        migrate(sync_engine)
+        factory = sessionmaker(bind=sync_engine)
+
+        async def create_link():
+            async with async_sessionmaker(bind=aio_engine)() as db:
+                db_url = URL(
+                    long_url="https://example.com/",
+                    short_code="pgsmoke",
+                    expires_at=datetime.now(IST) + timedelta(days=1),
+                    is_active=True,
+                )
+                db.add(db_url)
+                await db.commit()
+                url_id = db_url.id
+            await aio_engine.dispose()
+            return url_id
+
+        try:
+            url_id = asyncio.run(create_link())
+            buffer = ClickBuffer(session_factory=factory)
+            buffer.record(url_id, "1.1.1.1", "Agent")
+            self.assertEqual(buffer.flush(), 1)
+            with factory() as db:
+                clicks = db.query(Click).filter(Click.url_id == url_id).count()
+            self.assertEqual(clicks, 1)
+        finally:
+            Base.metadata.drop_all(sync_engine)
+            sync_engine.dispose()
+
+
+class TestQRCodes(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+        authenticate()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_png_with_etag(self):
+        create_dummy_url(self.db, short_code="qrcode1")
+        response = client.get("/qr/qrcode1")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.headers["content-type"], "image/png")
+        self.assertTrue(response.content.startswith(b"\x89PNG"))
+        etag = response.headers["etag"]
+
+        response = client.get("/qr/qrcode1", headers={"If-None-Match": etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, b"")
+        response = client.get("/qr/qrcode1", headers={"If-None-Match": "*"})
+        self.assertEqual(response.status_code, 304)
+        response = client.get("/qr/qrcode1", headers={"If-None-Match": etag * 2})
+        self.assertEqual(response.status_code, 200)
+
+    def test_if_none_match_parsing(self):
+        self.assertTrue(etag_matches('"a1", W/"b2"', '"b2"'))
+        self.assertTrue(etag_matches('"b2"', 'W/"b2"'))
+        self.assertTrue(etag_matches("*", '"b2"'))
+        self.assertFalse(etag_matches('"b22"', '"b2"'))
+        self.assertFalse(etag_matches("", '"b2"'))
+
+    def test_svg_and_size(self):
+        create_dummy_url(self.db, short_code="qrcode2")
+        response = client.get("/qr/qrcode2?format=svg")
+        self.assertEqual(response.headers["content-type"], "image/svg+xml")
+        self.assertIn(b"<svg", response.content)
+        small = client.get("/qr/qrcode2?size=2").content
+        large = client.get("/qr/qrcode2?size=20").content
+        self.assertLess(len(small), len(large))
+        self.assertEqual(client.get("/qr/qrcode2?format=gif").status_code, 422)
+
+    def test_unknown_code(self):
+        self.assertEqual(client.get("/qr/nosuchqr").status_code, 404)
+
+    def test_renderer_cache(self):
+        renderer = QRRenderer(cache_size=2)
+
+        async def render_all():
+            first = await renderer.render("a")
+            again = await renderer.render("a")
+            await renderer.render("b")
+            await renderer.render("c")
+            return first, again
+
+        first, again = asyncio.run(render_all())
+        renderer.shutdown()
+        self.assertEqual(first, again)
+        self.assertEqual(renderer.stats()["hits"], 1)
+        self.assertEqual(renderer.stats()["misses"], 3)
+        self.assertEqual(renderer.stats()["cached"], 2)
+
+    def test_shorten_without_inline_qr(self):
+        response = client.post(
+            "/shorten", json={"long_url": "https://example.com", "include_qr": False}
+        )
+        data = response.json()
+        self.assertNotIn("qr_code", data)
+        self.assertTrue(data["qr_url"].endswith(data["short_url"].rsplit("/", 1)[1]))
+        self.assertIn("qr_code", client.post(
+            "/shorten", json={"long_url": "https://example.com"}
+        ).json())
+
+
+class TestExpiryScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+
+    def tearDown(self):
+        code_filter.bloom = None
+        self.db.close()
+
+    def expiring(self, short_code, seconds):
+        expires_at = ist_naive(datetime.now(IST) + timedelta(seconds=seconds))
+        return create_dummy_url(self.db, short_code=short_code, expires_at=expires_at)
+
+    def test_deactivates_only_due_links(self):
+        overdue = self.expiring("overdue1", -5)
+        soon = self.expiring("soon1", 30)
+        self.expiring("later1", 7200)
+        create_dummy_url(self.db, short_code="forever1")
+
+        scheduler = ExpiryScheduler(horizon=60, refresh_interval=3600)
+        now = time.time()
+        self.assertEqual(scheduler.load(self.db, now), 2)
+        self.assertEqual(scheduler.run_once(now), ["overdue1"])
+        self.db.expire_all()
+        self.assertFalse(self.db.get(URL, overdue.id).is_active)
+        self.assertTrue(self.db.get(URL, soon.id).is_active)
+
+        self.assertEqual(scheduler.run_once(now + 31), ["soon1"])
+        self.db.expire_all()
+        self.assertFalse(self.db.get(URL, soon.id).is_active)
+        self.assertEqual(len(scheduler), 0)
+        self.assertEqual(scheduler.stats()["expired"], 2)
+
+    def test_schedule_respects_horizon(self):
+        scheduler = ExpiryScheduler(horizon=60, refresh_interval=3600)
+        scheduler.load(self.db)
+        scheduler.schedule(1, "a", time.time() + 10)
+        scheduler.schedule(1, "a", time.time() + 10)
+        scheduler.schedule(2, "b", time.time() + 600)
+        self.assertEqual(len(scheduler), 1)
+
+    def test_redirect_never_writes(self):
+        self.expiring("expired2", -5)
+        with QueryRecorder() as recorder:
+            response = client.get("/expired2")
+        self.assertEqual(response.status_code, 410)
+        self.assertIn("expired", response.text)
+        self.assertFalse(
+            [s for s in recorder.statements if s.lstrip().upper().startswith("UPDATE")]
+        )
+
+    def test_lifespan_runs_scheduler(self):
+        url = self.expiring("expiring3", 0.5)
+        with TestClient(app) as lifespan_client:
+            lifespan_client.get("/expiring3", follow_redirects=False)
+            deadline = time.time() + 5
+            while expiry_scheduler.stats()["expired"] == 0 and time.time() < deadline:
+                time.sleep(0.05)
+            self.assertEqual(lifespan_client.get("/expiring3").status_code, 410)
+        self.db.expire_all()
+        self.assertFalse(self.db.get(URL, url.id).is_active)
+        self.assertLess(expiry_scheduler.stats()["max_lag"], 1.0)
+
+
+class TestTokenCache(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        token_cache.clear()
+
+    def tearDown(self):
+        self.db.close()
+
+    def user_queries(self, statements):
+        return [s for s in statements if "FROM users" in s]
+
+    def test_cached_token_skips_user_query(self):
+        client.get("/admin/stats")
+        with QueryRecorder() as recorder:
+            response = client.get("/admin/stats")
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.user_queries(recorder.statements), [])
+        self.assertGreaterEqual(token_cache.stats()["hits"], 1)
+
+    def test_entry_capped_at_token_expiry(self):
+        cache = TokenCache(ttl=300)
+        user = UserSnapshot(1, "a", True)
+        cache.put("token", user, exp=1005, now=1000)
+        self.assertEqual(cache.get("token", now=1004), user)
+        self.assertIsNone(cache.get("token", now=1006))
+        cache.put("stale", user, exp=999, now=1000)
+        self.assertEqual(len(cache), 0)
+
+    def test_bounded_lru(self):
+        cache = TokenCache(max_size=2)
+        for i in range(3):
+            cache.put(f"token{i}", UserSnapshot(i, f"user{i}", True), exp=time.time() + 60)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("token0"))
+
+    def test_user_changes_invalidate(self):
+        client.post("/register", json={"username": "tokenuser", "password": "pw"})
+        token = create_access_token({"sub": "tokenuser"}, timedelta(minutes=5))
+        headers = {"Authorization": f"Bearer {token}"}
+        self.assertEqual(client.get("/urls", headers=headers).status_code, 200)
+
+        user = self.db.query(User).filter(User.username == "tokenuser").one()
+        user.is_active = False
+        self.db.commit()
+        self.assertEqual(client.get("/urls", headers=headers).status_code, 401)
+
+        user.is_active = True
+        self.db.commit()
+        self.assertEqual(client.get("/urls", headers=headers).status_code, 200)
+        self.db.delete(user)
+        self.db.commit()
+        self.assertEqual(client.get("/urls", headers=headers).status_code, 401)
+
+    def test_admin_stats_need_an_admin(self):
+        client.post("/register", json={"username": "plainuser", "password": "pw"})
+        token = create_access_token({"sub": "plainuser"}, timedelta(minutes=5))
+        headers = {"Authorization": f"Bearer {token}"}
+        self.assertEqual(client.get("/admin/stats", headers=headers).status_code, 403)
+        self.assertEqual(client.get("/admin/stats").status_code, 200)
+
+    def test_auth_overhead(self):
+        token = create_access_token({"sub": "testuser"}, timedelta(minutes=5))
+        rounds = 200
+
+        async def measure(clear):
+            async with AsyncSessionLocal() as db:
+                await get_current_user(token, db)
+                start = time.perf_counter()
+                for _ in range(rounds):
+                    if clear:
+                        token_cache.clear()
+                    await get_current_user(token, db)
+                return (time.perf_counter() - start) / rounds * 1e6
+
+        uncached = asyncio.run(measure(clear=True))
+        cached = asyncio.run(measure(clear=False))
+        self.assertLess(cached, uncached)
+
+
+class SlowContext:
+    """Stands in for a CryptContext whose hashes take a known time"""
+
+    def hash(self, password):
+        time.sleep(0.2)
+        return f"hashed-{password}"
+
+    def verify(self, password, hashed_password):
+        time.sleep(0.2)
+        return hashed_password == f"hashed-{password}"
+
+
+class TestPasswordHashing(unittest.TestCase):
+
+    def test_hashing_keeps_event_loop_free(self):
+        hasher = PasswordHasher(SlowContext(), workers=2, max_queue=4)
+
+        async def run():
+            ticks = 0
+
+            async def ticker():
+                nonlocal ticks
+                while True:
+                    await asyncio.sleep(0.01)
+                    ticks += 1
+
+            task = asyncio.create_task(ticker())
+            results = await asyncio.gather(
+                hasher.hash("a"), hasher.verify("b", "hashed-b")
+            )
+            task.cancel()
+            return results, ticks
+
+        (hashed, verified), ticks = asyncio.run(run())
+        hasher.shutdown()
+        self.assertEqual(hashed, "hashed-a")
+        self.assertTrue(verified)
+        self.assertGreater(ticks, 10)
+
+    def test_full_queue_rejected(self):
+        hasher = PasswordHasher(SlowContext(), workers=1, max_queue=1)
+
+        async def run():
+            return await asyncio.gather(
+                *(hasher.hash(str(i)) for i in range(3)), return_exceptions=True
+            )
+
+        results = asyncio.run(run())
+        hasher.shutdown()
+        self.assertEqual(sum(isinstance(r, HashingPoolFull) for r in results), 1)
+        stats = hasher.stats()
+        self.assertEqual(stats["rejected"], 1)
+        self.assertEqual(stats["completed"], 2)
+        self.assertEqual(stats["peak_queue_depth"], 1)
+        self.assertEqual(stats["in_flight"], 0)
+
+    def test_overload_returns_503(self):
+        password_hasher.in_flight += password_hasher.workers + password_hasher.max_queue
+        try:
+            response = client.post(
+                "/token", data={"username": "testuser", "password": "testpass"}
+            )
+        finally:
+            password_hasher.in_flight -= (
+                password_hasher.workers + password_hasher.max_queue
+            )
+        self.assertEqual(response.status_code, 503)
+        self.assertGreaterEqual(int(response.headers["retry-after"]), 1)
+        response = client.post(
+            "/token", data={"username": "testuser", "password": "testpass"}
+        )
+        self.assertEqual(response.status_code, 200)
+
+
+class TestBatchShorten(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+        authenticate()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_results_in_input_order(self):
+        create_dummy_url(self.db, short_code="taken1")
+        urls = [
+            {"long_url": "https://a.com"},
+            {"long_url": "https://b.com", "custom_code": "batch1"},
+            {"long_url": "https://c.com", "custom_code": "taken1"},
+            {"long_url": "https://d.com", "custom_code": "bad code!"},
+            {"long_url": "https://e.com", "custom_code": "batch1"},
+            {"long_url": "https://f.com", "expiry_minutes": 10},
+        ]
+        response = client.post("/shorten/batch", json={"urls": urls})
+        self.assertEqual(response.status_code, 200)
+        data = response.json()
+        self.assertEqual((data["created"], data["failed"]), (3, 3))
+        results = data["results"]
+        self.assertEqual([r["index"] for r in results], list(range(6)))
+        self.assertTrue(results[1]["short_url"].endswith("/batch1"))
+        self.assertEqual(results[2]["error"], "Custom code already exists")
+        self.assertEqual(results[3]["error"], "Invalid custom code format")
+        self.assertEqual(results[4]["error"], "Duplicate custom code in batch")
+        self.assertIsNotNone(results[5]["expires_at"])
+
+        for result, url in zip(results, urls):
+            if "short_url" in result:
+                code = result["short_url"].rsplit("/", 1)[1]
+                response = client.get(f"/{code}", follow_redirects=False)
+                self.assertEqual(response.headers["location"], url["long_url"])
+
+    def test_single_transaction_and_cache_primed(self):
+        urls = [{"long_url": f"https://site{i}.com/"} for i in range(200)]
+        with QueryRecorder() as recorder:
+            response = client.post("/shorten/batch", json={"urls": urls})
+        self.assertEqual(response.json()["created"], 200)
+        inserts = [s for s in recorder.statements if s.startswith("INSERT INTO urls")]
+        self.assertLessEqual(len(inserts), 2)
+        self.assertEqual(self.db.query(URL).count(), 200)
+
+        code = response.json()["results"][42]["short_url"].rsplit("/", 1)[1]
+        with QueryRecorder() as recorder:
+            response = client.get(f"/{code}", follow_redirects=False)
+        self.assertEqual(response.headers["location"], "https://site42.com/")
+        self.assertEqual(recorder.statements, [])
+
+    def test_batch_limit(self):
+        urls = [{"long_url": "https://a.com"}] * 1001
+        response = client.post("/shorten/batch", json={"urls": urls})
+        self.assertEqual(response.status_code, 400)
+
+    def test_allocate_many(self):
+        allocator = FeistelCodeAllocator(b"key", block_size=10, counter_name="batch")
+        first = allocator.next_counter()
+        codes = allocator.allocate_many(25)
+        self.assertEqual(len(set(codes)), 25)
+        self.assertNotIn(allocator.code_for(first), codes)
+        # The 16 values the first block lacked were leased as one block
+        self.assertEqual(allocator.next_counter(), first + 26)
+
+class TestCacheWarmup(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+        now = datetime.now(IST)
+        for i, (clicks, hours_ago) in enumerate([(5, 1), (50, 2), (20, 3), (90, 48)]):
+            url = create_dummy_url(self.db, short_code=f"warm{i}")
+            click = {
+                "url_id": url.id,
+                "timestamp": now - timedelta(hours=hours_ago),
+                "ip_address": "1.1.1.1",
+                "user_agent": "test",
+            }
+            ingest_clicks(self.db, [click] * clicks)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def warm(self, **kwargs):
+        return asyncio.run(warm_cache(router, **kwargs))
+
+    def test_top_links_by_recent_clicks(self):
+        async def run():
+            async with AsyncSessionLocal() as db:
+                return await ranked_links(db, top_n=2, lookback_hours=24)
+
+        links = asyncio.run(run())
+        self.assertEqual([url.short_code for url, _ in links], ["warm1", "warm2"])
+        self.assertEqual([clicks for _, clicks in links], [50, 20])
+
+    def test_warm_cache_loads_records(self):
+        report = self.warm(top_n=10, lookback_hours=24, timeout=5)
+        self.assertEqual(report["loaded"], 3)
+        self.assertFalse(report["timed_out"])
+        with QueryRecorder() as recorder:
+            response = client.get("/warm1", follow_redirects=False)
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(recorder.statements, [])
+        self.assertIsNone(asyncio.run(get_cached_url("warm3")))
+
+    def test_warm_up_is_time_boxed(self):
+        report = self.warm(top_n=10, lookback_hours=24, timeout=0)
+        self.assertTrue(report["timed_out"])
+        self.assertEqual(report["loaded"], 0)
+
+
+def sample(text, series):
+    """Value of one exact series line in Prometheus text output"""
+    for line in text.splitlines():
+        if line.startswith(series + " "):
+            return float(line.rsplit(" ", 1)[1])
+    return 0.0
+
+
+class TestMetrics(unittest.TestCase):
+
+    route_queries = 'http_request_db_queries_sum{route="/{short_code}"}'
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_metrics_endpoint(self):
+        create_dummy_url(self.db, short_code="metric1")
+        client.get("/metric1", follow_redirects=False)
+        response = client.get("/metrics")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/plain"))
+        text = response.text
+        self.assertIn(
+            'http_request_duration_seconds_bucket{route="/{short_code}",'
+            'method="GET",status="307",le="+Inf"}',
+            text,
+        )
+        for phase in ("bloom", "cache", "db", "click"):
+            self.assertGreater(
+                sample(text, f'redirect_phase_seconds_count{{phase="{phase}"}}'), 0
+            )
+        for name in (
+            "redirect_cache_hit_ratio",
+            "click_buffer_pending",
+            "expiry_scheduler_lag_seconds",
+        ):
+            self.assertIn(f"\n{name} ", text)
+
+    def test_queries_counted_per_request(self):
+        create_dummy_url(self.db, short_code="metric2")
+        before = sample(client.get("/metrics").text, self.route_queries)
+        client.get("/metric2", follow_redirects=False)
+        after_miss = sample(client.get("/metrics").text, self.route_queries)
+        client.get("/metric2", follow_redirects=False)
+        after_hit = sample(client.get("/metrics").text, self.route_queries)
+        self.assertGreaterEqual(after_miss - before, 1)
+        self.assertEqual(after_hit, after_miss)
+
+    def test_unmatched_routes_share_a_series(self):
+        client.get("/analytics/a/b/c/d")
+        self.assertIn('route="unmatched"', client.get("/metrics").text)
+
+    def test_switch_off(self):
+        disabled = Metrics(enabled=False)
+        with disabled.timer("cache"):
+            pass
+        self.assertNotIn("redirect_phase_seconds_count", disabled.render())
+        metrics.enabled = False
+        try:
+            self.assertEqual(client.get("/metrics").status_code, 404)
+        finally:
+            metrics.enabled = True
+
+    def test_observe_overhead(self):
+        histogram = Histogram("bench_seconds", "Overhead check", labels=("route",))
+        rounds = 100_000
+        start = time.perf_counter()
+        for _ in range(rounds):
+            histogram.observe(0.003, "/{short_code}")
+        per_call = (time.perf_counter() - start) / rounds * 1e6
+        print(f"\nhistogram observe: {per_call:.2f} us")
+        self.assertLess(per_call, 20)
+        self.assertIn(
+            'bench_seconds_count{route="/{short_code}"} 100000', histogram.render()
+        )
+
+
+class BrokenRedis:
+    """Shared tier that is down"""
+
+    async def get(self, key):
+        raise ConnectionError("redis down")
+
+    def pipeline(self):
+        raise ConnectionError("redis down")
+
+
+class TestTwoTierCache(unittest.TestCase):
+
+    record = CachedURL("https://a.com", 1, True, None)
+
+    def test_l1_bounded(self):
+        l1 = LRUCache(max_size=2)
+        for key in "abc":
+            l1.set(key, self.record, ttl=60)
+        self.assertIsNone(l1.get("a"))
+        self.assertEqual(l1.get("c"), self.record)
+        self.assertEqual(l1.stats()["evictions"], 1)
+        l1.set("short", self.record, ttl=5, now=1000)
+        self.assertIsNone(l1.get("short", now=1006))
+
+    def test_l2_shared_between_workers(self):
+        redis = FakeRedis()
+        first = TwoTierCache(LRUCache(10), redis)
+        second = TwoTierCache(LRUCache(10), redis)
+
+        async def run():
+            await first.set("abc", self.record, ttl=60)
+            await first.set("gone", NOT_FOUND, ttl=60)
+            return (
+                await second.get("abc"),
+                await second.get("abc"),
+                await second.get("gone"),
+                await second.get("nope"),
+            )
+
+        self.assertEqual(asyncio.run(run()), (self.record, self.record, NOT_FOUND, None))
+        stats = second.stats()
+        self.assertEqual(stats["l1"]["hits"], 1)
+        self.assertEqual(stats["l2"]["hits"], 2)
+        self.assertEqual(stats["l2"]["misses"], 1)
+
+    def test_invalidation_reaches_other_workers(self):
+        redis = FakeRedis()
+        first = TwoTierCache(LRUCache(10), redis)
+        second = TwoTierCache(LRUCache(10), redis)
+        changed = self.record._replace(is_active=False)
+
+        async def run():
+            await first.start()
+            await second.start()
+            await first.set("abc", self.record, ttl=60)
+            await second.get("abc")
+            await first.set("abc", changed, ttl=60)
+            await first.announce("abc")
+            await asyncio.sleep(0.05)
+            value = await second.get("abc")
+            await first.delete("abc")
+            await first.announce("abc")
+            await asyncio.sleep(0.05)
+            gone = await second.get("abc")
+            await first.stop()
+            await second.stop()
+            return value, gone
+
+        self.assertEqual(asyncio.run(run()), (changed, None))
+        self.assertEqual(second.stats()["invalidations_received"], 2)
+        self.assertEqual(first.stats()["invalidations_received"], 0)
+
+    def test_l2_outage_falls_back_to_l1(self):
+        tiered = TwoTierCache(LRUCache(10), BrokenRedis())
+
+        async def run():
+            await tiered.set("abc", self.record, ttl=60)
+            return await tiered.get("abc"), await tiered.get("other")
+
+        self.assertEqual(asyncio.run(run()), (self.record, None))
+        self.assertEqual(tiered.stats()["l2"]["errors"], 2)
+
+    def test_clear_leaves_other_redis_keys(self):
+        redis = FakeRedis()
+        tiered = TwoTierCache(LRUCache(10), redis)
+
+        async def run():
+            await redis.set("ratelimit:/shorten:ip:1.1.1.1", "bucket")
+            for i in range(3):
+                await tiered.set(f"code{i}", self.record, ttl=60)
+            await tiered.clear(batch_size=2)
+            return await tiered.get("code0"), sorted(redis._data)
+
+        self.assertEqual(
+            asyncio.run(run()), (None, ["ratelimit:/shorten:ip:1.1.1.1"])
+        )
+
+
+class TestClickRetention(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+        self.url = create_dummy_url(self.db, short_code="retain1")
+        self.archive_dir = tempfile.mkdtemp()
+        now = ist_naive(datetime.now(IST))
+        # Three old clicks in different months and two recent ones; 2.2.2.2
+        # visited both before and after the retention cutoff
+        visits = [
+            (220, "1.1.1.1"),
+            (170, "2.2.2.2"),
+            (120, "2.2.2.2"),
+            (2, "2.2.2.2"),
+            (1, "3.3.3.3"),
+        ]
+        rows = [
+            {
+                "url_id": self.url.id,
+                "timestamp": now - timedelta(days=days, hours=12),
+                "ip_address": ip,
+                "user_agent": "Agent",
+            }
+            for days, ip in visits
+        ]
+        ingest_clicks(self.db, rows)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def retain(self, **kwargs):
+        return run_retention(self.db, days=90, archive_dir=self.archive_dir, **kwargs)
+
+    def test_old_clicks_move_to_monthly_files(self):
+        report = self.retain(batch_size=2)
+        self.assertEqual(report["rows"], 3)
+        self.assertEqual(report["batches"], 2)
+        self.assertEqual(self.db.query(Click).count(), 2)
+        months = os.listdir(self.archive_dir)
+        self.assertEqual(len(months), 3)
+        self.assertTrue(all(name.startswith("month=") for name in months))
+        self.assertIn("reclaimed_bytes", report)
+        self.assertGreater(report["archive_bytes"], 0)
+
+    def test_rerun_archives_nothing(self):
+        self.retain()
+        self.assertEqual(self.retain()["rows"], 0)
+
+    def test_compaction_reports_file_size(self):
+        report = self.retain(compact=True)
+        self.assertEqual(report["free_bytes"], 0)
+        self.assertLessEqual(report["file_bytes_after"], report["file_bytes_before"])
+
+    def test_totals_survive_archiving_and_rebuild(self):
+        before = click_windows(self.db, self.url.id)
+        self.retain()
+        self.assertEqual(click_windows(self.db, self.url.id), before)
+        rebuild_aggregates(self.db, [self.url.id], archive_dir=self.archive_dir)
+        self.assertEqual(click_windows(self.db, self.url.id), before)
+        self.assertEqual(before["total_clicks"], 5)
+
+    def test_exact_unique_visitors_include_archives(self):
+        self.retain()
+        self.assertEqual(
+            archived_ips(self.url.id, archive_dir=self.archive_dir),
+            {"1.1.1.1", "2.2.2.2"},
+        )
+        with mock.patch("main.CLICK_ARCHIVE_DIR", self.archive_dir):
+            data = client.get("/analytics/retain1?exact_unique=true").json()
+        self.assertEqual(data["analytics"]["unique_visitors"], 3)
+        self.assertEqual(data["analytics"]["unique_visitors_last_7d"], 2)
+
+    def test_crash_before_delete_rewrites_same_file(self):
+        cutoff = datetime.now(IST) - timedelta(days=90)
+        with mock.patch.object(self.db, "commit", side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                archive_clicks(self.db, cutoff, self.archive_dir)
+        self.db.rollback()
+        files = sorted(
+            name for _, _, names in os.walk(self.archive_dir) for name in names
+        )
+        report = archive_clicks(self.db, cutoff, self.archive_dir)
+        self.assertEqual(report["rows"], 3)
+        self.assertEqual(
+            sorted(name for _, _, names in os.walk(self.archive_dir) for name in names),
+            files,
+        )
+        self.assertEqual(
+            len(archived_ips(self.url.id, archive_dir=self.archive_dir)), 2
+        )
+
+
+class TestClickExport(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+        self.url = create_dummy_url(self.db, short_code="export1")
+        self.now = ist_naive(datetime.now(IST))
+        rows = [
+            {
+                "url_id": self.url.id,
+                "timestamp": self.now - timedelta(days=days),
+                "ip_address": f"10.0.0.{days}",
+                "user_agent": 'Agent "quoted", with comma',
+            }
+            for days in (120, 5, 3, 1)
+        ]
+        ingest_clicks(self.db, rows)
+        self.db.commit()
+
+    def tearDown(self):
+        self.db.close()
+
+    def test_csv_export(self):
+        response = client.get("/analytics/export1/clicks/export")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers["content-type"].startswith("text/csv"))
+        self.assertIn("export1-clicks.csv", response.headers["content-disposition"])
+        rows = list(csv.DictReader(response.text.splitlines()))
+        self.assertEqual(len(rows), 4)
+        self.assertEqual(rows[0]["user_agent"], 'Agent "quoted", with comma')
+        self.assertEqual(rows[-1]["ip_address"], "10.0.0.1")
+
+    def test_ndjson_gzip_export_with_time_range(self):
+        start = (self.now - timedelta(days=4)).isoformat()
+        response = client.get(
+            "/analytics/export1/clicks/export",
+            params={"format": "ndjson", "gzip": "true", "start": start},
+        )
+        self.assertEqual(response.headers["content-type"], "application/gzip")
+        lines = gzip.decompress(response.content).decode().splitlines()
+        self.assertEqual(
+            [json.loads(line)["ip_address"] for line in lines],
+            ["10.0.0.3", "10.0.0.1"],
+        )
+
+    def test_empty_export_has_header(self):
+        end = (self.now - timedelta(days=365)).isoformat()
+        response = client.get("/analytics/export1/clicks/export", params={"end": end})
+        self.assertEqual(response.text.strip(), "id,timestamp,ip_address,user_agent")
+
+    def test_other_users_cannot_export(self):
+        if not self.db.query(User).filter(User.username == "exporter").first():
+            self.db.add(User(username="exporter", hashed_password="-", is_active=True))
+            self.db.commit()
+        token = create_access_token({"sub": "exporter"})
+        response = client.get(
+            "/analytics/export1/clicks/export",
+            headers={"Authorization": f"Bearer {token}"},
+        )
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(
+            client.get("/analytics/missing1/clicks/export").status_code, 404
+        )
+
+    def test_pages_are_bounded(self):
+        async def run():
+            return [page async for page in live_click_pages(self.url.id, page_size=3)]
+
+        pages = asyncio.run(run())
+        self.assertEqual([len(page) for page in pages], [3, 1])
+        ids = [row["id"] for page in pages for row in page]
+        self.assertEqual(ids, sorted(ids))
+
+    def test_archived_clicks_are_exported_first(self):
+        archive_dir = tempfile.mkdtemp()
+        archive_clicks(self.db, datetime.now(IST) - timedelta(days=90), archive_dir)
+
+        async def run():
+            chunks = export_clicks(self.url.id, "ndjson", archive_dir=archive_dir)
+            return b"".join([chunk async for chunk in chunks])
+
+        lines = asyncio.run(run()).decode().splitlines()
+        self.assertEqual(len(lines), 4)
+        self.assertEqual(json.loads(lines[0])["ip_address"], "10.0.0.120")
+
+
+class TestSharding(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        shards = []
+        for index in range(2):
+            url = f"sqlite:///{os.path.join(self.tmp, f'shard{index}.db')}"
+            engines = create_engines(url, load_settings("production", {}))
+            shards.append(Shard(index, url, *engines))
+        # Shard 0 doubles as the primary holding the slot map
+        self.router = ShardRouter(shards, slots=16, primary_session=shards[0].session)
+        self.router.prepare()
+        with SessionLocal() as db:
+            self.owner_id = db.query(User.id).filter_by(username="testuser").scalar()
+
+    def tearDown(self):
+        for shard in self.router.shards:
+            shard.engine.dispose()
+            asyncio.run(shard.async_engine.dispose())
+
+    def codes_on(self, index, count=2):
+        codes = (f"shard{i}" for i in range(1000))
+        return [c for c in codes if self.router.index_for(c) == index][:count]
+
+    def add_link(self, short_code):
+        async def run():
+            shard = self.router.shard_for(short_code)
+            async with shard.async_session() as db:
+                [url_id] = await self.router.next_url_ids(db, shard, 1)
+                db.add(
+                    URL(
+                        id=url_id,
+                        long_url=f"https://example.com/{short_code}",
+                        short_code=short_code,
+                        created_at=datetime.now(),
+                        is_active=True,
+                        owner_id=self.owner_id,
+                    )
+                )
+                await db.commit()
+            return url_id
+
+        return asyncio.run(run())
+
+    def count(self, index, model):
+        with self.router.shards[index].session() as db:
+            return db.query(model).count()
+
+    def test_slot_map_is_persisted(self):
+        self.assertEqual(slot_for("abc123", 16), slot_for("abc123", 16))
+        self.assertEqual(self.router.slot_map, [slot % 2 for slot in range(16)])
+        with self.router.primary_session() as db:
+            db.query(ShardSlot).filter_by(slot=0).update({"shard": 1})
+            db.commit()
+        self.router.load_map()
+        self.assertEqual(self.router.slot_map[0], 1)
+
+    def test_ids_encode_the_shard(self):
+        ids = [self.add_link(code) for code in self.codes_on(0) + self.codes_on(1)]
+        self.assertEqual([i % SHARD_ID_STRIDE for i in ids], [0, 0, 1, 1])
+        self.assertEqual(len(set(ids)), 4)
+        self.assertLess(ids[0], ids[1])
+
+    def test_fan_out_lists_links_of_every_shard(self):
+        for code in self.codes_on(0) + self.codes_on(1):
+            self.add_link(code)
+        with mock.patch("main.router", self.router):
+            response = client.get("/urls", params={"limit": 3})
+        links = response.json()["urls"]
+        self.assertEqual(len(links), 3)
+        self.assertEqual(
+            [link["created_at"] for link in links],
+            sorted((link["created_at"] for link in links), reverse=True),
+        )
+        self.assertEqual(links[0]["total_clicks"], 0)
+
+    def test_bloom_filter_follows_every_shard(self):
+        first, second = self.codes_on(0, 1) + self.codes_on(1, 1)
+        self.add_link(first)
+        code_filter = ShortCodeFilter(capacity=1000, id_stride=SHARD_ID_STRIDE)
+        asyncio.run(self.router.run_sync(code_filter.load))
+        self.assertTrue(code_filter.might_contain(first))
+        self.assertFalse(code_filter.might_contain(second))
+        self.add_link(second)
+        asyncio.run(self.router.run_sync(code_filter.sync))
+        self.assertTrue(code_filter.might_contain(second))
+
+    def test_clicks_are_written_to_their_shard(self):
+        buffer = ClickBuffer(router=self.router)
+        codes = self.codes_on(0, 1) + self.codes_on(1, 2)
+        for index, code in zip((0, 1, 1), codes):
+            buffer.record(self.add_link(code), "1.1.1.1", "Agent", index)
+        self.assertEqual(buffer.flush(), 3)
+        self.assertEqual(self.count(0, Click), 1)
+        self.assertEqual(self.count(1, Click), 2)
+        self.assertEqual(buffer.batches, 2)
+
+    def test_move_slots_keeps_clicks_and_aggregates(self):
+        code, *others = self.codes_on(0, 20)
+        slot = slot_for(code, self.router.slots)
+        url_id = self.add_link(code)
+        other = [c for c in others if slot_for(c, self.router.slots) != slot][0]
+        self.add_link(other)
+        now = datetime.now(IST)
+        with self.router.shards[0].session() as db:
+            ingest_clicks(
+                db,
+                [
+                    {
+                        "url_id": url_id,
+                        "timestamp": now - timedelta(hours=hours),
+                        "ip_address": f"10.0.0.{hours}",
+                        "user_agent": "Agent",
+                    }
+                    for hours in (1, 2, 30)
+                ],
+            )
+            db.commit()
+            before = click_windows(db, url_id)
+
+        report = move_slots(self.router, {slot}, 1, grace=0)
+        self.assertEqual(report["clicks"], 3)
+        self.assertEqual(self.router.index_for(code), 1)
+        with self.router.shards[1].session() as db:
+            self.assertEqual(db.get(URL, url_id).short_code, code)
+            self.assertEqual(click_windows(db, url_id), before)
+            self.assertEqual(unique_visitors(db, url_id, {})[0]["total"], 3)
+        with self.router.shards[0].session() as db:
+            self.assertIsNone(db.get(URL, url_id))
+            self.assertEqual(db.query(Click).count(), 0)
+            self.assertEqual(db.query(ClickRollupDaily).count(), 0)
+        self.assertEqual(report["links"], 1)
+        # Links in other slots stay where they were
+        self.assertEqual(self.count(0, URL), 1)
+
+    def test_click_during_snapshot_is_counted_once(self):
+        code = self.codes_on(0, 1)[0]
+        url_id = self.add_link(code)
+        click = {"url_id": url_id, "ip_address": "10.0.0.1", "user_agent": "Agent"}
+        source = self.router.shards[0]
+        with source.session() as db:
+            ingest_clicks(db, [dict(click, timestamp=datetime.now(IST))])
+            db.commit()
+        seen_high_water = []
+
+        def click_after_high_water(conn, cursor, statement, *args):
+            if seen_high_water == [True]:
+                seen_high_water.append(False)
+                with source.session() as db:
+                    ingest_clicks(db, [dict(click, timestamp=datetime.now(IST))])
+                    db.commit()
+            if "max(clicks.id)" in statement:
+                seen_high_water.append(True)
+
+        event.listen(source.engine, "before_cursor_execute", click_after_high_water)
+        try:
+            report = move_slots(self.router, {slot_for(code, 16)}, 1, grace=0)
+        finally:
+            event.remove(
+                source.engine, "before_cursor_execute", click_after_high_water
+            )
+        self.assertEqual(seen_high_water, [True, False])
+        self.assertEqual(report["clicks"], 2)
+        with self.router.shards[1].session() as db:
+            self.assertEqual(db.query(Click).count(), 2)
+            self.assertEqual(click_windows(db, url_id)["total_clicks"], 2)
+            self.assertEqual(unique_visitors(db, url_id, {})[0]["total"], 1)
+
+    def test_link_created_during_move_is_not_left_missing(self):
+        code, *others = self.codes_on(0, 20)
+        slot = slot_for(code, self.router.slots)
+        late = [c for c in others if slot_for(c, self.router.slots) == slot][0]
+        self.add_link(code)
+        asyncio.run(cache_missing(late))
+
+        def create_late_link(seconds):
+            # A worker still on the old map creates a link on the source
+            with self.router.shards[0].session() as db:
+                db.add(
+                    URL(
+                        id=SHARD_ID_STRIDE * 1000,
+                        long_url="https://late.com",
+                        short_code=late,
+                        is_active=True,
+                    )
+                )
+                db.commit()
+
+        with mock.patch("sharding.time.sleep", create_late_link):
+            report = move_slots(self.router, {slot}, 1, grace=0)
+        self.assertEqual(report["links"], 2)
+        self.assertEqual(self.router.index_for(late), 1)
+        with self.router.shards[1].session() as db:
+            self.assertIsNotNone(db.query(URL).filter_by(short_code=late).first())
+        self.assertIsNone(asyncio.run(get_cached_url(late)))
+
+    def test_shards_do_not_reference_users(self):
+        with self.router.shards[1].engine.connect() as conn:
+            self.assertEqual(inspect(conn).get_foreign_keys("urls"), [])
+
+    def test_rebalance_plan_evens_out_slots(self):
+        self.router.slot_map = [0] * 16
+        plan = rebalance_plan(self.router)
+        self.assertEqual(list(plan), [1])
+        self.assertEqual(len(plan[1]), 8)
+
+
+class TestReadReplicas(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+        self.url = create_dummy_url(self.db, short_code="replica1")
+        self.tmp = tempfile.mkdtemp()
+        self.replicas = []
+        for name in ("a", "b"):
+            url = f"sqlite:///{os.path.join(self.tmp, f'{name}.db')}"
+            refresh_sqlite_copy(str(engine.url), url)
+            settings = load_settings("development", {})
+            self.replicas.append(Replica(url, *create_engines(url, settings)))
+        self.replica_set = ReplicaSet(self.replicas, window=60)
+        self.shard = router.shards[0]
+
+    def tearDown(self):
+        self.db.close()
+        for replica in self.replicas:
+            replica.engine.dispose()
+            asyncio.run(replica.async_engine.dispose())
+
+    def read(self, short_code, **kwargs):
+        async def find(db, code):
+            result = await db.execute(select(URL.id).where(URL.short_code == code))
+            return result.scalar()
+
+        return asyncio.run(
+            self.replica_set.read(
+                AsyncSessionLocal, find, short_code, keys=(short_code,), **kwargs
+            )
+        )
+
+    def test_round_robin_over_healthy_replicas(self):
+        picks = [self.replica_set.pick() for _ in range(4)]
+        self.assertEqual(picks, self.replicas * 2)
+        self.replicas[0].healthy = False
+        self.assertEqual(self.replica_set.pick(), self.replicas[1])
+        self.replicas[1].healthy = False
+        self.assertIsNone(self.replica_set.pick())
+
+    def test_read_your_writes_window(self):
+        self.replica_set.wrote("old1", now=time.monotonic() - 61)
+        self.replica_set.wrote("replica1", now=time.monotonic() - 30)
+        self.assertIsNone(self.replica_set.pick("replica1"))
+        self.assertIsNotNone(self.replica_set.pick("other1"))
+        self.assertIsNotNone(self.replica_set.pick("old1"))
+        # Expired entries are dropped on the next lookup
+        self.assertEqual(list(self.replica_set._recent), ["replica1"])
+
+    def test_stale_replica_falls_back_to_primary(self):
+        self.assertEqual(self.read("replica1"), self.url.id)
+        late = create_dummy_url(self.db, short_code="replica2")
+        self.assertIsNone(self.read("replica2"))
+        found = self.read("replica2", stale=lambda url_id: url_id is None)
+        self.assertEqual(found, late.id)
+        self.assertEqual(self.replica_set.fallbacks, 1)
+        refresh_sqlite_copy(str(engine.url), self.replicas[1].url)
+        self.assertEqual(self.read("replica2"), late.id)
+
+    def test_failed_replica_is_skipped_until_healthy(self):
+        # A directory where the database file was cannot be opened
+        path = os.path.join(self.tmp, "a.db")
+        os.rename(path, path + ".gone")
+        os.makedirs(path)
+        asyncio.run(self.replica_set.check())
+        self.assertFalse(self.replicas[0].healthy)
+        self.assertTrue(self.replicas[1].healthy)
+        self.assertEqual(self.read("replica1"), self.url.id)
+        self.assertEqual(self.replicas[1].reads, 1)
+
+    def test_redirect_and_analytics_read_from_replicas(self):
+        with mock.patch.object(self.shard, "replicas", self.replica_set):
+            response = client.get("/replica1", follow_redirects=False)
+            self.assertEqual(response.status_code, 307)
+            self.assertEqual(client.get("/analytics/replica1").status_code, 200)
+            created = client.post(
+                "/shorten", json={"long_url": "https://example.com/new"}
+            ).json()
+            code = created["short_url"].rsplit("/", 1)[1]
+            asyncio.run(cache.clear())
+            response = client.get(f"/{code}", follow_redirects=False)
+        self.assertEqual(response.status_code, 307)
+        self.assertEqual(sum(replica.reads for replica in self.replicas), 2)
+        self.assertEqual(self.replica_set.primary_reads, 1)
+
+
+class TestRateLimiting(unittest.TestCase):
+
+    def setUp(self):
+        rate_limiter.local.clear()
+
+    def tearDown(self):
+        rate_limiter.local.clear()
+
+    def test_token_bucket_refills(self):
+        buckets = MemoryBuckets()
+        limit = Limit.parse("3/3")
+        waits = [buckets.take("a", limit, now=0) for _ in range(4)]
+        self.assertEqual(waits[:3], [0, 0, 0])
+        self.assertAlmostEqual(waits[3], 1.0)
+        self.assertEqual(buckets.take("a", limit, now=1), 0)
+        self.assertGreater(buckets.take("a", limit, now=1), 0)
+
+    def test_idle_buckets_are_evicted(self):
+        buckets = MemoryBuckets(max_size=50)
+        limit = Limit.parse("10/1")
+        for i in range(1000):
+            # Each client comes back after its bucket has refilled
+            buckets.take(f"client{i}", limit, now=i * 0.5)
+        self.assertLessEqual(len(buckets), 2)
+        for i in range(1000):
+            buckets.take(f"burst{i}", limit, now=1000)
+        self.assertEqual(len(buckets), 50)
+
+    def test_shared_backend_failure_falls_back_to_local(self):
+        shared = mock.Mock()
+        shared.take = mock.AsyncMock(side_effect=ConnectionError("down"))
+        limiter = RateLimiter({"/shorten": Limit.parse("1/60")}, shared)
+        waits = [asyncio.run(limiter.check("/shorten", "ip:1")) for _ in range(2)]
+        self.assertEqual(waits[0], 0)
+        self.assertGreater(waits[1], 0)
+        self.assertEqual(limiter.backend_errors, 2)
+        self.assertEqual(asyncio.run(limiter.check("/qr", "ip:1")), 0)
+
+    def test_redirects_limited_per_ip(self):
+        db = SessionLocal()
+        reset_database(db)
+        create_dummy_url(db, short_code="limit1")
+        db.close()
+        limits = {"/{short_code}": Limit.parse("2/60")}
+        with mock.patch.dict(rate_limiter.limits, limits):
+            statuses = [
+                client.get("/limit1", follow_redirects=False).status_code
+                for _ in range(3)
+            ]
+            response = client.get("/limit1", follow_redirects=False)
+        self.assertEqual(statuses, [307, 307, 429])
+        self.assertEqual(int(response.headers["retry-after"]), 30)
+        self.assertEqual(response.json()["detail"], "Too many requests")
+        self.assertGreaterEqual(rate_limiter.rejected["/{short_code}"], 2)
+
+    def test_shorten_limited_per_user(self):
+        other = {"Authorization": f"Bearer {create_access_token({'sub': 'other'})}"}
+        client.get("/urls")  # verify the test user's token into the cache
+        with mock.patch.dict(rate_limiter.limits, {"/shorten": Limit.parse("1/60")}):
+            body = {"long_url": "https://example.com/", "include_qr": False}
+            first = client.post("/shorten", json=body)
+            second = client.post("/shorten", json=body)
+            # Another user's bucket is untouched; their token is merely unknown
+            third = client.post("/shorten", json=body, headers=other)
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(third.status_code, 401)
+
+    def test_user_key_comes_from_the_token_cache(self):
+        token = client.headers["Authorization"].split(" ", 1)[1]
+        token_cache.clear()
+        with mock.patch("main.jwt.decode") as decode:
+            self.assertIsNone(token_user(token))
+        decode.assert_not_called()
+        client.get("/urls")
+        self.assertEqual(token_user(token), "testuser")
+
+
+class TestLongURLDedup(unittest.TestCase):
+
+    def setUp(self):
+        self.db = SessionLocal()
+        reset_database(self.db)
+
+    def tearDown(self):
+        self.db.close()
+
+    def shorten(self, long_url, headers=None, **fields):
+        body = {"long_url": long_url, "include_qr": False, **fields}
+        response = client.post("/shorten", json=body, headers=headers)
+        return response.json()
+
+    def test_normalization(self):
+        self.assertEqual(
+            normalize_url("HTTPS://Example.COM:443"), "https://example.com/"
+        )
+        same = url_hash("http://example.com"), url_hash("http://EXAMPLE.com/")
+        self.assertEqual(*same)
+        paths = url_hash("http://example.com/A"), url_hash("http://example.com/a")
+        self.assertNotEqual(*paths)
+        self.assertEqual(len(url_hash("http://example.com")), 16)
+
+    def test_dedupe_returns_existing_code(self):
+        first = self.shorten("https://Example.com", dedupe=True)
+        second = self.shorten("https://example.com/", dedupe=True)
+        self.assertFalse(first["deduplicated"])
+        self.assertTrue(second["deduplicated"])
+        self.assertEqual(first["short_url"], second["short_url"])
+        self.assertNotEqual(
+            self.shorten("https://example.com/")["short_url"], first["short_url"]
+        )
+        self.assertEqual(self.db.query(URL).count(), 2)
+
+    def test_dedupe_is_per_owner_and_skips_expiring_links(self):
+        first = self.shorten("https://example.org/", dedupe=True)
+        authenticate("dedupe-other", "otherpass")
+        try:
+            other = self.shorten("https://example.org/", dedupe=True)
+        finally:
+            authenticate()
+        self.assertFalse(other["deduplicated"])
+        expiring = self.shorten(
+            "https://example.org/", dedupe=True, expiry_minutes=5
+        )
+        self.assertFalse(expiring["deduplicated"])
+        self.assertNotEqual(expiring["short_url"], first["short_url"])
+        self.db.query(URL).update({"is_active": False})
+        self.db.commit()
+        again = self.shorten("https://example.org/", dedupe=True)
+        self.assertFalse(again["deduplicated"])
+
+    def test_backfill_and_index_lookup(self):
+        url = create_dummy_url(self.db, long_url="https://Example.net")
+        self.assertIsNone(url.long_url_hash)
+        self.assertEqual(backfill_hashes(self.db, batch_size=1), 1)
+        self.db.refresh(url)
+        self.assertEqual(url.long_url_hash, url_hash("https://example.net/"))
+        plan = query_plan(self.db, duplicate_query(url.owner_id, url.long_url))
+        self.assertIn("ix_urls_owner_id_long_url_hash", plan)
+
+
+LEGACY_SCHEMA = """
+CREATE TABLE users (id INTEGER PRIMARY KEY, username VARCHAR NOT NULL UNIQUE,
+    hashed_password VARCHAR NOT NULL, is_active BOOLEAN, created_at DATETIME);
+CREATE TABLE urls (id INTEGER PRIMARY KEY, long_url VARCHAR NOT NULL,
+    short_code VARCHAR, created_at DATETIME, expires_at DATETIME,
+    is_active BOOLEAN, owner_id INTEGER REFERENCES users (id));
+CREATE UNIQUE INDEX ix_urls_short_code ON urls (short_code);
+CREATE INDEX ix_urls_expires_at ON urls (expires_at);
+CREATE TABLE clicks (id INTEGER PRIMARY KEY, url_id INTEGER REFERENCES urls (id),
+    timestamp DATETIME, ip_address VARCHAR, user_agent VARCHAR);
+INSERT INTO urls (long_url, short_code, is_active)
+    VALUES ('HTTP://Legacy.com', 'old1', 1);
+"""
+
+
+class TestMigrations(unittest.TestCase):
+
+    def test_legacy_database_is_upgraded_in_place(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = f"sqlite:///{os.path.join(tmp, 'legacy.db')}"
+            sync_engine, aio_engine = create_engines(
+                url, load_settings("development", {})
+            )
+            with sync_engine.begin() as conn:
+                for statement in LEGACY_SCHEMA.split(";"):
+                    if statement.strip():
+                        conn.exec_driver_sql(statement)
+
+            applied = migrate(sync_engine)
+            self.assertEqual(applied, [name for _, name, _ in MIGRATIONS])
+            self.assertEqual(migrate(sync_engine), [])
+            self.assertEqual(applied_versions(sync_engine), {1, 2, 3, 4, 5})
+            with sync_engine.connect() as conn:
+                indexes = {
+                    row[0]
+                    for row in conn.exec_driver_sql(
+                        "SELECT name FROM sqlite_master WHERE type = 'index'"
+                    )
+                }
+                stored = conn.exec_driver_sql(
+                    "SELECT long_url_hash FROM urls WHERE short_code = 'old1'"
+                ).scalar()
+            self.assertLessEqual(
+                {
+                    "ix_clicks_url_id_id",
+                    "ix_clicks_url_id_timestamp",
+                    "ix_clicks_url_id_ip_address",
+                    "ix_urls_active_expires_at",
+                    "ix_urls_owner_id_long_url_hash",
+                },
+                indexes,
+            )
+            self.assertNotIn("ix_urls_expires_at", indexes)
+            self.assertEqual(stored, url_hash("http://legacy.com/"))
+            sync_engine.dispose()
+            asyncio.run(aio_engine.dispose())
+
+    def test_totals_merged_from_daily_sketches(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = f"sqlite:///{os.path.join(tmp, 'sketches.db')}"
+            sync_engine, aio_engine = create_engines(
+                url, load_settings("development", {})
+            )
+            migrate(sync_engine, MIGRATIONS[:4])
+            days = [HyperLogLog(), HyperLogLog()]
+            for i in range(300):
+                days[i % 2].add(f"10.0.{i // 256}.{i % 256}")
+            days[1].add("10.0.0.0")
+            with sync_engine.begin() as conn:
+                conn.execute(insert(URL), {"id": 1, "long_url": "https://a"})
+                for day, sketch in enumerate(days, start=1):
+                    conn.execute(
+                        insert(UniqueVisitorSketch),
+                        {
+                            "url_id": 1,
+                            "bucket": datetime(2025, 1, day),
+                            "registers": sketch.to_bytes(),
+                        },
+                    )
+            self.assertEqual(migrate(sync_engine), ["unique_visitor_totals"])
+            with sync_engine.connect() as conn:
+                stored = conn.execute(select(UniqueVisitorTotal.registers)).scalar()
+            days[0].merge(days[1])
+            self.assertEqual(HyperLogLog.from_bytes(stored).registers, days[0].registers)
+            sync_engine.dispose()
+            asyncio.run(aio_engine.dispose())
+
+    def test_new_database_matches_models(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            url = f"sqlite:///{os.path.join(tmp, 'fresh.db')}"
+            sync_engine, aio_engine = create_engines(
+                url, load_settings("development", {})
+            )
+            migrate(sync_engine)
+            with sync_engine.connect() as conn:
+                schema = inspect(conn)
+                for table in Base.metadata.sorted_tables:
+                    columns = {c["name"] for c in schema.get_columns(table.name)}
+                    self.assertEqual(columns, set(table.c.keys()), table.name)
+                    indexes = {i["name"] for i in schema.get_indexes(table.name)}
+                    self.assertEqual(
+                        indexes, {i.name for i in table.indexes}, table.name
+                    )
+            sync_engine.dispose()
+            asyncio.run(aio_engine.dispose())
+
+    def test_analytics_queries_use_indexes(self):
+        db = SessionLocal()
+        reset_database(db)
+        url = create_dummy_url(db, short_code="plan1")
+        now = datetime.now(IST)
+        ingest_clicks(
+            db,
+            [
+                {
+                    "url_id": url.id,
+                    "timestamp": now - timedelta(days=days, hours=12),
+                    "ip_address": f"10.0.0.{days}",
+                    "user_agent": "Agent",
+                }
+                for days in range(40)
+            ],
+        )
+        db.commit()
+        recorder = PlanRecorder()
+        recorder.engines = (async_engine.sync_engine,)
+        with recorder:
+            response = client.get("/analytics/plan1", params={"exact_unique": "true"})
+        self.assertEqual(response.json()["analytics"]["unique_visitors_last_7d"], 7)
+        plans = recorder.plans(db)
+        self.assertTrue(plans)
+        for plan in plans:
+            self.assertNotIn("SCAN", plan)
+        # Distinct visitors are read from the indexes alone, never the table
+        clicks = [
+            step for plan in plans for step in plan.split(" | ") if "clicks" in step
+        ]
+        self.assertEqual(
+            clicks,
+            [
+                "SEARCH clicks USING COVERING INDEX ix_clicks_url_id_ip_address"
+                " (url_id=?)",
+                "SEARCH clicks USING COVERING INDEX ix_clicks_url_id_timestamp"
+                " (url_id=? AND timestamp>?)",
+                "SEARCH clicks USING COVERING INDEX ix_clicks_url_id_timestamp"
+                " (url_id=? AND timestamp>?)",
+            ],
+        )
+        db.close()
+
+    def test_expiry_scheduler_uses_partial_index(self):
+        db = SessionLocal()
+        recorder = PlanRecorder()
+        with recorder:
+            ExpiryScheduler().load(db)
+        [plan] = recorder.plans(db)
+        self.assertIn("ix_urls_active_expires_at", plan)
+        db.close()
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -1,23 +1,31 @@
-from sqlalchemy.orm import Session
-from models import URL
 import random, string
 
+# First path segments of the app's own routes; a link with one of these as its
+# code would be shadowed by the route and could never be reached
+RESERVED_CODES = {
+    "admin",
+    "analytics",
+    "docs",
+    "metrics",
+    "qr",
+    "redoc",
+    "register",
+    "shorten",
+    "token",
+    "urls",
+}
+
 
 def generate_short_code(length=6, prefix=""):
     code = "".join(random.choices(string.ascii_letters + string.digits, k=length))
     return prefix + code
 
 
-def generate_unique_short_code(db: Session, length=6):
-    while True:
-        code = generate_short_code(length)
-        if not db.query(URL).filter(URL.short_code == code).first():
-            return code
-
-
 def validate_custom_code(code: str) -> bool:
     """Validate custom short code format."""
     if not code or len(code) < 4:
         return False
+    if code.lower() in RESERVED_CODES:
+        return False
     # Only allow alphanumeric characters
     return code.isalnum()
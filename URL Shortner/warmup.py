@@ -0,0 +1,77 @@
+# Redirect cache warm-up at startup
+import asyncio
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+from cache import cache, record_for, ttl_for
+from models import IST, URL, ClickRollupHourly
+from rollups import hour_bucket
+
+
+async def ranked_links(
+    db, top_n: int, lookback_hours: int, now: datetime | None = None
+) -> list[tuple[URL, int]]:
+    """(link, clicks) for the links with the most clicks in the lookback window.
+
+    Reads the hourly rollups rather than raw clicks, so the cost depends on
+    links times hours, not on click volume.
+    """
+    now = datetime.now(IST) if now is None else now
+    since = hour_bucket(now - timedelta(hours=lookback_hours))
+    volume = (
+        select(
+            ClickRollupHourly.url_id,
+            func.sum(ClickRollupHourly.clicks).label("clicks"),
+        )
+        .where(ClickRollupHourly.bucket >= since)
+        .group_by(ClickRollupHourly.url_id)
+        .order_by(func.sum(ClickRollupHourly.clicks).desc())
+        .limit(top_n)
+        .subquery()
+    )
+    result = await db.execute(
+        select(URL, volume.c.clicks)
+        .join(volume, volume.c.url_id == URL.id)
+        .where(URL.is_active.is_(True))
+        .order_by(volume.c.clicks.desc())
+    )
+    return [tuple(row) for row in result.all()]
+
+
+async def warm_cache(router, top_n: int, lookback_hours: int, timeout: float) -> dict:
+    """Load the hottest links of all shards into the redirect cache.
+
+    Each shard ranks its own links and the lists are merged; gives up after
+    timeout.
+    """
+    start = time.perf_counter()
+    loaded = 0
+    timed_out = False
+
+    async def load():
+        nonlocal loaded
+        ranked = await router.fan_out(ranked_links, top_n, lookback_hours)
+        merged = sorted(
+            (pair for shard_links in ranked for pair in shard_links),
+            key=lambda pair: pair[1],
+            reverse=True,
+        )
+        now = time.time()
+        for db_url, _ in merged[:top_n]:
+            record = record_for(db_url)
+            if record.status_at(now) == "active":
+                await cache.set(db_url.short_code, record, ttl=ttl_for(record, now))
+                loaded += 1
+
+    if top_n > 0:
+        try:
+            await asyncio.wait_for(load(), timeout)
+        except asyncio.TimeoutError:
+            timed_out = True
+    return {
+        "loaded": loaded,
+        "seconds": round(time.perf_counter() - start, 3),
+        "timed_out": timed_out,
+    }